@@ -0,0 +1,149 @@
+import asyncio
+import json
+from datetime import datetime
+from unittest import mock
+
+from django.db import connection
+from django.db.models.signals import pre_migrate
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.urls import path
+from django.utils import timezone
+
+from movies.management.commands.bench_api import ensure_content_schema
+from movies.models import Filmwork
+from api.v1 import views
+from api.v1.search import SearchUnavailable, encode_search_after
+
+
+pre_migrate.connect(ensure_content_schema, dispatch_uid='api_tests_content_schema')
+
+# Маршруты сервиса movies_asgi (DJANGO_API_ASYNC_VIEWS=1) независимо от настроек, с которыми запущены тесты
+urlpatterns = [
+    path('api/v1/movies/', views.AsyncMoviesListApi.as_view()),
+    path('api/v1/movies/<uuid:pk>/', views.AsyncMoviesDetailApi.as_view()),
+    path('api/v1/movies/search/', views.MoviesSearchApi.as_view()),
+    path('api/v1/movies/export/', views.MoviesExportApi.as_view()),
+]
+
+
+# Асинхронные view выполняют запрос в другом потоке со своим соединением, поэтому данные теста должны быть
+# закоммичены (TransactionTestCase, а не TestCase)
+@override_settings(ROOT_URLCONF=__name__, REPLICA_DATABASES=[])
+class AsyncMoviesApiTests(TransactionTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # соединения потоков пула закрываются после каждого запроса, иначе они не дадут удалить тестовую базу
+        cls.conn_max_age = connection.settings_dict['CONN_MAX_AGE']
+        connection.settings_dict['CONN_MAX_AGE'] = 0
+
+    @classmethod
+    def tearDownClass(cls):
+        connection.settings_dict['CONN_MAX_AGE'] = cls.conn_max_age
+        super().tearDownClass()
+
+    def setUp(self):
+        self.film = Filmwork.objects.create(title='The Golden River', rating=7.5)
+        self.client = AsyncClient()
+
+    def tearDown(self):
+        # таблицы схемы content не очищаются между тестами (flush находит только таблицы из search_path без схемы)
+        Filmwork.objects.all().delete()
+
+    async def test_list(self):
+        response = await self.client.get('/api/v1/movies/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([film['id'] for film in response.json()['results']], [str(self.film.id)])
+
+    async def test_detail(self):
+        response = await self.client.get(f'/api/v1/movies/{self.film.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['title'], 'The Golden River')
+
+    async def test_conditional_get(self):
+        response = await self.client.get(f'/api/v1/movies/{self.film.id}/')
+        # AsyncClient передает дополнительные аргументы как заголовки ASGI-запроса
+        response = await self.client.get(f'/api/v1/movies/{self.film.id}/', **{'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_views_are_async(self):
+        # Django 3.2 вызывает view как корутину, только если сама функция view асинхронная
+        self.assertTrue(asyncio.iscoroutinefunction(views.AsyncMoviesListApi.as_view()))
+        self.assertTrue(asyncio.iscoroutinefunction(views.AsyncMoviesDetailApi.as_view()))
+
+
+@override_settings(ROOT_URLCONF=__name__, REPLICA_DATABASES=[])
+@mock.patch('api.v1.views.search_movies', side_effect=SearchUnavailable('connection refused'))
+class SearchFallbackTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        ratings = [9.0, 7.5, 7.5, None, 7.5, 5.0, None]
+        cls.films = [Filmwork.objects.create(title=f'Golden River {index}', rating=rating)
+                     for index, rating in enumerate(ratings)]
+        Filmwork.objects.create(title='Silent Night', rating=8.0)
+
+    def fetch_all(self, url):
+        ids, pages = [], 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [film['id'] for film in response.json()['results']]
+            cursor = response.json()['next']
+            url = cursor and f'/api/v1/movies/search/?query=river&sort={self.sort}&page_size=2&search_after={cursor}'
+            pages += 1
+        return ids, pages
+
+    def test_pages_by_keyset(self, search_movies):
+        for sort, key in (('imdb_rating', lambda film: (film.rating is None, film.rating or 0, str(film.id))),
+                          ('-imdb_rating', lambda film: (film.rating is None, -(film.rating or 0), str(film.id))),
+                          ('-title', lambda film: (tuple(-ord(char) for char in film.title), str(film.id)))):
+            with self.subTest(sort=sort):
+                self.sort = sort
+                ids, pages = self.fetch_all(f'/api/v1/movies/search/?query=river&sort={sort}&page_size=2')
+                self.assertEqual(ids, [str(film.id) for film in sorted(self.films, key=key)])
+                self.assertEqual(pages, 4)
+
+    def test_relevance(self, search_movies):
+        self.sort = 'relevance'
+        ids, _ = self.fetch_all('/api/v1/movies/search/?query=river&page_size=2')
+        self.assertCountEqual(ids, [str(film.id) for film in self.films])
+
+    def test_count(self, search_movies):
+        response = self.client.get('/api/v1/movies/search/?query=river&sort=title&page_size=2')
+        self.assertEqual(response.json()['count'], len(self.films))
+
+    def test_elasticsearch_cursor(self, search_movies):
+        cursor = encode_search_after([7.5, str(self.films[0].id)])
+        response = self.client.get(f'/api/v1/movies/search/?query=river&sort=-imdb_rating&search_after={cursor}')
+        self.assertEqual(response.status_code, 503)
+
+
+@override_settings(ROOT_URLCONF=__name__, REPLICA_DATABASES=[])
+class ExportUpdatedSinceTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.old_film = Filmwork.objects.create(title='Old River')
+        cls.new_film = Filmwork.objects.create(title='New River')
+        Filmwork.objects.filter(id=cls.old_film.id).update(updated_at=datetime(1999, 12, 31, 23, tzinfo=timezone.utc))
+        Filmwork.objects.filter(id=cls.new_film.id).update(updated_at=datetime(2000, 1, 1, 1, tzinfo=timezone.utc))
+
+    def export_ids(self, updated_since):
+        response = self.client.get('/api/v1/movies/export/', {'updated_since': updated_since})
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line)['id'] for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_date(self):
+        self.assertEqual(self.export_ids('2000-01-01'), [str(self.new_film.id)])
+
+    def test_datetime(self):
+        self.assertEqual(self.export_ids('2000-01-01T00:30:00+00:00'), [str(self.new_film.id)])
+        self.assertEqual(len(self.export_ids('1999-12-31T22:00:00')), 2)
+
+    def test_invalid(self):
+        for value in ('yesterday', '2000-13-01'):
+            with self.subTest(value=value):
+                response = self.client.get('/api/v1/movies/export/', {'updated_since': value})
+                self.assertEqual(response.status_code, 400)
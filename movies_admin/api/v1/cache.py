@@ -0,0 +1,54 @@
+import hashlib
+from typing import Iterable
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+from movies.cache import get_cache, get_catalog_version
+
+
+class CachedResponseMixin:
+    """
+    Кеширование ответов API с условными GET-запросами.
+    Ответ кешируется по пути и параметрам запроса вместе с версией каталога, которую увеличивают сигналы при любом
+    изменении фильмов, персон, жанров и их связей. ETag строится из того же ключа (версия каталога, путь и параметры),
+    поэтому он меняется при любом изменении каталога, а запрос с актуальным If-None-Match получает 304 без обращения
+    к кешу ответов и к базе. Last-Modified не отдается: по updated_at фильмов в ответе не видно удалений фильмов
+    и переименований персон и жанров, и клиент с одним If-Modified-Since получил бы 304 на устаревший ответ.
+    """
+
+    def get(self, request, *args, **kwargs):
+        digest = self.get_response_digest(request)
+        etag = quote_etag(digest)
+        conditional_response = get_conditional_response(request, etag=etag)
+        if conditional_response is not None:
+            conditional_response['ETag'] = etag
+            return conditional_response
+
+        cache = get_cache()
+        cache_key = f'api:response:{digest}'
+        content = cache.get(cache_key)
+        if content is None:
+            response = super().get(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            content = response.content
+            cache.set(cache_key, content, settings.MOVIES_API_CACHE_TIMEOUT)
+
+        response = HttpResponse(content, content_type='application/json')
+        response['ETag'] = etag
+        return response
+
+    @staticmethod
+    def get_response_digest(request) -> str:
+        """Хеш версии каталога, пути и параметров запроса (все значения повторяющихся параметров, в порядке ключей)"""
+        query = '&'.join(f'{key}={value}' for key, values in sorted(request.GET.lists()) for value in values)
+        return hashlib.md5(f'{get_catalog_version()}:{request.path}?{query}'.encode()).hexdigest()
+
+    @staticmethod
+    def pop_updated_at(items: Iterable[dict]):
+        """Убрать служебное поле updated_at из выдачи"""
+        for item in items:
+            item.pop('updated_at', None)
@@ -0,0 +1,71 @@
+import base64
+import binascii
+import json
+import uuid
+from dataclasses import dataclass
+from typing import List, Optional
+
+from django.core.exceptions import BadRequest
+
+from movies.paginator import EstimatedCountPaginator
+
+
+# Время жизни закешированного кол-ва записей (сек)
+COUNT_CACHE_TIMEOUT = 60
+
+
+class CachedCountPaginator(EstimatedCountPaginator):
+    """Пагинатор списка API: список запрашивается часто, поэтому кол-во записей кешируется"""
+    count_cache_timeout = COUNT_CACHE_TIMEOUT
+
+
+@dataclass
+class CursorPage:
+    results: List
+    next: Optional[str]
+    prev: Optional[str]
+
+
+def encode_cursor(key: uuid.UUID, reverse: bool) -> str:
+    raw = json.dumps({'k': str(key), 'r': reverse}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token: str) -> (Optional[uuid.UUID], bool):
+    if not token:
+        return None, False
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        data = json.loads(raw)
+        return uuid.UUID(data['k']), bool(data['r'])
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise BadRequest('Invalid cursor')
+
+
+def paginate_by_cursor(queryset, token: str, per_page: int, key: str = 'id') -> CursorPage:
+    """Keyset-пагинация по уникальному ключу key: вместо OFFSET страница выбирается условием key > / < курсора,
+    поэтому стоимость запроса не зависит от глубины страницы"""
+    position, reverse = decode_cursor(token)
+    if position is not None:
+        queryset = queryset.filter(**{f'{key}__lt' if reverse else f'{key}__gt': position})
+    queryset = queryset.order_by(f'-{key}' if reverse else key)
+
+    # берем на одну запись больше, чтобы узнать, есть ли следующая страница
+    results = list(queryset[:per_page + 1])
+    has_more = len(results) > per_page
+    results = results[:per_page]
+    if reverse:
+        results.reverse()
+
+    if not results:
+        return CursorPage(results=[], next=None, prev=None)
+
+    first_key, last_key = results[0][key], results[-1][key]
+    if reverse:
+        has_next, has_prev = position is not None, has_more
+    else:
+        has_next, has_prev = has_more, position is not None
+
+    return CursorPage(results=results,
+                      next=encode_cursor(last_key, reverse=False) if has_next else None,
+                      prev=encode_cursor(first_key, reverse=True) if has_prev else None)
@@ -0,0 +1,208 @@
+import base64
+import binascii
+import json
+import logging
+import threading
+import uuid
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.exceptions import BadRequest
+
+from movies.models import FilmworkType
+
+
+logger = logging.getLogger(__name__)
+
+
+class SearchUnavailable(Exception):
+    """Elasticsearch недоступен или ответил ошибкой"""
+
+
+class ElasticsearchClient:
+    """Клиент Elasticsearch с пулом keep-alive соединений, общий для всех потоков воркера"""
+
+    def __init__(self, url: str, timeout: float, pool_size: int):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def search(self, index: str, body: Dict) -> Dict:
+        try:
+            response = self.session.post(f'{self.url}/{index}/_search',
+                                         data=json.dumps(body),
+                                         headers={'Content-Type': 'application/json'},
+                                         timeout=self.timeout)
+        except requests.exceptions.RequestException as err:
+            raise SearchUnavailable(err)
+        if response.status_code >= 500:
+            raise SearchUnavailable(f'Elasticsearch responded with {response.status_code}')
+        if response.status_code != 200:
+            raise BadRequest(f'Invalid search request ({response.status_code})')
+        return response.json()
+
+
+_es_client: Optional[ElasticsearchClient] = None
+_es_client_lock = threading.Lock()
+
+
+def get_es_client() -> ElasticsearchClient:
+    global _es_client
+    with _es_client_lock:
+        if _es_client is None:
+            _es_client = ElasticsearchClient(settings.ELASTICSEARCH_URL,
+                                             settings.ELASTICSEARCH_TIMEOUT,
+                                             settings.ELASTICSEARCH_POOL_SIZE)
+        return _es_client
+
+
+# Сортировки, доступные в параметре sort. id в конце каждой сортировки - для однозначного порядка и search_after
+SORT_OPTIONS = {
+    'relevance': [{'_score': 'desc'}, {'id': 'asc'}],
+    'imdb_rating': [{'imdb_rating': {'order': 'asc', 'missing': '_last'}}, {'id': 'asc'}],
+    '-imdb_rating': [{'imdb_rating': {'order': 'desc', 'missing': '_last'}}, {'id': 'asc'}],
+    'title': [{'title.raw': 'asc'}, {'id': 'asc'}],
+    '-title': [{'title.raw': 'desc'}, {'id': 'asc'}],
+}
+
+# Сортировки, для которых не считается общее кол-во найденных фильмов (count в ответе - null). Топ по рейтингу
+# листают с начала страницами, и total для него не нужен, а без подсчета ES не обязан собирать все совпадения.
+# Сортировки индекса (index.sort) здесь нет: ES 7 не поддерживает ее в индексах с nested-полями (жанры и персоны)
+SORTS_WITHOUT_COUNT = frozenset({'-imdb_rating'})
+
+PERSON_ROLES = ('actors', 'writers', 'directors')
+
+# Первый элемент search_after выдачи упрощенного поиска в Postgres: [POSTGRES_CURSOR, значение ключа сортировки, id].
+# Значения сортировки ES объектами не бывают, поэтому курсоры двух источников не путаются
+POSTGRES_CURSOR = {'source': 'postgres'}
+
+
+@dataclass
+class SearchParams:
+    query: Optional[str] = None
+    genre: Optional[uuid.UUID] = None
+    person: Optional[uuid.UUID] = None
+    rating_min: Optional[float] = None
+    rating_max: Optional[float] = None
+    type: Optional[str] = None
+    sort: str = 'relevance'
+    page_size: int = 50
+    search_after: Optional[List] = None
+
+    @classmethod
+    def from_request(cls, request, max_page_size: int = 100):
+        params = request.GET
+        try:
+            search_params = cls(
+                query=params.get('query') or None,
+                genre=uuid.UUID(params['genre']) if params.get('genre') else None,
+                person=uuid.UUID(params['person']) if params.get('person') else None,
+                rating_min=float(params['rating_min']) if params.get('rating_min') else None,
+                rating_max=float(params['rating_max']) if params.get('rating_max') else None,
+                type=params.get('type') or None,
+                sort=params.get('sort') or 'relevance',
+                page_size=min(int(params.get('page_size', 50)), max_page_size),
+                search_after=decode_search_after(params['search_after']) if params.get('search_after') else None,
+            )
+        except ValueError as err:
+            raise BadRequest(f'Invalid search parameters: {err}')
+
+        if search_params.sort not in SORT_OPTIONS:
+            raise BadRequest(f'Unknown sort: {search_params.sort}')
+        if search_params.type and search_params.type not in FilmworkType.values:
+            raise BadRequest(f'Unknown type: {search_params.type}')
+        if search_params.page_size < 1:
+            raise BadRequest('page_size must be positive')
+        return search_params
+
+
+def encode_search_after(sort_values: List) -> str:
+    return base64.urlsafe_b64encode(json.dumps(sort_values).encode()).decode().rstrip('=')
+
+
+def decode_search_after(token: str) -> List:
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError):
+        raise ValueError('search_after')
+    if not isinstance(sort_values, list):
+        raise ValueError('search_after')
+    return sort_values
+
+
+def is_postgres_cursor(search_after: Optional[List]) -> bool:
+    return bool(search_after) and search_after[0] == POSTGRES_CURSOR
+
+
+def build_search_body(params: SearchParams) -> Dict:
+    """Запрос к индексу фильмов по параметрам поиска"""
+    must = []
+    filters = []
+    if params.query:
+        must.append({
+            'multi_match': {
+                'query': params.query,
+                'fields': ['title^3', 'actors_names', 'directors_names', 'writers_names', 'description'],
+            }
+        })
+    if params.genre:
+        filters.append({'nested': {'path': 'genres', 'query': {'term': {'genres.id': str(params.genre)}}}})
+    if params.person:
+        filters.append({'bool': {'should': [
+            {'nested': {'path': role, 'query': {'term': {f'{role}.id': str(params.person)}}}} for role in PERSON_ROLES
+        ]}})
+    if params.rating_min is not None or params.rating_max is not None:
+        rating_range = {}
+        if params.rating_min is not None:
+            rating_range['gte'] = params.rating_min
+        if params.rating_max is not None:
+            rating_range['lte'] = params.rating_max
+        filters.append({'range': {'imdb_rating': rating_range}})
+    if params.type:
+        filters.append({'term': {'type': params.type}})
+
+    body = {
+        'size': params.page_size,
+        'query': {'bool': {'must': must or [{'match_all': {}}], 'filter': filters}},
+        'sort': SORT_OPTIONS[params.sort],
+        '_source': ['id', 'title', 'description', 'imdb_rating', 'type', 'genres', *PERSON_ROLES],
+    }
+    if params.sort in SORTS_WITHOUT_COUNT:
+        body['track_total_hits'] = False
+    if params.search_after:
+        body['search_after'] = params.search_after
+    return body
+
+
+def transform_hit(hit: Dict) -> Dict:
+    """Документ индекса в формате ответа API фильмов"""
+    source = hit['_source']
+    return {
+        'id': source['id'],
+        'title': source.get('title'),
+        'description': source.get('description'),
+        'rating': source.get('imdb_rating'),
+        'type': source.get('type'),
+        'genres': [genre['name'] for genre in source.get('genres', [])],
+        'actors': [person['name'] for person in source.get('actors', [])],
+        'directors': [person['name'] for person in source.get('directors', [])],
+        'writers': [person['name'] for person in source.get('writers', [])],
+    }
+
+
+def search_movies(params: SearchParams) -> Dict:
+    """Поиск фильмов в Elasticsearch. Выбрасывает SearchUnavailable, если ES недоступен"""
+    response = get_es_client().search(settings.ELASTICSEARCH_MOVIES_INDEX, build_search_body(params))
+    hits = response['hits']['hits']
+    has_next = len(hits) == params.page_size
+    return {
+        'count': response['hits']['total']['value'] if 'total' in response['hits'] else None,
+        'next': encode_search_after(hits[-1]['sort']) if hits and has_next else None,
+        'results': [transform_hit(hit) for hit in hits],
+    }
@@ -1,9 +1,21 @@
+from django.conf import settings
 from django.urls import path
 
 from api.v1 import views
 
 
+# Под ASGI список и карточка фильма обслуживаются асинхронными view
+if settings.API_ASYNC_VIEWS:
+    movies_list_view, movies_detail_view = views.AsyncMoviesListApi, views.AsyncMoviesDetailApi
+else:
+    movies_list_view, movies_detail_view = views.MoviesListApi, views.MoviesDetailApi
+
+
 urlpatterns = [
-    path('movies/', views.MoviesListApi.as_view()),
-    path('movies/<uuid:pk>/', views.MoviesDetailApi.as_view()),
+    path('movies/', movies_list_view.as_view()),
+    path('movies/search/', views.MoviesSearchApi.as_view()),
+    path('movies/export/', views.MoviesExportApi.as_view()),
+    path('movies/batch/', views.MoviesBatchApi.as_view()),
+    path('movies/facets/', views.MoviesFacetsApi.as_view()),
+    path('movies/<uuid:pk>/', movies_detail_view.as_view()),
 ]
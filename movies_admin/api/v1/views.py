@@ -1,52 +1,402 @@
-from django.http import JsonResponse
+import functools
+import json
+import logging
+import uuid
+import zlib
+from datetime import datetime, time
+
+from asgiref.sync import sync_to_async
+
+from django.core.exceptions import BadRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, router
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic.list import BaseListView
 from django.views.generic.detail import BaseDetailView
-from django.db.models import Q, OuterRef, Subquery
+from django.db.models import Q, OuterRef, Subquery, F
 from django.contrib.postgres.aggregates import ArrayAgg
 
-from movies.models import Filmwork, FilmworkGenre, PersonType
+from config.db_pool import bind_pool_executor, check_connections, release_connections
+from config.instrumentation import timing
+from movies.facets import get_facets
+from movies.models import Filmwork, FilmworkGenre, FilmworkPerson, PersonType
+from movies.paginator import get_estimated_count
+from api.v1.cache import CachedResponseMixin
+from api.v1.pagination import COUNT_CACHE_TIMEOUT, CachedCountPaginator, paginate_by_cursor
+from api.v1.search import (POSTGRES_CURSOR, SORTS_WITHOUT_COUNT, SearchParams, SearchUnavailable, encode_search_after,
+                           is_postgres_cursor, search_movies)
+
+
+logger = logging.getLogger(__name__)
 
 
 class MoviesApiMixin:
     model = Filmwork
     http_method_names = ['get']
 
+    # поля, которые можно запросить параметром fields=; агрегаты по персонам и жанрам считаются только если запрошены
+    plain_fields = ('id', 'title', 'description', 'creation_date', 'rating', 'type')
+    person_fields = {
+        'actors': PersonType.ACTOR,
+        'directors': PersonType.DIRECTOR,
+        'writers': PersonType.WRITER,
+    }
+    fields_kwarg = 'fields'
+
+    def get_fields(self):
+        """Запрошенные поля фильма (по умолчанию все). id возвращается всегда"""
+        all_fields = (*self.plain_fields, *self.person_fields, 'genres')
+        requested = self.request.GET.get(self.fields_kwarg)
+        if not requested:
+            return all_fields
+
+        fields = {field.strip() for field in requested.split(',') if field.strip()}
+        unknown = fields.difference(all_fields)
+        if unknown:
+            raise BadRequest(f'Unknown fields: {", ".join(sorted(unknown))}')
+        fields.add('id')
+        return tuple(field for field in all_fields if field in fields)
+
     def get_queryset(self):
-        genres_sub = FilmworkGenre.objects.filter(film_work=OuterRef('pk')) \
-            .values('film_work') \
-            .annotate(genres=ArrayAgg('genre__name')) \
-            .values_list('genres')
-        query_set = (Filmwork.objects.values('id', 'title', 'description', 'creation_date', 'rating', 'type')
-                     .annotate(actors=self._aggregate_person(PersonType.ACTOR),
-                               directors=self._aggregate_person(PersonType.DIRECTOR),
-                               writers=self._aggregate_person(PersonType.WRITER))
-                     .annotate(genres=Subquery(genres_sub)))
-        return query_set
+        fields = self.get_fields()
+        query_set = Filmwork.objects.values(*(field for field in self.plain_fields if field in fields), 'updated_at')
+
+        person_aggregates = {field: self._aggregate_person(role)
+                             for field, role in self.person_fields.items() if field in fields}
+        if person_aggregates:
+            query_set = query_set.annotate(**person_aggregates)
+
+        if 'genres' in fields:
+            genres_sub = FilmworkGenre.objects.filter(film_work=OuterRef('pk')) \
+                .values('film_work') \
+                .annotate(genres=ArrayAgg('genre__name')) \
+                .values_list('genres')
+            query_set = query_set.annotate(genres=Subquery(genres_sub))
+
+        return query_set.order_by('id')
 
     def render_to_response(self, context, **response_kwargs):
-        return JsonResponse(context)
+        with timing('serialize'):
+            return JsonResponse(context)
 
     @staticmethod
     def _aggregate_person(role: PersonType):
         return ArrayAgg('persons__full_name', filter=Q(filmworkperson__role=role))
 
 
-class MoviesListApi(MoviesApiMixin, BaseListView):
+def _with_db_connection_cleanup(func):
+    """Проверять и закрывать устаревшие соединения с базой в потоке пула: сигналы request_started и request_finished
+    и ConnectionHealthCheckMiddleware делают это только в потоке запроса"""
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        close_old_connections()
+        check_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            release_connections()
+            close_old_connections()
+    return inner
+
+
+class AsyncViewMixin:
+    """
+    Асинхронный вариант view для работы под ASGI. В Django 3.2 ORM синхронный, поэтому обработка запроса целиком
+    выполняется в пуле потоков (thread_sensitive=False), а event loop в это время обслуживает другие запросы.
+    Без этого ASGI выполняет все синхронные view в одном общем потоке.
+    В Django 3.2 View.as_view() всегда возвращает синхронную функцию (асинхронный метод get она вернула бы
+    неожиданной корутиной), поэтому асинхронной делается сама функция view.
+    """
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        handler = _with_db_connection_cleanup(view)
+
+        async def async_view(request, *args, **kwargs):
+            bind_pool_executor()
+            return await sync_to_async(handler, thread_sensitive=False)(request, *args, **kwargs)
+
+        # view_class, view_initkwargs и пр., как у функции из as_view()
+        functools.update_wrapper(async_view, view)
+        return async_view
+
+
+class MoviesListApi(CachedResponseMixin, MoviesApiMixin, BaseListView):
     paginate_by = 50
+    paginator_class = CachedCountPaginator
+    cursor_kwarg = 'cursor'
 
     def get_context_data(self, *, object_list=None, **kwargs):
         queryset = self.get_queryset()
+        if self.cursor_kwarg in self.request.GET:
+            return self.get_cursor_context_data(queryset)
+
         paginator, page, queryset, is_paginated = self.paginate_queryset(queryset, self.paginate_by)
+        results = list(queryset)
+        self.pop_updated_at(results)
         context = {
             'count': paginator.count,
             'total_pages': paginator.num_pages,
             'prev': page.previous_page_number() if page.has_previous() else None,
             'next': page.next_page_number() if page.has_next() else None,
-            'results': list(queryset),
+            'results': results,
         }
         return context
 
+    def get_cursor_context_data(self, queryset):
+        """Постраничная выдача по курсору (?cursor=, пустой курсор - первая страница) без OFFSET и COUNT(*)"""
+        page = paginate_by_cursor(queryset, self.request.GET.get(self.cursor_kwarg), self.paginate_by)
+        self.pop_updated_at(page.results)
+        return {
+            'count': get_estimated_count(queryset, COUNT_CACHE_TIMEOUT),
+            'prev': page.prev,
+            'next': page.next,
+            'results': page.results,
+        }
 
-class MoviesDetailApi(MoviesApiMixin, BaseDetailView):
+
+class MoviesDetailApi(CachedResponseMixin, MoviesApiMixin, BaseDetailView):
     def get_context_data(self, **kwargs):
-        return super().get_context_data(**kwargs)['object']
+        film = super().get_context_data(**kwargs)['object']
+        self.pop_updated_at((film,))
+        return film
+
+
+class AsyncMoviesListApi(AsyncViewMixin, MoviesListApi):
+    pass
+
+
+class AsyncMoviesDetailApi(AsyncViewMixin, MoviesDetailApi):
+    pass
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class MoviesBatchApi(MoviesApiMixin, View):
+    """
+    Получение нескольких фильмов одним запросом: GET ?ids=<id>,<id>,... или POST с телом {"ids": [...]}
+    (для больших списков, которые не помещаются в URL). Поддерживает параметр fields.
+    """
+    http_method_names = ['get', 'post']
+    max_ids = 500
+
+    def get(self, request, *args, **kwargs):
+        return self.render_batch(request.GET.get('ids', '').split(','))
+
+    def post(self, request, *args, **kwargs):
+        try:
+            ids = json.loads(request.body).get('ids', [])
+        except (ValueError, AttributeError):
+            raise BadRequest('Expected JSON body with ids')
+        if not isinstance(ids, list):
+            raise BadRequest('ids must be a list')
+        return self.render_batch(ids)
+
+    def render_batch(self, raw_ids):
+        try:
+            ids = list(dict.fromkeys(uuid.UUID(str(raw_id).strip()) for raw_id in raw_ids if str(raw_id).strip()))
+        except ValueError:
+            raise BadRequest('Invalid id')
+        if len(ids) > self.max_ids:
+            raise BadRequest(f'Too many ids (max {self.max_ids})')
+
+        films = {film['id']: film for film in self.get_queryset().filter(id__in=ids)} if ids else {}
+        for film in films.values():
+            film.pop('updated_at', None)
+        return self.render_to_response({
+            'results': [films[film_id] for film_id in ids if film_id in films],
+            'not_found': [film_id for film_id in ids if film_id not in films],
+        })
+
+
+class MoviesSearchApi(MoviesApiMixin, View):
+    """
+    Поиск фильмов по индексу Elasticsearch. Если ES недоступен, выполняется упрощенный поиск в Postgres со своим
+    курсором next: следующие страницы этой выдачи тоже берутся из Postgres. Продолжить в Postgres выдачу, начатую
+    в ES, нельзя (у них разные значения сортировки), на такой запрос при недоступном ES отвечаем 503
+    """
+    max_page_size = 100
+
+    # ключи сортировок поиска в Postgres: (поле, по убыванию, может ли быть NULL - такие строки идут в конце).
+    # После ключа строки упорядочены по id. Сортировка relevance - по search_rank, а без строки поиска - только по id
+    fallback_keys = {
+        'imdb_rating': ('rating', False, True),
+        '-imdb_rating': ('rating', True, True),
+        'title': ('title', False, False),
+        '-title': ('title', True, False),
+    }
+
+    def get(self, request, *args, **kwargs):
+        params = SearchParams.from_request(request, self.max_page_size)
+        if is_postgres_cursor(params.search_after):
+            return self.render_to_response(self.search_in_postgres(params))
+        try:
+            context = search_movies(params)
+            fields = self.get_fields()
+            context['results'] = [{field: film.get(field) for field in fields} for film in context['results']]
+        except SearchUnavailable as err:
+            if params.search_after:
+                logger.warning(f'Search: Elasticsearch is unavailable ({err}), cannot continue its results')
+                return JsonResponse({'error': 'Search is temporarily unavailable'}, status=503)
+            logger.warning(f'Search: Elasticsearch is unavailable ({err}), falling back to postgres')
+            context = self.search_in_postgres(params)
+        return self.render_to_response(context)
+
+    def get_fallback_key(self, params: SearchParams):
+        if params.sort in self.fallback_keys:
+            return self.fallback_keys[params.sort]
+        return ('search_rank', True, False) if params.query else (None, False, False)
+
+    def search_in_postgres(self, params: SearchParams):
+        """
+        Поиск в Postgres по тем же параметрам. Страницы выбираются по ключу (ключ сортировки, id) из search_after,
+        count - точное кол-во найденных фильмов или оценка планировщика для больших выборок
+        """
+        queryset = self.filter_search(self.get_queryset(), params)
+        count = None
+        if params.sort not in SORTS_WITHOUT_COUNT:
+            count = get_estimated_count(self.filter_search(Filmwork.objects.all(), params), COUNT_CACHE_TIMEOUT)
+
+        key, descending, nullable = self.get_fallback_key(params)
+        if key:
+            # ключ нужен в выдаче для курсора, даже если его поле не запрошено в fields=
+            queryset = queryset.annotate(sort_key=F(key))
+            sort_key = F('sort_key').desc(nulls_last=True) if descending else F('sort_key').asc(nulls_last=True)
+            queryset = queryset.order_by(sort_key, 'id')
+        else:
+            queryset = queryset.order_by('id')
+        if params.search_after:
+            queryset = queryset.filter(self.keyset_filter(params.search_after, key, descending, nullable))
+
+        # берем на одну запись больше, чтобы узнать, есть ли следующая страница
+        results = list(queryset[:params.page_size + 1])
+        next_cursor = None
+        if len(results) > params.page_size:
+            results = results[:params.page_size]
+            last = results[-1]
+            next_cursor = encode_search_after([POSTGRES_CURSOR, last.get('sort_key'), str(last['id'])])
+        for film in results:
+            for field in ('updated_at', 'search_rank', 'sort_key'):
+                film.pop(field, None)
+        return {
+            'count': count,
+            'next': next_cursor,
+            'results': results,
+        }
+
+    @staticmethod
+    def keyset_filter(search_after, key, descending: bool, nullable: bool) -> Q:
+        """Условие "строка после курсора" для порядка (sort_key с NULL в конце, id)"""
+        try:
+            _, value, last_id = search_after
+            last_id = uuid.UUID(last_id)
+        except (TypeError, ValueError, AttributeError):
+            raise BadRequest('Invalid search_after')
+        if not key:
+            return Q(id__gt=last_id)
+        if value is None:
+            if not nullable:
+                raise BadRequest('Invalid search_after')
+            return Q(sort_key__isnull=True, id__gt=last_id)
+        # курсор мог остаться от выдачи с другой сортировкой
+        value_types = (str,) if key == 'title' else (int, float)
+        if not isinstance(value, value_types) or isinstance(value, bool):
+            raise BadRequest('Invalid search_after')
+        after = (Q(sort_key__lt=value) if descending else Q(sort_key__gt=value)) | Q(sort_key=value, id__gt=last_id)
+        if nullable:
+            after |= Q(sort_key__isnull=True)
+        return after
+
+    @staticmethod
+    def filter_search(queryset, params: SearchParams):
+        """Фильтры поиска в Postgres"""
+        if params.query:
+            # полнотекстовый поиск по search_vector, по умолчанию результаты упорядочены по релевантности
+            queryset = queryset.search(params.query)
+        # фильтры по связям делаем подзапросами, чтобы join не размножал строки агрегатов
+        if params.genre:
+            queryset = queryset.filter(id__in=FilmworkGenre.objects.filter(genre_id=params.genre)
+                                       .values('film_work_id'))
+        if params.person:
+            queryset = queryset.filter(id__in=FilmworkPerson.objects.filter(person_id=params.person)
+                                       .values('film_work_id'))
+        if params.rating_min is not None:
+            queryset = queryset.filter(rating__gte=params.rating_min)
+        if params.rating_max is not None:
+            queryset = queryset.filter(rating__lte=params.rating_max)
+        if params.type:
+            queryset = queryset.filter(type=params.type)
+        return queryset
+
+
+class MoviesExportApi(MoviesApiMixin, View):
+    """
+    Потоковая выгрузка всего каталога в формате NDJSON (по фильму на строку) одним запросом.
+    Данные читаются серверным курсором пачками по chunk_size, поэтому память воркера не зависит от размера каталога.
+    Параметр updated_since (ISO 8601) ограничивает выгрузку фильмами, изменившимися после указанного момента.
+    Дата без времени означает полночь UTC, время без часового пояса - время UTC.
+    Если клиент поддерживает gzip (Accept-Encoding), поток сжимается на лету.
+    """
+    chunk_size = 2000
+
+    def get(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
+        updated_since = request.GET.get('updated_since')
+        if updated_since:
+            queryset = queryset.filter(updated_at__gt=self.parse_updated_since(updated_since))
+
+        use_gzip = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+        lines = self.iter_lines(queryset)
+        response = StreamingHttpResponse(self.gzip_stream(lines) if use_gzip else lines,
+                                         content_type='application/x-ndjson')
+        if use_gzip:
+            response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        # не даем nginx буферизовать поток целиком
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    @staticmethod
+    def parse_updated_since(value: str) -> datetime:
+        try:
+            updated_since = parse_datetime(value)
+            if not updated_since:
+                date = parse_date(value)
+                updated_since = datetime.combine(date, time.min) if date else None
+        except ValueError:
+            updated_since = None
+        if not updated_since:
+            raise BadRequest('Invalid updated_since')
+        if timezone.is_naive(updated_since):
+            updated_since = timezone.make_aware(updated_since, timezone.utc)
+        return updated_since
+
+    def iter_lines(self, queryset):
+        encoder = DjangoJSONEncoder()
+        for film in queryset.iterator(chunk_size=self.chunk_size):
+            yield (encoder.encode(film) + '\n').encode()
+
+    @staticmethod
+    def gzip_stream(chunks):
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+        for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+
+class MoviesFacetsApi(View):
+    """
+    Кол-во фильмов по жанрам, типам и диапазонам рейтинга (те же диапазоны, что в фильтре админки).
+    Читаются готовые счетчики (см. movies/facets.py), поэтому время ответа не зависит от размера каталога
+    """
+    http_method_names = ['get']
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(get_facets(using=router.db_for_read(Filmwork)))
@@ -0,0 +1,102 @@
+"""
+Нагрузочный тест API фильмов: сравнение задержек (p50/p95/p99) и пропускной способности разных способов запуска
+(например, WSGI-сервиса movies и ASGI-сервиса movies_asgi) при росте числа одновременных клиентов.
+
+Пример запуска (сервисы должны быть доступны с машины, где запускается тест):
+    $ python benchmarks/load_test.py --target wsgi=http://127.0.0.1:8000 --target asgi=http://127.0.0.1:8001 \
+        --concurrency 3 10 50 100 --duration 30
+
+Чтобы измерять работу с базой, а не кеш ответов, сервисы нужно запускать с MOVIES_API_CACHE_TIMEOUT=0.
+"""
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+
+def fetch(url: str, timeout: float) -> float:
+    started = time.perf_counter()
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        response.read()
+    return time.perf_counter() - started
+
+
+def get_sample_ids(base_url: str, timeout: float) -> List[str]:
+    with urllib.request.urlopen(f'{base_url}/api/v1/movies/?fields=id', timeout=timeout) as response:
+        return [film['id'] for film in json.load(response)['results']]
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+
+def run_load(base_url: str, film_ids: List[str], concurrency: int, duration: float, timeout: float) -> Dict:
+    """concurrency клиентов в течение duration секунд запрашивают страницы списка и карточки фильмов"""
+    deadline = time.monotonic() + duration
+    latencies: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def client():
+        nonlocal errors
+        while time.monotonic() < deadline:
+            if film_ids and random.random() < 0.5:
+                url = f'{base_url}/api/v1/movies/{random.choice(film_ids)}/'
+            else:
+                url = f'{base_url}/api/v1/movies/?page={random.randint(1, 20)}'
+            try:
+                latency = fetch(url, timeout)
+            except (urllib.error.URLError, OSError):
+                with lock:
+                    errors += 1
+                continue
+            with lock:
+                latencies.append(latency)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(client)
+
+    latencies.sort()
+    if not latencies:
+        return {'requests': 0, 'errors': errors}
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / duration, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Нагрузочный тест API фильмов')
+    parser.add_argument('--target', action='append', required=True,
+                        help='имя=базовый URL сервиса, можно указать несколько раз')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[3, 10, 50])
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--output', default=None, help='файл для сохранения результатов в json')
+    args = parser.parse_args()
+
+    results = []
+    for target in args.target:
+        name, base_url = target.split('=', 1)
+        base_url = base_url.rstrip('/')
+        ids = get_sample_ids(base_url, args.timeout)
+        for concurrency in args.concurrency:
+            result = {'target': name, 'concurrency': concurrency,
+                      **run_load(base_url, ids, concurrency, args.duration, args.timeout)}
+            results.append(result)
+            print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, 'w') as fs:
+            json.dump(results, fs, indent=2)
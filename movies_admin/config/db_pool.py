@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+
+from config.middleware import SyncAndAsyncMiddleware
+
+
+# Постоянные соединения с базой. Django держит по одному соединению на алиас базы в каждом потоке и с CONN_MAX_AGE
+# не закрывает его между запросами, так что установка соединения (TCP, аутентификация, настройка сессии) уходит из
+# времени ответа. Поэтому размер "пула" определяется кол-вом потоков, которые ходят в базу:
+# - синхронный воркер gunicorn - один поток, одно соединение на алиас;
+# - ASGI-воркер - поток обработки запроса плюс пул потоков асинхронных view, ограниченный DB_POOL_SIZE.
+# Всего соединений с каждой базой не больше workers * (1 + DB_POOL_SIZE) на сервис.
+#
+# Django 3.2 не проверяет постоянное соединение перед использованием, и соединение, закрытое сервером или
+# балансировщиком за время простоя, дает ошибку первому запросу после простоя. Поэтому соединение, простаивавшее
+# дольше DB_CONN_HEALTH_CHECK_SECONDS, проверяется (SELECT 1) и при ошибке закрывается - Django откроет новое.
+
+
+logger = logging.getLogger(__name__)
+
+_pool_loops = weakref.WeakSet()
+
+
+def check_connections():
+    """Проверка постоянных соединений текущего потока перед обработкой запроса"""
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is None:
+            continue
+        released_at = getattr(connection, 'pool_released_at', None)
+        if released_at is None or now - released_at < settings.DB_CONN_HEALTH_CHECK_SECONDS:
+            continue
+        if not connection.is_usable():
+            logger.info(f'Closing unusable persistent connection to "{connection.alias}"')
+            connection.close()
+
+
+def release_connections():
+    """Отметка времени, с которого соединения текущего потока простаивают"""
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is not None:
+            connection.pool_released_at = now
+
+
+def bind_pool_executor():
+    """
+    Ограничение пула потоков текущего event loop размером DB_POOL_SIZE: sync_to_async(thread_sensitive=False)
+    выполняет view в executor'е по умолчанию, и каждый его поток держит свое соединение
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _pool_loops:
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=settings.DB_POOL_SIZE,
+                                                     thread_name_prefix='db-pool'))
+        _pool_loops.add(loop)
+
+
+class ConnectionHealthCheckMiddleware(SyncAndAsyncMiddleware):
+    def handle(self, request):
+        check_connections()
+        try:
+            return self.get_response(request)
+        finally:
+            release_connections()
+
+    async def ahandle(self, request):
+        # Соединения, которыми пользуются синхронные части асинхронной цепочки, живут в общем потоке
+        # sync_to_async(thread_sensitive=True) - проверяем их там же, не блокируя event loop
+        await sync_to_async(check_connections, thread_sensitive=True)()
+        try:
+            return await self.get_response(request)
+        finally:
+            await sync_to_async(release_connections, thread_sensitive=True)()
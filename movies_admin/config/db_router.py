@@ -0,0 +1,68 @@
+import contextvars
+import random
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from config.middleware import SyncAndAsyncMiddleware
+
+
+# Маршрутизация чтения на реплики. Запись всегда идет в основную базу (default), чтение - на случайную реплику из
+# settings.REPLICA_DATABASES, кроме случаев, когда нужно видеть только что записанные данные:
+# - внутри транзакции на основной базе;
+# - в запросах, изменяющих данные (POST и т.п.);
+# - в течение REPLICA_STICKY_SECONDS после изменяющего запроса того же клиента (read-your-writes для админки),
+#   это отмечается cookie.
+
+
+PRIMARY_PIN_COOKIE = 'db_primary_pin'
+
+_use_primary = contextvars.ContextVar('use_primary_db', default=False)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not settings.REPLICA_DATABASES or _use_primary.get():
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(settings.REPLICA_DATABASES)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.REPLICA_DATABASES}
+        return obj1._state.db in databases and obj2._state.db in databases
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaRoutingMiddleware(SyncAndAsyncMiddleware):
+    safe_methods = ('GET', 'HEAD', 'OPTIONS')
+
+    def handle(self, request):
+        is_write = request.method not in self.safe_methods
+        token = _use_primary.set(is_write or PRIMARY_PIN_COOKIE in request.COOKIES)
+        try:
+            response = self.get_response(request)
+        finally:
+            _use_primary.reset(token)
+        return self.pin_primary(request, response)
+
+    async def ahandle(self, request):
+        # contextvar копируется в потоки sync_to_async, так что выбор базы виден и синхронным view
+        is_write = request.method not in self.safe_methods
+        token = _use_primary.set(is_write or PRIMARY_PIN_COOKIE in request.COOKIES)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _use_primary.reset(token)
+        return self.pin_primary(request, response)
+
+    def pin_primary(self, request, response):
+        if request.method not in self.safe_methods and settings.REPLICA_DATABASES:
+            response.set_cookie(PRIMARY_PIN_COOKIE, '1', max_age=settings.REPLICA_STICKY_SECONDS,
+                                httponly=True, samesite='Lax')
+        return response
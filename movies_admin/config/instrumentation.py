@@ -0,0 +1,225 @@
+import bisect
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db.backends.signals import connection_created
+from django.http import JsonResponse
+
+from config.middleware import SyncAndAsyncMiddleware
+
+
+# Инструментирование запросов: для каждого запроса считаем кол-во SQL-запросов, суммарное время в базе, самый
+# медленный запрос и время сериализации, отдаем их в заголовке Server-Timing, пишем в лог медленные запросы и копим
+# гистограммы времени ответа по шаблонам URL. Обертка над выполнением SQL ставится на каждое новое соединение и
+# берет статистику текущего запроса из contextvar, поэтому учитываются и запросы из потоков пула асинхронных view.
+
+
+logger = logging.getLogger('instrumentation')
+
+SLOW_SQL_MAX_LENGTH = 1000
+
+
+@dataclass
+class RequestStats:
+    queries: int = 0
+    db_time: float = 0.0
+    slowest_sql: str = ''
+    slowest_time: float = 0.0
+    timings: Dict[str, float] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def add_query(self, sql: str, duration: float):
+        with self.lock:
+            self.queries += 1
+            self.db_time += duration
+            if duration > self.slowest_time:
+                self.slowest_time = duration
+                self.slowest_sql = sql
+
+    def add_timing(self, name: str, duration: float):
+        with self.lock:
+            self.timings[name] = self.timings.get(name, 0.0) + duration
+
+
+_current_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar('request_stats', default=None)
+
+
+def _record_query(execute, sql, params, many, context):
+    stats = _current_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.add_query(sql, time.perf_counter() - started)
+
+
+def _install_query_wrapper(sender, connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+@contextmanager
+def timing(name: str):
+    """Замер произвольного участка обработки запроса (например, сериализации) для Server-Timing"""
+    stats = _current_stats.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.add_timing(name, time.perf_counter() - started)
+
+
+class RollingHistogram:
+    """
+    Гистограмма времени ответа с фиксированными корзинами за скользящее окно: хранятся текущее и предыдущее окна,
+    при чтении они складываются, так что статистика охватывает от одного до двух последних окон.
+    """
+    buckets_ms = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, window_seconds: float):
+        self.window_seconds = window_seconds
+        self.lock = threading.Lock()
+        self.window_started = time.monotonic()
+        self.current = self._empty()
+        self.previous = self._empty()
+
+    def _empty(self):
+        return {'counts': [0] * (len(self.buckets_ms) + 1), 'count': 0, 'total_ms': 0.0, 'queries': 0, 'db_ms': 0.0}
+
+    def _rotate(self):
+        now = time.monotonic()
+        if now - self.window_started >= self.window_seconds:
+            self.previous = self.current if now - self.window_started < 2 * self.window_seconds else self._empty()
+            self.current = self._empty()
+            self.window_started = now
+
+    def add(self, duration_ms: float, queries: int, db_ms: float):
+        with self.lock:
+            self._rotate()
+            self.current['counts'][bisect.bisect_left(self.buckets_ms, duration_ms)] += 1
+            self.current['count'] += 1
+            self.current['total_ms'] += duration_ms
+            self.current['queries'] += queries
+            self.current['db_ms'] += db_ms
+
+    def _percentile(self, counts, count, percent):
+        rank = count * percent / 100
+        seen = 0
+        for bucket_index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets_ms[bucket_index] if bucket_index < len(self.buckets_ms) else None
+        return None
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            self._rotate()
+            counts = [current + previous for current, previous in zip(self.current['counts'], self.previous['counts'])]
+            count = self.current['count'] + self.previous['count']
+            total_ms = self.current['total_ms'] + self.previous['total_ms']
+            queries = self.current['queries'] + self.previous['queries']
+            db_ms = self.current['db_ms'] + self.previous['db_ms']
+        if not count:
+            return {'count': 0}
+        return {
+            'count': count,
+            'mean_ms': round(total_ms / count, 2),
+            'mean_queries': round(queries / count, 2),
+            'mean_db_ms': round(db_ms / count, 2),
+            # верхние границы корзин, в которые попадают перцентили (None - больше последней границы)
+            'p50_le_ms': self._percentile(counts, count, 50),
+            'p95_le_ms': self._percentile(counts, count, 95),
+            'p99_le_ms': self._percentile(counts, count, 99),
+            'buckets_le_ms': dict(zip([*map(str, self.buckets_ms), 'inf'], counts)),
+        }
+
+
+_histograms: Dict[str, RollingHistogram] = {}
+_histograms_lock = threading.Lock()
+
+
+def _get_histogram(key: str) -> RollingHistogram:
+    with _histograms_lock:
+        if key not in _histograms:
+            _histograms[key] = RollingHistogram(settings.INSTRUMENTATION_WINDOW_SECONDS)
+        return _histograms[key]
+
+
+class QueryInstrumentationMiddleware(SyncAndAsyncMiddleware):
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        connection_created.connect(_install_query_wrapper, dispatch_uid='instrumentation_query_wrapper')
+
+    def handle(self, request):
+        stats = RequestStats()
+        token = _current_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_stats.reset(token)
+        return self.process_stats(request, response, stats, time.perf_counter() - started)
+
+    async def ahandle(self, request):
+        # sync_to_async копирует контекст, поэтому статистику видят и запросы из потоков синхронных частей цепочки
+        stats = RequestStats()
+        token = _current_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_stats.reset(token)
+        return self.process_stats(request, response, stats, time.perf_counter() - started)
+
+    def process_stats(self, request, response, stats: RequestStats, total: float):
+        response['Server-Timing'] = self.server_timing_header(stats, total)
+
+        match = getattr(request, 'resolver_match', None)
+        pattern = f'{request.method} {match.route if match else "<unresolved>"}'
+        _get_histogram(pattern).add(total * 1000, stats.queries, stats.db_time * 1000)
+
+        if total * 1000 >= settings.INSTRUMENTATION_SLOW_REQUEST_MS:
+            logger.warning(json.dumps({
+                'event': 'slow_request',
+                'method': request.method,
+                'path': request.path,
+                'pattern': pattern,
+                'status': response.status_code,
+                'total_ms': round(total * 1000, 2),
+                'queries': stats.queries,
+                'db_ms': round(stats.db_time * 1000, 2),
+                'slowest_sql_ms': round(stats.slowest_time * 1000, 2),
+                'slowest_sql': stats.slowest_sql[:SLOW_SQL_MAX_LENGTH],
+                **{f'{name}_ms': round(duration * 1000, 2) for name, duration in stats.timings.items()},
+            }, ensure_ascii=False))
+
+        return response
+
+    @staticmethod
+    def server_timing_header(stats: RequestStats, total: float) -> str:
+        metrics = [
+            f'db;dur={stats.db_time * 1000:.2f};desc="{stats.queries} queries"',
+            f'db-slowest;dur={stats.slowest_time * 1000:.2f}',
+            *(f'{name};dur={duration * 1000:.2f}' for name, duration in stats.timings.items()),
+            f'total;dur={total * 1000:.2f}',
+        ]
+        return ', '.join(metrics)
+
+
+@staff_member_required
+def instrumentation_stats(request):
+    """Гистограммы времени ответа по шаблонам URL (только для сотрудников)"""
+    with _histograms_lock:
+        histograms = dict(_histograms)
+    return JsonResponse({pattern: histogram.snapshot() for pattern, histogram in sorted(histograms.items())})
@@ -0,0 +1,29 @@
+import asyncio
+
+
+class SyncAndAsyncMiddleware:
+    """
+    Базовый класс middleware, работающего и в синхронной, и в асинхронной цепочке (так же, как MiddlewareMixin
+    Django). Под ASGI цепочка из таких middleware остается асинхронной до асинхронного view, и Django не переключается
+    ради нее в поток (с thread_sensitive=True все такие переключения выполняются в одном общем потоке).
+    Наследники реализуют handle() для синхронной цепочки и ahandle() для асинхронной.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            # Django определяет асинхронный middleware через asyncio.iscoroutinefunction
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.ahandle(request)
+        return self.handle(request)
+
+    def handle(self, request):
+        raise NotImplementedError
+
+    async def ahandle(self, request):
+        raise NotImplementedError
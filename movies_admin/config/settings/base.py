@@ -26,6 +26,9 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'config.instrumentation.QueryInstrumentationMiddleware',
+    'config.db_pool.ConnectionHealthCheckMiddleware',
+    'config.db_router.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -66,12 +69,78 @@ DATABASES = {
         'PASSWORD': os.environ.get('DB_PASSWORD'),
         'HOST': os.environ.get('DB_HOST', '127.0.0.1'),
         'PORT': os.environ.get('DB_PORT', 5432),
+        # постоянные соединения: сколько секунд соединение переиспользуется между запросами (0 - закрывать после
+        # каждого запроса)
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 300)),
         'OPTIONS': {
             'options': '-c search_path=public,content'
         }
     }
 }
 
+# Реплики для чтения: DB_REPLICA_HOSTS - список host[:port] через пробел (остальные параметры как у основной базы)
+
+REPLICA_DATABASES = []
+for replica_number, replica_host in enumerate(os.environ.get('DB_REPLICA_HOSTS', '').split()):
+    replica_alias = f'replica_{replica_number}'
+    host, _, port = replica_host.partition(':')
+    DATABASES[replica_alias] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'PORT': port or DATABASES['default']['PORT'],
+        'TEST': {'MIRROR': 'default'},
+    }
+    REPLICA_DATABASES.append(replica_alias)
+
+DATABASE_ROUTERS = ['config.db_router.ReplicaRouter']
+
+# Сколько секунд после изменяющего запроса клиент читает из основной базы, чтобы видеть свои изменения
+REPLICA_STICKY_SECONDS = int(os.environ.get('DB_REPLICA_STICKY_SECONDS', 10))
+
+# Постоянные соединения (config/db_pool.py): кол-во потоков асинхронных view в одном ASGI-воркере (у каждого свое
+# соединение с базой) и время простоя (сек), после которого соединение проверяется перед использованием
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 4))
+DB_CONN_HEALTH_CHECK_SECONDS = float(os.environ.get('DB_CONN_HEALTH_CHECK_SECONDS', 30))
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# По умолчанию кеш в памяти процесса - только для разработки (DEBUG). В версии каталога в кеше (movies/cache.py)
+# процессы админки и API видят изменения друг друга, поэтому без DEBUG нужен общий кеш, например
+# django.core.cache.backends.memcached.PyMemcacheCache и его адрес (иначе приложение не запустится).
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('DJANGO_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('DJANGO_CACHE_LOCATION', ''),
+    }
+}
+
+# Кеш и время жизни (сек) закешированных ответов API фильмов
+MOVIES_API_CACHE_ALIAS = 'default'
+MOVIES_API_CACHE_TIMEOUT = int(os.environ.get('MOVIES_API_CACHE_TIMEOUT', 60))
+
+
+# Инструментирование запросов: порог (мс), начиная с которого запрос пишется в лог как медленный,
+# и длина окна (сек) для гистограмм времени ответа
+
+INSTRUMENTATION_SLOW_REQUEST_MS = float(os.environ.get('INSTRUMENTATION_SLOW_REQUEST_MS', 500))
+INSTRUMENTATION_WINDOW_SECONDS = float(os.environ.get('INSTRUMENTATION_WINDOW_SECONDS', 300))
+
+
+# Использовать асинхронные view для списка и карточки фильма (включается для сервиса, запущенного под ASGI)
+
+API_ASYNC_VIEWS = os.environ.get('DJANGO_API_ASYNC_VIEWS', '0') == '1'
+
+
+# Elasticsearch для поиска фильмов
+
+ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL', 'http://127.0.0.1:9200')
+ELASTICSEARCH_MOVIES_INDEX = os.environ.get('ELASTICSEARCH_MOVIES_INDEX', 'movies')
+ELASTICSEARCH_TIMEOUT = float(os.environ.get('ELASTICSEARCH_TIMEOUT', 2))
+ELASTICSEARCH_POOL_SIZE = int(os.environ.get('ELASTICSEARCH_POOL_SIZE', 10))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
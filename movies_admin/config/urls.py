@@ -2,8 +2,11 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 
+from config.instrumentation import instrumentation_stats
+
 
 urlpatterns = [
+    path('admin/instrumentation/', instrumentation_stats),
     path('admin/', admin.site.urls),
     path('api/', include('api.urls')),
 ]
@@ -1,7 +1,11 @@
+import uuid
+
 from django.contrib import admin
 from django.utils.translation import gettext_lazy as _
 
+from .facets import RATING_RANGES
 from .models import Filmwork, FilmworkGenre, Genre, FilmworkPerson, Person
+from .paginator import EstimatedCountPaginator
 
 
 class GenreInline(admin.TabularInline):
@@ -21,12 +25,7 @@ class RatingListFilter(admin.SimpleListFilter):
     title = _('rating')
     parameter_name = 'rating'
 
-    ranges = (
-        (0, 5),
-        (5.1, 7),
-        (7.1, 9),
-        (9.1, 10)
-    )
+    ranges = RATING_RANGES
 
     def lookups(self, request, model_admin):
         return [('-'.join(map(str, rating_range)),
@@ -40,8 +39,14 @@ class RatingListFilter(admin.SimpleListFilter):
                                rating__lte=rating_range[1])
 
 
+class LargeTableAdminMixin:
+    """Списки больших таблиц: оценка кол-ва записей вместо COUNT(*) и без подсчета общего кол-ва записей"""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
 @admin.register(Filmwork)
-class FilmWorkAdmin(admin.ModelAdmin):
+class FilmWorkAdmin(LargeTableAdminMixin, admin.ModelAdmin):
     list_display = ('title', 'type', 'creation_date', 'rating')
     fields = (
         'title', 'type', 'description', 'creation_date', 'certificate',
@@ -53,11 +58,19 @@ class FilmWorkAdmin(admin.ModelAdmin):
     )
 
     list_filter = ('type', RatingListFilter)
-    search_fields = ('title', 'description', 'id',)
+    # title и description ищутся по trigram-индексам (см. миграцию 0002), id - точным совпадением
+    search_fields = ('title', 'description',)
+
+    def get_search_results(self, request, queryset, search_term):
+        try:
+            film_id = uuid.UUID(search_term.strip())
+        except ValueError:
+            return super().get_search_results(request, queryset, search_term)
+        return queryset.filter(id=film_id), False
 
 
 @admin.register(Genre)
-class GenreAdmin(admin.ModelAdmin):
+class GenreAdmin(LargeTableAdminMixin, admin.ModelAdmin):
     list_display = ('name',)
     fields = ('name', 'description')
     search_fields = ('name',)
@@ -66,7 +79,7 @@ class GenreAdmin(admin.ModelAdmin):
 
 
 @admin.register(Person)
-class PersonAdmin(admin.ModelAdmin):
+class PersonAdmin(LargeTableAdminMixin, admin.ModelAdmin):
     list_display = ('full_name', 'birth_date')
     fields = ('full_name', 'birth_date')
     search_fields = ('full_name',)
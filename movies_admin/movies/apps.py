@@ -7,3 +7,5 @@ class MoviesConfig(AppConfig):
 
     def ready(self):
         import movies.signals
+        from movies.cache import check_shared_cache
+        check_shared_cache()
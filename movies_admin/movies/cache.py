@@ -0,0 +1,48 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+
+
+# Версия каталога в кеше. Все закешированные ответы API содержат версию в ключе, поэтому для инвалидации
+# достаточно увеличить версию (старые записи просто перестанут запрашиваться и вытеснятся по таймауту).
+# Версию увеличивают процессы, меняющие каталог (воркеры админки, import_catalog), а читают воркеры API - поэтому
+# кеш должен быть общим для всех процессов. С кешем в памяти процесса ETag в API никогда бы не менялся, и клиенты
+# с If-None-Match бесконечно получали бы 304 на устаревшие данные.
+CATALOG_VERSION_KEY = 'movies:catalog_version'
+
+# Бэкенды кеша, которые не видны другим процессам
+PROCESS_LOCAL_CACHE_BACKENDS = ('django.core.cache.backends.locmem.LocMemCache',)
+
+
+def get_cache():
+    return caches[settings.MOVIES_API_CACHE_ALIAS]
+
+
+def check_shared_cache():
+    """Кеш версии каталога должен быть общим для процессов; процесс-локальный допустим только при DEBUG"""
+    backend = settings.CACHES[settings.MOVIES_API_CACHE_ALIAS]['BACKEND']
+    if backend in PROCESS_LOCAL_CACHE_BACKENDS and not settings.DEBUG:
+        raise ImproperlyConfigured(f'Cache "{settings.MOVIES_API_CACHE_ALIAS}" ({backend}) is local to the process: '
+                                   f'catalog version bumps would not reach other workers. Set DJANGO_CACHE_BACKEND '
+                                   f'and DJANGO_CACHE_LOCATION to a shared cache (e.g. memcached)')
+
+
+def get_catalog_version() -> int:
+    cache = get_cache()
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # если версия вытеснена из кеша, начинаем с метки времени, чтобы не совпасть с какой-то из прошлых версий
+        version = time.time_ns()
+        if not cache.add(CATALOG_VERSION_KEY, version, timeout=None):
+            version = cache.get(CATALOG_VERSION_KEY, version)
+    return version
+
+
+def bump_catalog_version():
+    cache = get_cache()
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        cache.set(CATALOG_VERSION_KEY, time.time_ns(), timeout=None)
@@ -0,0 +1,115 @@
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from psycopg2.extras import execute_values
+
+
+# Счетчики фасетов каталога (кол-во фильмов по жанрам, типам и диапазонам рейтинга) хранятся в таблице
+# content.facet_count и поддерживаются триггерами уровня оператора на film_work и genre_film_work (миграция 0003),
+# поэтому учитываются и изменения в обход Django: COPY и upsert'ы load_data.py, import_catalog, генератор каталога.
+# Чтение фасетов - выборка нескольких десятков строк, не зависящая от размера каталога.
+# sweep_facets() пересчитывает счетчики по самим таблицам и исправляет расхождения (например, после ручных правок
+# в базе с отключенными триггерами).
+
+logger = logging.getLogger(__name__)
+
+# Диапазоны рейтинга - те же, что в фильтре админки. Ключ диапазона совпадает со значением параметра фильтра.
+# При изменении диапазонов нужна миграция, пересоздающая content.rating_bucket() (см. 0003_facet_counts).
+RATING_RANGES = (
+    (0, 5),
+    (5.1, 7),
+    (7.1, 9),
+    (9.1, 10)
+)
+
+GENRE_FACET = 'genre'
+TYPE_FACET = 'type'
+RATING_FACET = 'rating'
+
+FacetKey = Tuple[str, str]
+
+# Фактические значения счетчиков по таблицам каталога
+ACTUAL_COUNTS_SQL = """
+    SELECT 'type', type, COUNT(*) FROM content.film_work GROUP BY type
+    UNION ALL
+    SELECT 'rating', content.rating_bucket(rating), COUNT(*)
+    FROM content.film_work
+    WHERE content.rating_bucket(rating) IS NOT NULL
+    GROUP BY 2
+    UNION ALL
+    SELECT 'genre', genre_id::text, COUNT(*) FROM content.genre_film_work GROUP BY genre_id;
+"""
+
+
+def rating_range_key(rating_range) -> str:
+    return '-'.join(map(str, rating_range))
+
+
+@dataclass
+class FacetDrift:
+    facet: str
+    bucket: str
+    stored: int
+    actual: int
+
+
+def get_facets(using: str = DEFAULT_DB_ALIAS) -> Dict:
+    with connections[using].cursor() as cursor:
+        cursor.execute("""
+            SELECT g.id, g.name, fc.count
+            FROM content.facet_count as fc
+            JOIN content.genre as g ON g.id::text = fc.bucket
+            WHERE fc.facet = %s AND fc.count > 0
+            ORDER BY fc.count DESC, g.name;
+        """, [GENRE_FACET])
+        genres = [{'id': genre_id, 'name': name, 'count': count} for genre_id, name, count in cursor.fetchall()]
+
+        cursor.execute('SELECT facet, bucket, count FROM content.facet_count WHERE facet IN (%s, %s);',
+                       [TYPE_FACET, RATING_FACET])
+        counts = {(facet, bucket): count for facet, bucket, count in cursor.fetchall()}
+
+    types = [{'type': bucket, 'count': count} for (facet, bucket), count in sorted(counts.items())
+             if facet == TYPE_FACET and count > 0]
+    ratings = [{'range': rating_range_key(rating_range),
+                'count': counts.get((RATING_FACET, rating_range_key(rating_range)), 0)}
+               for rating_range in RATING_RANGES]
+    return {
+        'total': sum(item['count'] for item in types),
+        'genres': genres,
+        'types': types,
+        'ratings': ratings,
+    }
+
+
+def sweep_facets(using: str = DEFAULT_DB_ALIAS) -> List[FacetDrift]:
+    """
+    Сверка счетчиков с таблицами каталога и исправление расхождений. На время сверки таблица счетчиков
+    блокируется от записи (чтение фасетов не блокируется), поэтому изменения каталога, попавшие в сверку,
+    не будут учтены дважды: их триггеры дождутся конца сверки.
+    """
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        cursor.execute('LOCK TABLE content.facet_count IN EXCLUSIVE MODE;')
+        cursor.execute(ACTUAL_COUNTS_SQL)
+        actual: Dict[FacetKey, int] = {(facet, bucket): count for facet, bucket, count in cursor.fetchall()}
+        cursor.execute('SELECT facet, bucket, count FROM content.facet_count;')
+        stored: Dict[FacetKey, int] = {(facet, bucket): count for facet, bucket, count in cursor.fetchall()}
+
+        drifts = [FacetDrift(facet=facet, bucket=bucket, stored=stored.get((facet, bucket), 0),
+                             actual=actual.get((facet, bucket), 0))
+                  for facet, bucket in stored.keys() | actual.keys()
+                  if stored.get((facet, bucket), 0) != actual.get((facet, bucket), 0)]
+
+        fixes = [(drift.facet, drift.bucket, drift.actual) for drift in drifts]
+        if fixes:
+            execute_values(cursor, """
+                INSERT INTO content.facet_count (facet, bucket, count) VALUES %s
+                ON CONFLICT (facet, bucket) DO UPDATE SET count = EXCLUDED.count;
+            """, fixes)
+        # нулевые счетчики (удаленные жанры, опустевшие корзины) не храним
+        cursor.execute('DELETE FROM content.facet_count WHERE count = 0;')
+
+    for drift in drifts:
+        logger.warning(f'Facet {drift.facet}={drift.bucket} drifted: stored {drift.stored}, actual {drift.actual}')
+    return drifts
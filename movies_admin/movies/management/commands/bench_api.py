@@ -0,0 +1,224 @@
+import json
+import random
+import statistics
+import time
+from dataclasses import dataclass
+from itertools import accumulate
+from typing import Callable, Dict, List, Optional
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models.signals import pre_migrate
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, \
+    teardown_test_environment
+from django.utils import timezone
+
+from api.v1.pagination import encode_cursor
+from movies.models import Filmwork, FilmworkGenre, FilmworkPerson, FilmworkType, Genre, Person, PersonType
+
+
+# Регрессионный бенчмарк API и админки: создает одноразовую тестовую базу (test_<DB_NAME>) на сервере из настроек,
+# заполняет ее синтетическим каталогом, для каждого сценария замеряет кол-во SQL-запросов и перцентили времени
+# ответа (через django.test.Client, без nginx и gunicorn) и сверяет их с бюджетами. Кеш ответов API отключен.
+#
+#   $ python manage.py bench_api --films 20000 --output bench.json --compare bench_prev.json
+#
+# Бюджет запросов - это потолок: если изменение законно добавляет запрос, бюджет поднимается в том же коммите.
+
+
+GENRE_NAMES = ('Drama', 'Comedy', 'Action', 'Thriller', 'Romance', 'Crime', 'Adventure', 'Horror', 'Sci-Fi',
+               'Family', 'Fantasy', 'Mystery', 'Animation', 'Documentary', 'Biography', 'History', 'Music', 'War')
+WORDS = ('star', 'night', 'last', 'dark', 'return', 'lost', 'city', 'dream', 'war', 'love', 'secret', 'empire',
+         'shadow', 'river', 'storm', 'ghost', 'silent', 'golden', 'winter', 'road', 'fire', 'moon')
+
+BENCH_CACHE_ALIAS = 'bench_dummy'
+
+
+@dataclass
+class BenchContext:
+    film_id: str
+    middle_film_id: str
+    last_page: int
+
+
+@dataclass
+class Scenario:
+    name: str
+    url: Callable[[BenchContext], str]
+    max_queries: int
+    max_p95_ms: float
+    admin: bool = False
+
+
+SCENARIOS = (
+    Scenario('api list first page', lambda ctx: '/api/v1/movies/', max_queries=3, max_p95_ms=150),
+    Scenario('api list deep page', lambda ctx: f'/api/v1/movies/?page={ctx.last_page}', max_queries=3,
+             max_p95_ms=300),
+    Scenario('api list deep cursor', lambda ctx: f'/api/v1/movies/?cursor={encode_cursor(ctx.middle_film_id, False)}',
+             max_queries=3, max_p95_ms=150),
+    Scenario('api list sparse fields', lambda ctx: '/api/v1/movies/?fields=id,title,rating', max_queries=3,
+             max_p95_ms=80),
+    Scenario('api detail', lambda ctx: f'/api/v1/movies/{ctx.film_id}/', max_queries=1, max_p95_ms=50),
+    Scenario('api facets', lambda ctx: '/api/v1/movies/facets/', max_queries=2, max_p95_ms=30),
+    Scenario('admin changelist', lambda ctx: '/admin/movies/filmwork/', max_queries=8, max_p95_ms=500, admin=True),
+    Scenario('admin changelist search', lambda ctx: '/admin/movies/filmwork/?q=golden+river', max_queries=8,
+             max_p95_ms=500, admin=True),
+    Scenario('admin change page', lambda ctx: f'/admin/movies/filmwork/{ctx.film_id}/change/', max_queries=14,
+             max_p95_ms=500, admin=True),
+)
+
+
+def ensure_content_schema(using, **kwargs):
+    """Таблицы лежат в схеме content, которую миграции не создают (в рабочей базе ее создает schema_design)"""
+    from django.db import connections
+    with connections[using].cursor() as cursor:
+        cursor.execute('CREATE SCHEMA IF NOT EXISTS content')
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+
+class Command(BaseCommand):
+    help = 'Регрессионный бенчмарк API и админки с бюджетами на кол-во запросов и время ответа'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--films', type=int, default=20000, help='размер синтетического каталога')
+        parser.add_argument('--repeat', type=int, default=30, help='кол-во замеров каждого сценария')
+        parser.add_argument('--warmup', type=int, default=3, help='кол-во прогревочных запросов')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--keepdb', action='store_true', help='не пересоздавать тестовую базу между запусками')
+        parser.add_argument('--output', default=None, help='файл для сохранения результатов в json')
+        parser.add_argument('--compare', default=None, help='файл с результатами прошлого запуска для сравнения')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        pre_migrate.connect(ensure_content_schema, dispatch_uid='bench_api_content_schema')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            # кеш кол-ва записей (default) тоже отключен, чтобы каждый замер включал запросы подсчета
+            dummy_cache = {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+            caches = {'default': dummy_cache, BENCH_CACHE_ALIAS: dummy_cache}
+            with override_settings(CACHES=caches, MOVIES_API_CACHE_ALIAS=BENCH_CACHE_ALIAS, REPLICA_DATABASES=[]):
+                if Filmwork.objects.count() < options['films']:
+                    self.seed(options['films'], options['seed'])
+                results = self.run_scenarios(options['repeat'], options['warmup'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        report = {'films': options['films'], 'started_at': timezone.now().isoformat(), 'results': results}
+        if options['output']:
+            with open(options['output'], 'w') as fs:
+                json.dump(report, fs, indent=2)
+        if options['compare']:
+            self.compare(results, options['compare'])
+
+        failures = [result for result in results if result['violations']]
+        for result in failures:
+            self.stderr.write(f'{result["name"]}: {"; ".join(result["violations"])}')
+        if failures:
+            raise CommandError(f'{len(failures)} scenario(s) exceeded their budgets')
+        self.stdout.write(self.style.SUCCESS('All scenarios are within budgets'))
+
+    def seed(self, films: int, seed: int):
+        """Каталог с неравномерной популярностью персон и жанров, как в реальных данных"""
+        rnd = random.Random(seed)
+        self.stdout.write(f'Seeding {films} films...')
+        with transaction.atomic():
+            Filmwork.objects.all().delete()
+            Person.objects.all().delete()
+            Genre.objects.all().delete()
+            genres = Genre.objects.bulk_create([Genre(name=name) for name in GENRE_NAMES])
+            persons = Person.objects.bulk_create(
+                [Person(full_name=f'{rnd.choice(WORDS).title()} {rnd.choice(WORDS).title()}son')
+                 for _ in range(max(1, films // 2))], batch_size=5000)
+            person_weights = list(accumulate((rank + 10) ** -0.8 for rank in range(1, len(persons) + 1)))
+            genre_weights = list(accumulate(rank ** -1.0 for rank in range(1, len(genres) + 1)))
+
+            for start in range(0, films, 5000):
+                filmworks = Filmwork.objects.bulk_create([
+                    Filmwork(title=' '.join(rnd.choices(WORDS, k=rnd.randint(1, 4))).title(),
+                             description=' '.join(rnd.choices(WORDS, k=20)),
+                             rating=round(rnd.triangular(1, 10, 6.5), 1),
+                             type=FilmworkType.MOVIE if rnd.random() < 0.8 else FilmworkType.TV_SHOW)
+                    for _ in range(min(5000, films - start))])
+                person_links, genre_links = [], []
+                for filmwork in filmworks:
+                    cast_size = min(60, int(rnd.paretovariate(1.5) * 1.5)) + 2
+                    for index, person in enumerate(set(rnd.choices(persons, cum_weights=person_weights,
+                                                                   k=cast_size))):
+                        role = PersonType.DIRECTOR if index == 0 else \
+                            PersonType.WRITER if index == 1 else PersonType.ACTOR
+                        person_links.append(FilmworkPerson(film_work=filmwork, person=person, role=role))
+                    for genre in set(rnd.choices(genres, cum_weights=genre_weights, k=rnd.randint(1, 3))):
+                        genre_links.append(FilmworkGenre(film_work=filmwork, genre=genre))
+                FilmworkPerson.objects.bulk_create(person_links, batch_size=5000)
+                FilmworkGenre.objects.bulk_create(genre_links, batch_size=5000)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def run_scenarios(self, repeat: int, warmup: int) -> List[Dict]:
+        film_ids = list(Filmwork.objects.order_by('id').values_list('id', flat=True)[::max(1, repeat)])
+        context = BenchContext(film_id=str(film_ids[0]), middle_film_id=str(film_ids[len(film_ids) // 2]),
+                               last_page=max(1, -(-Filmwork.objects.count() // 50)))
+        admin_user = get_user_model().objects.filter(username='bench_admin').first() or \
+            get_user_model().objects.create_superuser('bench_admin', 'bench@example.com', 'bench')
+
+        results = []
+        for scenario in SCENARIOS:
+            client = Client()
+            if scenario.admin:
+                client.force_login(admin_user)
+            url = scenario.url(context)
+
+            for _ in range(warmup):
+                client.get(url)
+
+            latencies, query_counts = [], []
+            for _ in range(repeat):
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    response = client.get(url)
+                    latencies.append((time.perf_counter() - started) * 1000)
+                if response.status_code != 200:
+                    raise CommandError(f'{scenario.name}: {url} returned {response.status_code}')
+                query_counts.append(len(captured.captured_queries))
+
+            results.append(self.check_budgets(scenario, url, sorted(latencies), max(query_counts)))
+            self.stdout.write(json.dumps(results[-1]))
+
+        return results
+
+    @staticmethod
+    def check_budgets(scenario: Scenario, url: str, latencies: List[float], queries: int) -> Dict:
+        p95 = percentile(latencies, 95)
+        violations = []
+        if queries > scenario.max_queries:
+            violations.append(f'{queries} queries > budget {scenario.max_queries}')
+        if p95 > scenario.max_p95_ms:
+            violations.append(f'p95 {p95:.1f}ms > budget {scenario.max_p95_ms}ms')
+        return {
+            'name': scenario.name,
+            'url': url,
+            'queries': queries,
+            'p50_ms': round(statistics.median(latencies), 2),
+            'p95_ms': round(p95, 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'budget': {'queries': scenario.max_queries, 'p95_ms': scenario.max_p95_ms},
+            'violations': violations,
+        }
+
+    def compare(self, results: List[Dict], path: str):
+        with open(path) as fs:
+            previous = {result['name']: result for result in json.load(fs)['results']}
+        for result in results:
+            before: Optional[Dict] = previous.get(result['name'])
+            if not before:
+                continue
+            self.stdout.write(f'{result["name"]}: queries {before["queries"]} -> {result["queries"]}, '
+                              f'p95 {before["p95_ms"]} -> {result["p95_ms"]}ms '
+                              f'({(result["p95_ms"] / before["p95_ms"] - 1) * 100 if before["p95_ms"] else 0:+.0f}%)')
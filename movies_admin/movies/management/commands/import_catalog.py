@@ -0,0 +1,195 @@
+import csv
+import itertools
+import json
+import uuid
+from datetime import date
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from psycopg2.extras import execute_values
+
+from movies.cache import bump_catalog_version
+from movies.models import FilmworkType, Genre, Person, PersonType
+
+
+# Массовый импорт каталога партнера в обход админки: данные читаются потоково и пишутся пачками по chunk_size фильмов
+# многострочными INSERT ... ON CONFLICT. Сигналы не используются - updated_at каждого затронутого фильма выставляется
+# один раз при его записи, этого достаточно, чтобы ETL подхватил изменения.
+#
+# Формат NDJSON - по фильму на строку:
+#   {"id": "...", "title": "...", "description": "...", "creation_date": "2020-01-31", "rating": 7.5, "type": "movie",
+#    "genres": ["Drama"], "persons": [{"full_name": "...", "birth_date": "1970-01-01", "role": "actor"}]}
+# Формат CSV - колонки id, title, description, creation_date, rating, type, genres, actors, directors, writers, где
+# жанры и персоны перечисляются через "|". id необязателен: фильм с уже существующим id обновляется, без id - создается.
+
+PersonKey = Tuple[str, Optional[date]]
+
+LIST_SEPARATOR = '|'
+
+
+def read_ndjson(file) -> Iterator[Dict]:
+    for line_number, line in enumerate(file, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            film = json.loads(line)
+        except json.JSONDecodeError as err:
+            raise ValueError(f'line {line_number}: {err}')
+        if not isinstance(film, dict):
+            raise ValueError(f'line {line_number}: expected an object')
+        yield film
+
+
+def read_csv(file) -> Iterator[Dict]:
+    for row in csv.DictReader(file):
+        persons = []
+        for role in PersonType.values:
+            names = row.pop(f'{role}s', '') or ''
+            persons.extend({'full_name': name, 'role': role} for name in names.split(LIST_SEPARATOR) if name.strip())
+        genres = row.pop('genres', '') or ''
+        yield {**row,
+               'genres': [name for name in genres.split(LIST_SEPARATOR) if name.strip()],
+               'persons': persons}
+
+
+def chunked(items: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = 'Потоковый импорт фильмов, персон, жанров и их связей из NDJSON/CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='путь к файлу с каталогом')
+        parser.add_argument('--format', choices=('ndjson', 'csv'), default=None,
+                            help='формат файла (по умолчанию определяется по расширению)')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='кол-во фильмов в одной пачке')
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or ('csv' if options['path'].endswith('.csv') else 'ndjson')
+        self.genre_index: Dict[str, uuid.UUID] = {}
+        self.person_index: Dict[PersonKey, uuid.UUID] = {}
+        self.load_genre_index()
+
+        films_count = 0
+        try:
+            with open(options['path'], encoding='utf-8', newline='') as file:
+                reader = read_csv(file) if file_format == 'csv' else read_ndjson(file)
+                chunks = chunked(reader, options['chunk_size'])
+                for chunk_number in itertools.count(1):
+                    # файл разбирается при чтении пачки, поэтому ошибки формата ловятся вместе с ошибками данных
+                    try:
+                        chunk = next(chunks, None)
+                        if not chunk:
+                            break
+                        with transaction.atomic():
+                            self.import_chunk(chunk)
+                    except (ValueError, KeyError, csv.Error) as err:
+                        raise CommandError(f'Invalid data in chunk {chunk_number}: {err}')
+                    films_count += len(chunk)
+                    self.stdout.write(f'Imported {films_count} films')
+        finally:
+            # пачки, записанные до ошибки, уже закоммичены, и кеш API должен их увидеть
+            if films_count:
+                bump_catalog_version()
+
+        self.stdout.write(self.style.SUCCESS(f'Done: {films_count} films, {len(self.person_index)} persons seen'))
+
+    def load_genre_index(self):
+        # жанров немного, поэтому загружаем их все сразу
+        for genre_id, name in Genre.objects.values_list('id', 'name'):
+            self.genre_index.setdefault(name, genre_id)
+
+    def import_chunk(self, films: List[Dict]):
+        now = timezone.now()
+        # фильмы с одинаковым id в одной пачке схлопываем (ON CONFLICT DO UPDATE не может обновить строку дважды)
+        film_rows: Dict[uuid.UUID, Tuple] = {}
+        genre_links, person_links = [], []
+        genre_names = {name.strip() for film in films for name in film.get('genres', ())}
+        person_keys = {self.person_key(person) for film in films for person in film.get('persons', ())}
+        self.ensure_genres(genre_names, now)
+        self.ensure_persons(person_keys, now)
+
+        for film in films:
+            film_id = uuid.UUID(film['id']) if film.get('id') else uuid.uuid4()
+            film_type = film.get('type') or FilmworkType.MOVIE
+            if film_type not in FilmworkType.values:
+                raise ValueError(f'unknown type {film_type}')
+            film_rows[film_id] = (film_id, film['title'], film.get('description') or None,
+                                 film.get('creation_date') or None, film.get('certificate') or None,
+                                 film.get('file_path') or None,
+                                 float(film['rating']) if film.get('rating') not in (None, '') else None,
+                                 film_type, now, now)
+            for name in film.get('genres', ()):
+                genre_links.append((uuid.uuid4(), film_id, self.genre_index[name.strip()], now))
+            for person in film.get('persons', ()):
+                role = person.get('role') or PersonType.ACTOR
+                if role not in PersonType.values:
+                    raise ValueError(f'unknown role {role}')
+                person_links.append((uuid.uuid4(), film_id, self.person_index[self.person_key(person)], role, now))
+
+        with connection.cursor() as cursor:
+            raw_cursor = cursor.cursor
+            execute_values(raw_cursor, """
+                INSERT INTO content.film_work
+                    (id, title, description, creation_date, certificate, file_path, rating, type,
+                     created_at, updated_at)
+                VALUES %s
+                ON CONFLICT (id) DO UPDATE SET
+                    title = EXCLUDED.title,
+                    description = EXCLUDED.description,
+                    creation_date = EXCLUDED.creation_date,
+                    certificate = EXCLUDED.certificate,
+                    file_path = EXCLUDED.file_path,
+                    rating = EXCLUDED.rating,
+                    type = EXCLUDED.type,
+                    updated_at = EXCLUDED.updated_at
+            """, list(film_rows.values()), page_size=len(film_rows))
+            if genre_links:
+                execute_values(raw_cursor, """
+                    INSERT INTO content.genre_film_work (id, film_work_id, genre_id, created_at)
+                    VALUES %s
+                    ON CONFLICT (film_work_id, genre_id) DO NOTHING
+                """, genre_links, page_size=1000)
+            if person_links:
+                execute_values(raw_cursor, """
+                    INSERT INTO content.person_film_work (id, film_work_id, person_id, role, created_at)
+                    VALUES %s
+                    ON CONFLICT (film_work_id, person_id, role) DO NOTHING
+                """, person_links, page_size=1000)
+
+    def ensure_genres(self, names, now):
+        new_genres = [Genre(id=uuid.uuid4(), name=name, created_at=now, updated_at=now)
+                      for name in names if name and name not in self.genre_index]
+        Genre.objects.bulk_create(new_genres)
+        self.genre_index.update((genre.name, genre.id) for genre in new_genres)
+
+    def ensure_persons(self, keys, now):
+        """Найти персон в индексе, затем в базе (по имени и дате рождения), недостающих создать"""
+        missing = {key for key in keys if key not in self.person_index}
+        if not missing:
+            return
+        existing = Person.objects.filter(full_name__in={name for name, _ in missing}) \
+            .values_list('full_name', 'birth_date', 'id')
+        for full_name, birth_date, person_id in existing:
+            key = (full_name, birth_date)
+            if key in missing:
+                self.person_index.setdefault(key, person_id)
+
+        new_persons = [Person(id=uuid.uuid4(), full_name=name, birth_date=birth_date, created_at=now, updated_at=now)
+                       for name, birth_date in missing if (name, birth_date) not in self.person_index]
+        Person.objects.bulk_create(new_persons, batch_size=1000)
+        self.person_index.update(((person.full_name, person.birth_date), person.id) for person in new_persons)
+
+    @staticmethod
+    def person_key(person: Dict) -> PersonKey:
+        birth_date = person.get('birth_date')
+        return person['full_name'].strip(), date.fromisoformat(birth_date) if birth_date else None
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from movies.facets import sweep_facets
+
+
+class Command(BaseCommand):
+    help = 'Сверка счетчиков фасетов с каталогом и исправление расхождений (запускать периодически, например cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help='алиас базы, в которой сверяются счетчики')
+
+    def handle(self, *args, **options):
+        drifts = sweep_facets(using=options['database'])
+        for drift in drifts:
+            self.stdout.write(f'{drift.facet}={drift.bucket}: {drift.stored} -> {drift.actual}')
+        self.stdout.write(self.style.SUCCESS(f'Facets swept, {len(drifts)} counter(s) fixed'))
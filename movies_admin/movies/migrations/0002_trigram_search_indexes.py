@@ -0,0 +1,36 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+# Поиск в админке (search_fields) и автодополнение в инлайнах строятся на lookup'е icontains, который в Postgres
+# превращается в UPPER("field"::text) LIKE UPPER('%term%'). B-tree индексы такой запрос использовать не могут,
+# поэтому строим GIN-индексы pg_trgm ровно по этому выражению.
+# Индексы строятся с CONCURRENTLY, чтобы не блокировать запись в таблицы каталога на время построения. Такой
+# CREATE INDEX нельзя выполнить в транзакции, поэтому миграция неатомарная; если построение прервется, останется
+# невалидный индекс, который нужно удалить (DROP INDEX) перед повторным запуском миграции.
+TRIGRAM_INDEXES = (
+    ('film_work_title_trgm_idx', 'content.film_work', 'title'),
+    ('film_work_description_trgm_idx', 'content.film_work', 'description'),
+    ('person_full_name_trgm_idx', 'content.person', 'full_name'),
+    ('genre_name_trgm_idx', 'content.genre', 'name'),
+)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('movies', '0001_initial'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        *(
+            migrations.RunSQL(
+                sql=f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} '
+                    f'ON {table} USING gin (UPPER({column}::text) gin_trgm_ops);',
+                reverse_sql=f'DROP INDEX CONCURRENTLY IF EXISTS content.{index_name};',
+            )
+            for index_name, table, column in TRIGRAM_INDEXES
+        ),
+    ]
@@ -0,0 +1,150 @@
+from django.db import migrations
+
+
+# Счетчики фасетов (см. movies/facets.py). Триггеры уровня оператора получают все измененные оператором строки в
+# transition-таблицах и обновляют каждый затронутый счетчик один раз, поэтому массовая загрузка (COPY, многострочный
+# INSERT) стоит одного агрегирующего запроса. UPDATE фильма, не меняющий тип и рейтинг (например, обновление
+# updated_at при изменении связей), дает нулевые приращения и счетчики не трогает.
+# Популярные счетчики (тип movie, крупные жанры) затрагивает почти каждая транзакция, поэтому строки счетчиков
+# блокируются в одном порядке (ORDER BY facet, bucket): иначе параллельные транзакции, обновляющие одни и те же
+# счетчики в разном порядке, взаимно блокируются (deadlock).
+# Transition-таблицы нельзя объявить у триггера на несколько событий, поэтому триггеров по одному на событие.
+
+RATING_RANGES = (
+    (0, 5),
+    (5.1, 7),
+    (7.1, 9),
+    (9.1, 10)
+)
+
+RATING_BUCKET_SQL = """
+CREATE OR REPLACE FUNCTION content.rating_bucket(rating double precision) RETURNS text
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT CASE
+        {cases}
+    END
+$$;
+""".format(cases='\n        '.join(f"WHEN rating >= {low} AND rating <= {high} THEN '{low}-{high}'"
+                                   for low, high in RATING_RANGES))
+
+# Фасеты таблиц: пары (имя фасета, выражение для корзины) по строке таблицы
+TABLE_FACETS = {
+    'film_work': (("'type'", 'type'), ("'rating'", 'content.rating_bucket(rating)')),
+    'genre_film_work': (("'genre'", 'genre_id::text'),),
+}
+
+
+def changes_sql(table: str, rows: str, delta: int) -> str:
+    return ' UNION ALL '.join(f'SELECT {facet}, {bucket}, {delta} FROM {rows}'
+                              for facet, bucket in TABLE_FACETS[table])
+
+
+def upsert_sql(changes: str) -> str:
+    return f"""
+        INSERT INTO content.facet_count AS fc (facet, bucket, count)
+        SELECT facet, bucket, SUM(delta)
+        FROM ({changes}) as changes(facet, bucket, delta)
+        WHERE bucket IS NOT NULL
+        GROUP BY facet, bucket
+        HAVING SUM(delta) <> 0
+        ORDER BY facet, bucket
+        ON CONFLICT (facet, bucket) DO UPDATE SET count = fc.count + EXCLUDED.count;
+    """
+
+
+# Запросы plpgsql планируются при первом выполнении, поэтому ветки, ссылающиеся на отсутствующую у этого
+# события transition-таблицу, ошибки не дают
+def facets_function_sql(table: str) -> str:
+    return f"""
+CREATE OR REPLACE FUNCTION content.{table}_facets() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {upsert_sql(changes_sql(table, 'new_rows', 1))}
+    ELSIF TG_OP = 'DELETE' THEN
+        {upsert_sql(changes_sql(table, 'old_rows', -1))}
+    ELSE
+        {upsert_sql(changes_sql(table, 'new_rows', 1) + ' UNION ALL ' + changes_sql(table, 'old_rows', -1))}
+    END IF;
+    RETURN NULL;
+END
+$$;
+"""
+
+
+FACET_COUNTS_SQL = """
+CREATE TABLE IF NOT EXISTS content.facet_count (
+    facet text NOT NULL,
+    bucket text NOT NULL,
+    count bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (facet, bucket)
+);
+
+CREATE OR REPLACE FUNCTION content.truncate_facets() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    DELETE FROM content.facet_count WHERE facet = ANY(TG_ARGV);
+    RETURN NULL;
+END
+$$;
+""" + ''.join(facets_function_sql(table) for table in TABLE_FACETS)
+
+
+TRANSITION_TABLES = {
+    'INSERT': 'NEW TABLE AS new_rows',
+    'UPDATE': 'OLD TABLE AS old_rows NEW TABLE AS new_rows',
+    'DELETE': 'OLD TABLE AS old_rows',
+}
+
+CREATE_TRIGGERS_SQL = ''.join(
+    f"""
+    CREATE TRIGGER {table}_facets_{event.lower()} AFTER {event} ON content.{table}
+    REFERENCING {transition_tables} FOR EACH STATEMENT EXECUTE FUNCTION content.{table}_facets();
+    """
+    for table in TABLE_FACETS for event, transition_tables in TRANSITION_TABLES.items()
+) + """
+    CREATE TRIGGER film_work_facets_truncate AFTER TRUNCATE ON content.film_work
+    FOR EACH STATEMENT EXECUTE FUNCTION content.truncate_facets('type', 'rating');
+    CREATE TRIGGER genre_film_work_facets_truncate AFTER TRUNCATE ON content.genre_film_work
+    FOR EACH STATEMENT EXECUTE FUNCTION content.truncate_facets('genre');
+"""
+
+DROP_TRIGGERS_SQL = ''.join(
+    f'DROP TRIGGER IF EXISTS {table}_facets_{event.lower()} ON content.{table};\n'
+    for table in TABLE_FACETS for event in (*TRANSITION_TABLES, 'TRUNCATE')
+)
+
+# Начальное заполнение по текущему содержимому каталога (то же, что делает movies.facets.sweep_facets)
+FILL_FACET_COUNTS_SQL = """
+INSERT INTO content.facet_count (facet, bucket, count)
+    SELECT 'type', type, COUNT(*) FROM content.film_work GROUP BY type
+    UNION ALL
+    SELECT 'rating', content.rating_bucket(rating), COUNT(*)
+    FROM content.film_work
+    WHERE content.rating_bucket(rating) IS NOT NULL
+    GROUP BY 2
+    UNION ALL
+    SELECT 'genre', genre_id::text, COUNT(*) FROM content.genre_film_work GROUP BY genre_id
+ON CONFLICT (facet, bucket) DO UPDATE SET count = EXCLUDED.count;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0002_trigram_search_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=RATING_BUCKET_SQL + FACET_COUNTS_SQL,
+            reverse_sql="""
+                DROP FUNCTION IF EXISTS content.truncate_facets();
+                DROP FUNCTION IF EXISTS content.genre_film_work_facets();
+                DROP FUNCTION IF EXISTS content.film_work_facets();
+                DROP TABLE IF EXISTS content.facet_count;
+                DROP FUNCTION IF EXISTS content.rating_bucket(double precision);
+            """,
+        ),
+        migrations.RunSQL(sql=CREATE_TRIGGERS_SQL + FILL_FACET_COUNTS_SQL, reverse_sql=DROP_TRIGGERS_SQL),
+    ]
@@ -0,0 +1,201 @@
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+# Полнотекстовый поиск в Postgres на случай недоступности Elasticsearch. search_vector фильма собирается из названия
+# (вес A), имен персон (B), описания (C) и названий жанров (D). Как и анализатор ru_en индекса movies, текст
+# разбирается и русской, и английской конфигурацией.
+#
+# Вектор поддерживается триггерами:
+# - BEFORE INSERT / UPDATE OF title, description на film_work - вектор строки (Django при сохранении фильма всегда
+#   перечисляет эти колонки, поэтому перезаписанный им NULL сразу заменяется вектором);
+# - триггеры уровня оператора на связях и на переименование персон и жанров - пересчет затронутых фильмов одним
+#   UPDATE на оператор (refresh_film_work_search_vectors), пересчеты одного фильма выполняются по очереди.
+# Пересчет не трогает updated_at: ETL об изменениях связей узнает и так, а сам вектор в индекс не выгружается.
+
+SEARCH_VECTOR_SQL = """
+CREATE OR REPLACE FUNCTION content.build_search_vector(title text, description text, persons text, genres text)
+RETURNS tsvector
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT
+        setweight(to_tsvector('russian', coalesce(title, '')) || to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('russian', coalesce(persons, '')) ||
+                  to_tsvector('english', coalesce(persons, '')), 'B') ||
+        setweight(to_tsvector('russian', coalesce(description, '')) ||
+                  to_tsvector('english', coalesce(description, '')), 'C') ||
+        setweight(to_tsvector('russian', coalesce(genres, '')) || to_tsvector('english', coalesce(genres, '')), 'D')
+$$;
+
+CREATE OR REPLACE FUNCTION content.refresh_film_work_search_vectors(film_ids uuid[]) RETURNS void
+LANGUAGE plpgsql AS $$
+BEGIN
+    -- Вектор собирается из нескольких таблиц, и транзакции, параллельно меняющие разные связи одного фильма,
+    -- иначе перезаписали бы его каждая по своему снимку без изменений другой. Поэтому сначала блокируются строки
+    -- фильмов (в порядке id, чтобы не было взаимных блокировок), а пересчет выполняется следующим запросом: в
+    -- READ COMMITTED у него свой снимок, в котором уже видны связи транзакции, державшей блокировку
+    PERFORM 1 FROM content.film_work WHERE id = ANY(film_ids) ORDER BY id FOR UPDATE;
+
+    WITH ids AS (
+        SELECT DISTINCT id FROM unnest(film_ids) as id
+    ), persons AS (
+        SELECT pfw.film_work_id as id, string_agg(p.full_name, ' ') as names
+        FROM content.person_film_work as pfw
+        JOIN ids ON ids.id = pfw.film_work_id
+        JOIN content.person as p ON p.id = pfw.person_id
+        GROUP BY pfw.film_work_id
+    ), genres AS (
+        SELECT gfw.film_work_id as id, string_agg(g.name, ' ') as names
+        FROM content.genre_film_work as gfw
+        JOIN ids ON ids.id = gfw.film_work_id
+        JOIN content.genre as g ON g.id = gfw.genre_id
+        GROUP BY gfw.film_work_id
+    )
+    UPDATE content.film_work as fw
+    SET search_vector = content.build_search_vector(fw.title, fw.description, persons.names, genres.names)
+    FROM ids
+    LEFT JOIN persons ON persons.id = ids.id
+    LEFT JOIN genres ON genres.id = ids.id
+    WHERE fw.id = ids.id;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION content.film_work_search_vector() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.search_vector := content.build_search_vector(
+        NEW.title,
+        NEW.description,
+        (SELECT string_agg(p.full_name, ' ')
+         FROM content.person_film_work as pfw
+         JOIN content.person as p ON p.id = pfw.person_id
+         WHERE pfw.film_work_id = NEW.id),
+        (SELECT string_agg(g.name, ' ')
+         FROM content.genre_film_work as gfw
+         JOIN content.genre as g ON g.id = gfw.genre_id
+         WHERE gfw.film_work_id = NEW.id)
+    );
+    RETURN NEW;
+END
+$$;
+
+-- Запросы plpgsql планируются при первом выполнении, поэтому ветки, ссылающиеся на отсутствующую у этого
+-- события transition-таблицу, ошибки не дают
+CREATE OR REPLACE FUNCTION content.film_work_link_search_vectors() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM content.refresh_film_work_search_vectors(ARRAY(SELECT film_work_id FROM new_rows));
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM content.refresh_film_work_search_vectors(ARRAY(SELECT film_work_id FROM old_rows));
+    ELSE
+        PERFORM content.refresh_film_work_search_vectors(ARRAY(
+            SELECT film_work_id FROM new_rows UNION SELECT film_work_id FROM old_rows
+        ));
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION content.person_search_vectors() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM content.refresh_film_work_search_vectors(ARRAY(
+        SELECT pfw.film_work_id
+        FROM new_rows
+        JOIN old_rows ON old_rows.id = new_rows.id
+        JOIN content.person_film_work as pfw ON pfw.person_id = new_rows.id
+        WHERE new_rows.full_name IS DISTINCT FROM old_rows.full_name
+    ));
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION content.genre_search_vectors() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM content.refresh_film_work_search_vectors(ARRAY(
+        SELECT gfw.film_work_id
+        FROM new_rows
+        JOIN old_rows ON old_rows.id = new_rows.id
+        JOIN content.genre_film_work as gfw ON gfw.genre_id = new_rows.id
+        WHERE new_rows.name IS DISTINCT FROM old_rows.name
+    ));
+    RETURN NULL;
+END
+$$;
+"""
+
+LINK_TABLES = ('person_film_work', 'genre_film_work')
+
+TRANSITION_TABLES = {
+    'INSERT': 'NEW TABLE AS new_rows',
+    'UPDATE': 'OLD TABLE AS old_rows NEW TABLE AS new_rows',
+    'DELETE': 'OLD TABLE AS old_rows',
+}
+
+CREATE_TRIGGERS_SQL = """
+CREATE TRIGGER film_work_search_vector BEFORE INSERT OR UPDATE OF title, description ON content.film_work
+FOR EACH ROW EXECUTE FUNCTION content.film_work_search_vector();
+
+CREATE TRIGGER person_search_vectors AFTER UPDATE ON content.person
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION content.person_search_vectors();
+
+CREATE TRIGGER genre_search_vectors AFTER UPDATE ON content.genre
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION content.genre_search_vectors();
+""" + ''.join(
+    f"""
+CREATE TRIGGER {table}_search_vectors_{event.lower()} AFTER {event} ON content.{table}
+REFERENCING {transition_tables} FOR EACH STATEMENT EXECUTE FUNCTION content.film_work_link_search_vectors();
+"""
+    for table in LINK_TABLES for event, transition_tables in TRANSITION_TABLES.items()
+)
+
+DROP_TRIGGERS_SQL = """
+DROP TRIGGER IF EXISTS film_work_search_vector ON content.film_work;
+DROP TRIGGER IF EXISTS person_search_vectors ON content.person;
+DROP TRIGGER IF EXISTS genre_search_vectors ON content.genre;
+""" + ''.join(
+    f'DROP TRIGGER IF EXISTS {table}_search_vectors_{event.lower()} ON content.{table};\n'
+    for table in LINK_TABLES for event in TRANSITION_TABLES
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0003_facet_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filmwork',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            sql=SEARCH_VECTOR_SQL,
+            reverse_sql="""
+                DROP FUNCTION IF EXISTS content.genre_search_vectors();
+                DROP FUNCTION IF EXISTS content.person_search_vectors();
+                DROP FUNCTION IF EXISTS content.film_work_link_search_vectors();
+                DROP FUNCTION IF EXISTS content.film_work_search_vector();
+                DROP FUNCTION IF EXISTS content.refresh_film_work_search_vectors(uuid[]);
+                DROP FUNCTION IF EXISTS content.build_search_vector(text, text, text, text);
+            """,
+        ),
+        migrations.RunSQL(
+            sql=CREATE_TRIGGERS_SQL + """
+                SELECT content.refresh_film_work_search_vectors(ARRAY(SELECT id FROM content.film_work));
+            """,
+            reverse_sql=DROP_TRIGGERS_SQL,
+        ),
+        # индекс строится после заполнения: так быстрее, чем обновлять его при заполнении
+        migrations.AddIndex(
+            model_name='filmwork',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'],
+                                                           name='film_work_search_vector_idx'),
+        ),
+    ]
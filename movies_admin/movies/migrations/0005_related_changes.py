@@ -0,0 +1,84 @@
+from django.db import migrations
+
+
+# Журнал персон и жанров, которые ETL не найдет по текущим связям фильмов: удаленные персоны и жанры, а также
+# персоны и жанры, у которых удалили или перевесили связь с фильмом. Фильм при этом ETL переиндексирует (его
+# updated_at обновляется), но в его связях убранной персоны уже нет, и ее документ в индексе persons остался бы
+# со старым списком фильмов. ETL читает журнал по changed_at со своей контрольной точкой, обработанные записи
+# удаляет reconcile.py --apply.
+# Записи добавляют триггеры уровня оператора, по одной на затронутый оператором id.
+
+# Таблицы журнала: (тип записи, колонка с id персоны или жанра, события)
+TABLE_CHANGES = {
+    'person_film_work': ('person', 'person_id', ('UPDATE', 'DELETE')),
+    'genre_film_work': ('genre', 'genre_id', ('UPDATE', 'DELETE')),
+    'person': ('person', 'id', ('DELETE',)),
+    'genre': ('genre', 'id', ('DELETE',)),
+}
+
+TRANSITION_TABLES = {
+    'UPDATE': 'OLD TABLE AS old_rows NEW TABLE AS new_rows',
+    'DELETE': 'OLD TABLE AS old_rows',
+}
+
+
+# Запросы plpgsql планируются при первом выполнении, поэтому ветка UPDATE для триггера на DELETE ошибки не дает
+def changes_function_sql(table: str) -> str:
+    item_type, column, _ = TABLE_CHANGES[table]
+    return f"""
+CREATE OR REPLACE FUNCTION content.{table}_related_changes() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO content.related_change (item_type, item_id)
+        SELECT DISTINCT '{item_type}', {column} FROM old_rows;
+    ELSE
+        INSERT INTO content.related_change (item_type, item_id)
+        SELECT '{item_type}', {column} FROM old_rows
+        EXCEPT
+        SELECT '{item_type}', {column} FROM new_rows;
+    END IF;
+    RETURN NULL;
+END
+$$;
+"""
+
+
+RELATED_CHANGES_SQL = """
+CREATE TABLE IF NOT EXISTS content.related_change (
+    id bigserial PRIMARY KEY,
+    item_type text NOT NULL,
+    item_id uuid NOT NULL,
+    changed_at timestamp with time zone NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS related_change_changed_at_idx ON content.related_change (changed_at);
+""" + ''.join(changes_function_sql(table) for table in TABLE_CHANGES)
+
+CREATE_TRIGGERS_SQL = ''.join(
+    f"""
+    CREATE TRIGGER {table}_related_changes_{event.lower()} AFTER {event} ON content.{table}
+    REFERENCING {TRANSITION_TABLES[event]} FOR EACH STATEMENT EXECUTE FUNCTION content.{table}_related_changes();
+    """
+    for table, (_, _, events) in TABLE_CHANGES.items() for event in events
+)
+
+DROP_TRIGGERS_SQL = ''.join(
+    f'DROP TRIGGER IF EXISTS {table}_related_changes_{event.lower()} ON content.{table};\n'
+    for table, (_, _, events) in TABLE_CHANGES.items() for event in events
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0004_filmwork_search_vector'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=RELATED_CHANGES_SQL,
+            reverse_sql=''.join(f'DROP FUNCTION IF EXISTS content.{table}_related_changes();\n'
+                                for table in TABLE_CHANGES) + 'DROP TABLE IF EXISTS content.related_change;',
+        ),
+        migrations.RunSQL(sql=CREATE_TRIGGERS_SQL, reverse_sql=DROP_TRIGGERS_SQL),
+    ]
@@ -1,9 +1,15 @@
 import uuid
 
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorField
 from django.db import models
+from django.db.models.functions import Cast
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from .touches import touch_films
+
 
 # Добавлям классы для текстового и файлового полей, которые пустые значения сохраняют в базу данных как NULL.
 # Делаем так потому, что в базе, которую мы унаследовали, используется такое соглашение (не пустые строки, а NULL).
@@ -24,10 +30,20 @@ class FileNullField(FieldWithNullIfEmptyMixin, models.FileField):
     """FileField that stores NULL when empty"""
 
 
+class TimeStampedQuerySet(models.QuerySet):
+    """QuerySet.update() не вызывает save() и сам auto_now поля не обновляет - делаем это явно,
+    чтобы массовые правки тоже попадали в ETL"""
+    def update(self, **kwargs):
+        kwargs.setdefault('updated_at', timezone.now())
+        return super().update(**kwargs)
+
+
 class TimeStampedMixin(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = TimeStampedQuerySet.as_manager()
+
     class Meta:
         abstract = True
 
@@ -71,6 +87,43 @@ class PersonType(models.TextChoices):
     WRITER = 'writer', _('writer')
 
 
+class FilmworkLinkQuerySet(models.QuerySet):
+    """QuerySet для связей фильмов с персонами и жанрами. Массовые операции не посылают post_save/pre_delete,
+    поэтому затронутые фильмы отмечаются как измененные здесь (через тот же накопитель, что и сигналы).
+    Используется в том числе менеджерами m2m (filmwork.persons.add()/remove())."""
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        touch_films((obj.film_work_id for obj in objs), using=self.db)
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        film_ids = {obj.film_work_id for obj in objs}
+        if 'film_work' in fields or 'film_work_id' in fields:
+            # связь могли перенести на другой фильм - прежний фильм тоже изменился
+            film_ids.update(self.model.objects.using(self.db).filter(pk__in=[obj.pk for obj in objs])
+                            .values_list('film_work_id', flat=True))
+        rows = super().bulk_update(objs, fields, *args, **kwargs)
+        touch_films(film_ids, using=self.db)
+        return rows
+
+    def update(self, **kwargs):
+        film_ids = set(self.values_list('film_work_id', flat=True).distinct())
+        new_film = kwargs.get('film_work_id', kwargs.get('film_work'))
+        if new_film:
+            film_ids.add(getattr(new_film, 'pk', new_film))
+        rows = super().update(**kwargs)
+        touch_films(film_ids, using=self.db)
+        return rows
+
+    def delete(self):
+        film_ids = set(self.values_list('film_work_id', flat=True).distinct())
+        result = super().delete()
+        touch_films(film_ids, using=self.db)
+        return result
+
+
 class FilmworkPerson(models.Model):
     """Модель для связи персон и кинопроизведений"""
     id = models.UUIDField(_('ID'), primary_key=True, default=uuid.uuid4, editable=False)
@@ -79,6 +132,8 @@ class FilmworkPerson(models.Model):
     role = models.CharField(_('role'), max_length=20, choices=PersonType.choices, default=PersonType.ACTOR)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = FilmworkLinkQuerySet.as_manager()
+
     class Meta:
         constraints = (
             models.UniqueConstraint(fields=('film_work', 'person', 'role'), name='person_film_work_idx'),
@@ -99,6 +154,8 @@ class FilmworkGenre(models.Model):
     genre = models.ForeignKey('Genre', on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = FilmworkLinkQuerySet.as_manager()
+
     class Meta:
         constraints = (
             models.UniqueConstraint(fields=('film_work', 'genre'), name='genre_film_work_idx'),
@@ -109,6 +166,22 @@ class FilmworkGenre(models.Model):
         return f'{self.film_work} - {self.genre}'
 
 
+class FilmworkQuerySet(TimeStampedQuerySet):
+    def search(self, query: str):
+        """
+        Полнотекстовый поиск по search_vector (GIN-индекс), отсортированный по релевантности (поле search_rank).
+        Запрос разбирается русской и английской конфигурацией (как и вектор) в синтаксисе websearch: "фраза",
+        -исключение, or
+        """
+        search_query = SearchQuery(query, config='russian', search_type='websearch') | \
+            SearchQuery(query, config='english', search_type='websearch')
+        # ts_rank возвращает real: приводим к double, чтобы значение точно совпадало с переданным обратно в запрос
+        # (например, в курсоре следующей страницы)
+        return self.filter(search_vector=search_query) \
+            .annotate(search_rank=Cast(SearchRank(models.F('search_vector'), search_query), models.FloatField())) \
+            .order_by('-search_rank', 'id')
+
+
 class FilmworkType(models.TextChoices):
     MOVIE = 'movie', _('movie')
     TV_SHOW = 'tv_show', _('tv show')
@@ -127,11 +200,16 @@ class Filmwork(TimeStampedMixin, models.Model):
     type = models.CharField(_('type'), max_length=20, choices=FilmworkType.choices, default=FilmworkType.MOVIE)
     genres = models.ManyToManyField(Genre, through='FilmworkGenre')
     persons = models.ManyToManyField(Person, through='FilmworkPerson')
+    # поддерживается триггерами (см. миграцию 0004_filmwork_search_vector), используется поиском без Elasticsearch
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = FilmworkQuerySet.as_manager()
 
     class Meta:
         indexes = (
             models.Index(fields=('title',), name='film_work_title_idx'),
             models.Index(fields=('creation_date',), name='film_work_creation_date_idx'),
+            GinIndex(fields=('search_vector',), name='film_work_search_vector_idx'),
         )
         verbose_name = _('filmwork')
         verbose_name_plural = _('filmworks')
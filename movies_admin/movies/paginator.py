@@ -0,0 +1,89 @@
+import hashlib
+from typing import Optional
+
+from django.core.cache import cache
+from django.core.paginator import EmptyPage, Page, Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+
+# Кол-во строк, начиная с которого вместо COUNT(*) используем оценку планировщика
+COUNT_ESTIMATE_THRESHOLD = 10_000
+
+
+def estimate_count(queryset) -> int:
+    """Оценка кол-ва строк запроса по плану (EXPLAIN) - без выполнения самого запроса"""
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def get_estimated_count(queryset, cache_timeout: Optional[int] = None) -> int:
+    """
+    Кол-во строк запроса: точное для небольших выборок и оценка планировщика для больших.
+    С cache_timeout результат кешируется по тексту запроса, чтобы не считать его на каждый запрос страницы.
+    """
+    cache_key = None
+    if cache_timeout:
+        sql, params = queryset.order_by().query.sql_with_params()
+        cache_key = f'count:{hashlib.md5(f"{queryset.db}:{sql}:{params}".encode()).hexdigest()}'
+        count = cache.get(cache_key)
+        if count is not None:
+            return count
+
+    count = estimate_count(queryset)
+    if count < COUNT_ESTIMATE_THRESHOLD:
+        count = queryset.count()
+
+    if cache_key:
+        cache.set(cache_key, count, cache_timeout)
+    return count
+
+
+class EstimatedPage(Page):
+    """Страница, наличие следующей страницы у которой определяется выборкой, а не оценкой кол-ва записей"""
+
+    def __init__(self, object_list, number, paginator, has_more: bool):
+        super().__init__(object_list, number, paginator)
+        self.has_more = has_more
+
+    def has_next(self):
+        return self.has_more
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Пагинатор для списков по большим таблицам (админка, API): если по плану запроса строк много, показываем оценку
+    планировщика вместо точного COUNT(*), который на больших таблицах выполняется на каждый просмотр страницы.
+    Небольшие выборки считаются точно.
+    Оценка может быть меньше фактического кол-ва, поэтому страница не обрезается по ней: выбирается полная страница
+    (и одна запись сверх нее, чтобы узнать, есть ли следующая), а номер страницы за оценкой отклоняется, только
+    если страница действительно пуста.
+    """
+    # время кеширования кол-ва строк (None - не кешировать)
+    count_cache_timeout: Optional[int] = None
+
+    @cached_property
+    def count(self):
+        if not hasattr(self.object_list, 'query'):
+            return super().count
+        return get_estimated_count(self.object_list, self.count_cache_timeout)
+
+    def validate_number(self, number):
+        try:
+            return super().validate_number(number)
+        except EmptyPage:
+            number = int(number)
+            if number < 1:
+                raise
+            return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        object_list = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not object_list and number > 1:
+            raise EmptyPage('That page contains no results')
+        return EstimatedPage(object_list[:self.per_page], number, self, has_more=len(object_list) > self.per_page)
@@ -1,41 +1,32 @@
 from django.dispatch import receiver
-from django.db.models.signals import post_save, pre_delete
-from typing import Tuple
-import uuid
-from datetime import datetime
+from django.db.models.signals import post_save, pre_delete, post_delete
 
-from .models import Filmwork
+from .cache import bump_catalog_version
+from .touches import touch_films
 
 
 # С помощью сигналов мы детектим изменения связей кинопроизведений с персонами и жанрами, определяем фильмы, которые эти
 # изменения затронут и обновляем в Filmwork updated_at у соответствующего фильма. Далее ETL периодически мониторит эту
 # таблицу и при появлении новых изменений обновляет информацию о соответствующих фильмах в Elasticsearch'e.
-
-
-def update_filmwork_updates(film_ids: Tuple[uuid.UUID]):
-    updated = Filmwork.objects.filter(id__in=film_ids).update(updated_at=datetime.now())
-    print(updated)
+# Обновления копятся до конца транзакции (см. touches.py), так что сохранение фильма со всеми инлайнами в админке
+# дает один UPDATE. Массовые операции, которые не посылают сигналы, учитываются менеджерами моделей связей.
 
 
 @receiver(post_save, sender='movies.FilmworkPerson')
-def on_filmwork_person_save(sender, instance, **kwargs):
-    print("on_filmwork_person_save:", instance)
-    update_filmwork_updates((instance.film_work_id,))
-
-
 @receiver(post_save, sender='movies.FilmworkGenre')
-def on_filmwork_genre_save(sender, instance, **kwargs):
-    print("on_filmwork_genre_save:", instance)
-    update_filmwork_updates((instance.film_work_id,))
-
-
 @receiver(pre_delete, sender='movies.FilmworkPerson')
-def on_filmwork_person_delete(sender, instance, **kwargs):
-    print("on_filmwork_person_delete:", instance)
-    update_filmwork_updates((instance.film_work_id,))
-
-
 @receiver(pre_delete, sender='movies.FilmworkGenre')
-def on_filmwork_genre_delete(sender, instance, **kwargs):
-    print("on_filmwork_genre_delete:", instance)
-    update_filmwork_updates((instance.film_work_id,))
+def on_filmwork_link_change(sender, instance, using, **kwargs):
+    touch_films((instance.film_work_id,), using=using)
+
+
+# Любое изменение каталога делает неактуальными закешированные ответы API - увеличиваем версию каталога в кеше.
+# Для связей версия увеличивается вместе с обновлением updated_at фильмов.
+@receiver(post_save, sender='movies.Filmwork')
+@receiver(post_save, sender='movies.Person')
+@receiver(post_save, sender='movies.Genre')
+@receiver(post_delete, sender='movies.Filmwork')
+@receiver(post_delete, sender='movies.Person')
+@receiver(post_delete, sender='movies.Genre')
+def on_catalog_change(sender, instance, **kwargs):
+    bump_catalog_version()
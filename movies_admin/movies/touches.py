@@ -0,0 +1,57 @@
+import logging
+from typing import Iterable, Set
+import uuid
+
+from django.apps import apps
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils import timezone
+
+from .cache import bump_catalog_version
+
+
+# Изменения связей фильмов с персонами и жанрами должны обновлять updated_at у фильма, чтобы их подхватил ETL.
+# Вместо UPDATE на каждую сохраненную/удаленную связь собираем id затронутых фильмов до конца транзакции и обновляем
+# их одним запросом через transaction.on_commit. Вне транзакции обновление выполняется сразу.
+
+
+logger = logging.getLogger(__name__)
+
+
+class _FilmTouchFlush:
+    """Отложенное обновление updated_at фильмов одной транзакции"""
+
+    def __init__(self, using: str):
+        self.using = using
+        self.film_ids: Set[uuid.UUID] = set()
+
+    def __call__(self):
+        if not self.film_ids:
+            return
+        filmwork_model = apps.get_model('movies', 'Filmwork')
+        updated = filmwork_model.objects.using(self.using).filter(id__in=self.film_ids) \
+            .update(updated_at=timezone.now())
+        logger.debug(f'Touched {updated} filmworks')
+        bump_catalog_version()
+
+
+def touch_films(film_ids: Iterable[uuid.UUID], using: str = DEFAULT_DB_ALIAS):
+    """Отметить фильмы как измененные по завершении текущей транзакции"""
+    film_ids = {film_id for film_id in film_ids if film_id}
+    if not film_ids:
+        return
+
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        flush = _FilmTouchFlush(using)
+        flush.film_ids.update(film_ids)
+        flush()
+        return
+
+    # Переиспользуем обновление, уже зарегистрированное в этой транзакции. Если его откатили вместе с точкой
+    # сохранения (Django удаляет такие колбэки из run_on_commit), регистрируем новое.
+    flush = getattr(connection, '_film_touch_flush', None)
+    if flush is None or not any(callback is flush for _, callback in connection.run_on_commit):
+        flush = _FilmTouchFlush(using)
+        connection._film_touch_flush = flush
+        transaction.on_commit(flush, using=using)
+    flush.film_ids.update(film_ids)
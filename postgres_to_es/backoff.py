@@ -1,52 +1,240 @@
 from functools import wraps
+import asyncio
+import random
+import threading
 import time
-from typing import List
+from enum import Enum
+from typing import Dict, Optional, Tuple, Type
 import logging
 
 
-def backoff(exceptions: List, start_sleep_time=0.1, factor=2, border_sleep_time=10, total_sleep_time=30):
+class CircuitBreakerOpen(Exception):
+    """Вызов отклонен, так как автомат для этого сервиса разомкнут"""
+
+
+class CircuitState(Enum):
+    closed = 'closed'
+    open = 'open'
+    half_open = 'half_open'
+
+
+class CircuitBreaker:
     """
-    Функция для повторного выполнения функции через некоторое время, если возникла ошибка. Использует наивный
-    экспоненциальный рост времени повтора (factor) до граничного времени ожидания (border_sleep_time)
+    Автоматический выключатель (circuit breaker) для одного внешнего сервиса, общий для всех потоков и воркеров.
+
+    closed - вызовы проходят, ошибки подсчитываются; после failure_threshold ошибок подряд автомат размыкается.
+    open - вызовы сразу отклоняются с CircuitBreakerOpen, пока не пройдет recovery_timeout.
+    half_open - пропускается не больше half_open_max_calls пробных вызовов одновременно; после success_threshold
+        успешных вызовов автомат замыкается, при первой же ошибке снова размыкается.
+    Так восстанавливающаяся база получает сначала единичные пробные запросы, а не всех воркеров разом.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 5,
+                 half_open_max_calls: int = 1, success_threshold: int = 2):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.success_threshold = success_threshold
+
+        self._lock = threading.Lock()
+        self._state = CircuitState.closed
+        self._failures = 0
+        self._successes = 0
+        self._half_open_calls = 0
+        self._half_open_period = 0
+        self._opened_at = 0.0
+
+    @property
+    def state(self) -> CircuitState:
+        with self._lock:
+            return self._state
+
+    def before_call(self) -> Optional[int]:
+        """
+        Проверить, можно ли выполнить вызов. Выбрасывает CircuitBreakerOpen, если нельзя.
+        Возвращает номер периода half-open, если вызов занял слот пробного вызова, иначе None. Этот номер
+        передается в on_success, on_failure и release: слот освобождается и результат засчитывается только
+        пробным вызовам текущего периода, а не вызовам, начатым до размыкания автомата.
+        """
+        with self._lock:
+            if self._state == CircuitState.open:
+                if time.monotonic() - self._opened_at < self.recovery_timeout:
+                    raise CircuitBreakerOpen(f'Circuit breaker "{self.name}" is open')
+                logging.info(f'CircuitBreaker: "{self.name}" is half-open')
+                self._state = CircuitState.half_open
+                self._successes = 0
+                self._half_open_calls = 0
+                self._half_open_period += 1
+
+            if self._state == CircuitState.half_open:
+                if self._half_open_calls >= self.half_open_max_calls:
+                    raise CircuitBreakerOpen(f'Circuit breaker "{self.name}" is half-open, trial calls limit reached')
+                self._half_open_calls += 1
+                return self._half_open_period
+            return None
+
+    def _is_trial(self, trial: Optional[int]) -> bool:
+        return trial is not None and self._state == CircuitState.half_open and trial == self._half_open_period
+
+    def on_success(self, trial: Optional[int] = None):
+        with self._lock:
+            if self._is_trial(trial):
+                self._half_open_calls -= 1
+                self._successes += 1
+                if self._successes >= self.success_threshold:
+                    logging.info(f'CircuitBreaker: "{self.name}" is closed')
+                    self._state = CircuitState.closed
+            if self._state == CircuitState.closed:
+                self._failures = 0
+
+    def release(self, trial: Optional[int] = None):
+        with self._lock:
+            if self._is_trial(trial):
+                self._half_open_calls -= 1
+
+    def on_failure(self, trial: Optional[int] = None):
+        with self._lock:
+            if self._is_trial(trial):
+                self._half_open_calls -= 1
+                self._open()
+                return
+            # Ошибки вызовов, начатых до размыкания, в состоянии open и half-open не учитываются
+            if self._state == CircuitState.closed:
+                self._failures += 1
+                if self._failures >= self.failure_threshold:
+                    self._open()
+
+    def _open(self):
+        logging.warning(f'CircuitBreaker: "{self.name}" is open')
+        self._state = CircuitState.open
+        self._opened_at = time.monotonic()
+        self._failures = 0
+
+
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name: str, **kwargs) -> CircuitBreaker:
+    """Получить общий для процесса автомат по имени сервиса (создается при первом обращении)"""
+    with _circuit_breakers_lock:
+        if name not in _circuit_breakers:
+            _circuit_breakers[name] = CircuitBreaker(name, **kwargs)
+        return _circuit_breakers[name]
+
+
+class _RetryState:
+    """Состояние повторов одного вызова. Создается заново на каждый вызов, поэтому потоки и разные места вызова
+    не делят между собой счетчики"""
+
+    def __init__(self, start_sleep_time, factor, border_sleep_time, total_sleep_time):
+        self.start_sleep_time = start_sleep_time
+        self.factor = factor
+        self.border_sleep_time = border_sleep_time
+        self.total_sleep_left = total_sleep_time
+        self.sleep_time = start_sleep_time
+
+    def next_sleep_time(self) -> Optional[float]:
+        """Следующее время ожидания с decorrelated jitter или None, если время на повторы закончилось"""
+        if self.total_sleep_left <= 0:
+            return None
+        self.sleep_time = min(self.border_sleep_time,
+                              random.uniform(self.start_sleep_time, self.sleep_time * self.factor))
+        sleep_time = min(self.sleep_time, self.total_sleep_left)
+        self.total_sleep_left -= sleep_time
+        return sleep_time
+
+
+def backoff(exceptions: Tuple[Type[Exception], ...], start_sleep_time=0.1, factor=3, border_sleep_time=10,
+            total_sleep_time=30, breaker: Optional[CircuitBreaker] = None):
+    """
+    Функция для повторного выполнения функции через некоторое время, если возникла ошибка. Использует
+    экспоненциальный рост времени повтора с decorrelated jitter до граничного времени ожидания (border_sleep_time),
+    чтобы одновременно упавшие воркеры не повторяли запросы синхронно.
 
     Формула:
-        t = start_sleep_time * 2^(n) if t < border_sleep_time
-        t = border_sleep_time if t >= border_sleep_time
+        t = min(border_sleep_time, random(start_sleep_time, t_prev * factor))
+    Поддерживаются как обычные функции (ожидание через time.sleep), так и корутины (через asyncio.sleep).
     :param exceptions: перехватываемые ошибки, на которые будем делать повторы
-    :param start_sleep_time: начальное время повтора
-    :param factor: во сколько раз нужно увеличить время ожидания
+    :param start_sleep_time: начальное (и минимальное) время повтора
+    :param factor: во сколько раз максимум может вырасти время ожидания
     :param border_sleep_time: граничное время ожидания
-    :param total_sleep_time: максимальное время, выделенное на все повторы
+    :param total_sleep_time: максимальное время, выделенное на все повторы одного вызова
+    :param breaker: общий автомат сервиса; пока он разомкнут, вызовы не выполняются, а ожидают следующего повтора
     :return: результат выполнения функции
     """
+    exceptions = tuple(exceptions)
+    retry_exceptions = (*exceptions, CircuitBreakerOpen) if breaker else exceptions
+
+    def call_once(func, args, kwargs):
+        trial = None
+        if breaker:
+            trial = breaker.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except exceptions:
+            if breaker:
+                breaker.on_failure(trial)
+            raise
+        except BaseException:
+            # Прочие ошибки не говорят о недоступности сервиса, только освобождаем слот пробного вызова
+            if breaker:
+                breaker.release(trial)
+            raise
+        if breaker:
+            breaker.on_success(trial)
+        return result
+
+    async def call_once_async(func, args, kwargs):
+        trial = None
+        if breaker:
+            trial = breaker.before_call()
+        try:
+            result = await func(*args, **kwargs)
+        except exceptions:
+            if breaker:
+                breaker.on_failure(trial)
+            raise
+        except BaseException:
+            # Прочие ошибки не говорят о недоступности сервиса, только освобождаем слот пробного вызова
+            if breaker:
+                breaker.release(trial)
+            raise
+        if breaker:
+            breaker.on_success(trial)
+        return result
+
+    def on_error(err, retry_state: _RetryState) -> float:
+        logging.info(f'Backoff: caught exception {err}')
+        sleep_time = retry_state.next_sleep_time()
+        if sleep_time is None:
+            logging.info('Backoff: total sleep time is over, reraising..')
+            raise err
+        logging.info(f'Backoff: will try again after sleep {sleep_time:.2f} secs..')
+        return sleep_time
 
     def func_wrapper(func):
-        total_sleep_left = total_sleep_time
-        sleep_time = min(start_sleep_time, total_sleep_left)
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def inner_async(*args, **kwargs):
+                retry_state = _RetryState(start_sleep_time, factor, border_sleep_time, total_sleep_time)
+                while True:
+                    try:
+                        return await call_once_async(func, args, kwargs)
+                    except retry_exceptions as err:
+                        await asyncio.sleep(on_error(err, retry_state))
+
+            return inner_async
 
         @wraps(func)
         def inner(*args, **kwargs):
-            nonlocal sleep_time, total_sleep_left
-            try:
-                return func(*args, **kwargs)
-            except exceptions as err:
-                logging.info(f'Backoff: caught exception {err}')
-                if total_sleep_left == 0:
-                    logging.info('Backoff: total sleep type is over, reraising..')
-                    # в этой реализации мы используем внешние nonlocal переменные, поэтому они сами себя не сбросят
-                    # при разворачивании стека, надо их сбросить
-                    total_sleep_left = total_sleep_time
-                    sleep_time = min(start_sleep_time, total_sleep_left)
-                    raise
-                if not sleep_time:
-                    total_sleep_left = total_sleep_time
-                    sleep_time = min(start_sleep_time, total_sleep_left)
-                logging.info(f'Backoff: will try again after sleep {sleep_time} secs..')
-                time.sleep(sleep_time)
-                total_sleep_left -= sleep_time
-                sleep_time *= factor
-                sleep_time = min(sleep_time, border_sleep_time, total_sleep_left)
-                return inner(*args, **kwargs)
+            retry_state = _RetryState(start_sleep_time, factor, border_sleep_time, total_sleep_time)
+            while True:
+                try:
+                    return call_once(func, args, kwargs)
+                except retry_exceptions as err:
+                    time.sleep(on_error(err, retry_state))
 
         return inner
 
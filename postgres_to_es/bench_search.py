@@ -0,0 +1,128 @@
+import argparse
+import json
+import logging
+import statistics
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import requests
+
+from postgres_to_es.config import config
+
+
+# Бенчмарк поисковых запросов к индексу movies: для каждого сценария сравнивается "старый" запрос (как его приходилось
+# писать до появления title.suggest, исключения *_names из _source и отказа от подсчета total) и оптимизированный.
+# Время берется из поля took ответа ES, чтобы не учитывать сеть. Для сравнения с прежней раскладкой индекса
+# можно передать --baseline-index со старой схемой (например, копией индекса, созданной до миграции).
+
+
+@dataclass
+class BenchCase:
+    name: str
+    baseline: Dict
+    optimized: Dict
+    endpoint: str = '_search'
+
+
+def bench_cases(prefix: str, top_n: int) -> List[BenchCase]:
+    return [
+        BenchCase(
+            name='title autocomplete',
+            baseline={
+                'size': 10,
+                '_source': ['title'],
+                'query': {'match_phrase_prefix': {'title': prefix}},
+            },
+            optimized={
+                '_source': ['title'],
+                'suggest': {'title': {'prefix': prefix, 'completion': {'field': 'title.suggest', 'size': 10}}},
+            },
+        ),
+        BenchCase(
+            name=f'top {top_n} by imdb_rating',
+            baseline={
+                'size': top_n,
+                'track_total_hits': True,
+                'sort': [{'imdb_rating': {'order': 'desc', 'missing': '_last'}}, {'id': 'asc'}],
+                'query': {'match_all': {}},
+            },
+            # тот же запрос, что делает API поиска для sort=-imdb_rating: без подсчета total
+            optimized={
+                'size': top_n,
+                'track_total_hits': False,
+                'sort': [{'imdb_rating': {'order': 'desc', 'missing': '_last'}}, {'id': 'asc'}],
+                'query': {'match_all': {}},
+            },
+        ),
+        BenchCase(
+            name='list page _source',
+            baseline={
+                'size': 50,
+                'query': {'match_all': {}},
+            },
+            # поля, которые запрашивает API поиска (api/v1/search.py): без *_names и служебных полей
+            optimized={
+                'size': 50,
+                '_source': ['id', 'title', 'description', 'imdb_rating', 'type', 'genres',
+                            'actors', 'writers', 'directors'],
+                'query': {'match_all': {}},
+            },
+        ),
+    ]
+
+
+def run_query(index: str, endpoint: str, body: Dict) -> (int, int):
+    """Выполнить запрос и вернуть время выполнения на стороне ES (мс) и размер ответа (байт)"""
+    response = requests.post('http://{}:{}/{}/{}'.format(config.es_db.dsn.host, config.es_db.dsn.port,
+                                                         index, endpoint),
+                             params={'request_cache': 'false'},
+                             data=json.dumps(body),
+                             headers={'Content-Type': 'application/json'})
+    response.raise_for_status()
+    return response.json()['took'], len(response.content)
+
+
+def measure(index: str, endpoint: str, body: Dict, repeat: int, warmup: int) -> Dict:
+    for _ in range(warmup):
+        run_query(index, endpoint, body)
+    timings, sizes = [], []
+    for _ in range(repeat):
+        took, size = run_query(index, endpoint, body)
+        timings.append(took)
+        sizes.append(size)
+    timings.sort()
+    return {
+        'p50_ms': statistics.median(timings),
+        'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        'response_bytes': int(statistics.mean(sizes)),
+    }
+
+
+def bench(index: str, baseline_index: Optional[str], prefix: str, top_n: int, repeat: int, warmup: int):
+    results = []
+    for case in bench_cases(prefix, top_n):
+        baseline = measure(baseline_index or index, case.endpoint, case.baseline, repeat, warmup)
+        optimized = measure(index, case.endpoint, case.optimized, repeat, warmup)
+        results.append({'case': case.name, 'baseline': baseline, 'optimized': optimized})
+        logging.info(f'{case.name}: baseline p50={baseline["p50_ms"]}ms p95={baseline["p95_ms"]}ms '
+                     f'{baseline["response_bytes"]}B -> optimized p50={optimized["p50_ms"]}ms '
+                     f'p95={optimized["p95_ms"]}ms {optimized["response_bytes"]}B')
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s : %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Бенчмарк поисковых запросов к индексу фильмов')
+    parser.add_argument('--index', default=config.es_db.dsn.dbname, help='индекс с новой схемой')
+    parser.add_argument('--baseline-index', default=None, help='индекс со старой схемой для базовых запросов')
+    parser.add_argument('--prefix', default='sta', help='префикс названия для автодополнения')
+    parser.add_argument('--top-n', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--output', default=None, help='файл для сохранения результатов в json')
+    args = parser.parse_args()
+
+    bench_results = bench(args.index, args.baseline_index, args.prefix, args.top_n, args.repeat, args.warmup)
+    if args.output:
+        with open(args.output, 'w') as fs:
+            json.dump(bench_results, fs, indent=2)
@@ -0,0 +1,211 @@
+import argparse
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime
+from os import environ
+from typing import Dict, Iterator, List, Optional
+
+import pytz
+import requests
+
+from postgres_to_es.config import config
+from postgres_to_es.loader import BaseLoader, Loader, PersonsLoader, GenresLoader
+from postgres_to_es.migrate import create_indexes
+from postgres_to_es.models import FilmWork, NamedItem, Person, Genre
+from postgres_to_es.state_storage import JsonFileStorage, State
+from sqlite_to_postgres.load_data import SQLiteLoader, connect_sqlite
+
+
+# Первичное наполнение индексов movies, persons и genres напрямую из SQLite, без ожидания, пока ETL обойдет
+# весь Postgres с datetime.min. Подразумевается, что Postgres заполнен из того же файла (load_data.py): по
+# окончании в состояние ETL записываются максимальные updated_at фильмов, персон и жанров из SQLite, а для журнала
+# content.related_change - момент начала наполнения, и ETL продолжает синхронизацию с них. Контрольные точки
+# берутся до начала чтения, поэтому изменения, сделанные в Postgres во время наполнения, ETL тоже подхватит.
+#
+# Запуск из каталога postgres_to_es (рядом с config.json): PYTHONPATH=.. python3 bootstrap.py --sqlite-path ...
+
+
+ROLE_ATTRS = {'actor': 'actors', 'writer': 'writers', 'director': 'directors'}
+
+STATE_TABLES = {
+    'filmworks_synced_date': 'film_work',
+    'persons_synced_date': 'person',
+    'genres_synced_date': 'genre',
+}
+
+# контрольная точка журнала content.related_change: в SQLite журнала нет, и все записанное в него до начала
+# наполнения индексы уже учитывают
+RELATED_CHANGES_STATE = 'related_changes_synced_date'
+
+
+class BootstrapError(Exception):
+    pass
+
+
+def as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """SQLiteLoader.convert_timestamp отбрасывает часовой пояс, время в SQLite хранится в UTC"""
+    return value.replace(tzinfo=pytz.UTC) if value else value
+
+
+def placeholders(count: int) -> str:
+    return ', '.join('?' * count)
+
+
+def iter_filmworks(connection, chunk_size: int) -> Iterator[List[FilmWork]]:
+    """
+    Пачки фильмов в порядке id. Персоны и жанры пачки выбираются отдельными запросами по film_work_id, для которых
+    используются уникальные индексы таблиц связей (film_work_id - их первая колонка)
+    """
+    last_id = ''
+    while True:
+        rows = connection.execute("""
+            SELECT id, title, description, rating, type, updated_at
+            FROM film_work
+            WHERE id > ?
+            ORDER BY id
+            LIMIT ?
+        """, (last_id, chunk_size)).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+
+        filmworks = {row[0]: FilmWork(id=row[0], title=row[1], description=row[2], rating=row[3], type=row[4],
+                                      updated_at=as_utc(row[5]))
+                     for row in rows}
+        film_ids = list(filmworks)
+
+        persons = connection.execute(f"""
+            SELECT pfw.film_work_id, pfw.role, p.id, p.full_name, p.updated_at
+            FROM person_film_work as pfw
+            JOIN person as p ON p.id = pfw.person_id
+            WHERE pfw.film_work_id IN ({placeholders(len(film_ids))})
+        """, film_ids)
+        for film_id, role, person_id, full_name, updated_at in persons:
+            getattr(filmworks[film_id], ROLE_ATTRS[role]).add(
+                NamedItem(id=person_id, name=full_name, updated_at=as_utc(updated_at)))
+
+        genres = connection.execute(f"""
+            SELECT gfw.film_work_id, g.id, g.name, g.updated_at
+            FROM genre_film_work as gfw
+            JOIN genre as g ON g.id = gfw.genre_id
+            WHERE gfw.film_work_id IN ({placeholders(len(film_ids))})
+        """, film_ids)
+        for film_id, genre_id, name, updated_at in genres:
+            filmworks[film_id].genres.add(NamedItem(id=genre_id, name=name, updated_at=as_utc(updated_at)))
+
+        yield list(filmworks.values())
+
+
+def iter_persons(connection, chunk_size: int) -> Iterator[List[Person]]:
+    """Пачки персон с их фильмами и ролями: один потоковый запрос, отсортированный по id персоны"""
+    persons = []
+    rows = connection.execute("""
+        SELECT p.id, p.full_name, p.updated_at, pfw.film_work_id, pfw.role
+        FROM person as p
+        LEFT JOIN person_film_work as pfw ON pfw.person_id = p.id
+        ORDER BY p.id
+    """)
+    for person_id, full_name, updated_at, film_id, role in rows:
+        if not persons or persons[-1].id != person_id:
+            if len(persons) >= chunk_size:
+                yield persons
+                persons = []
+            persons.append(Person(id=person_id, full_name=full_name, updated_at=as_utc(updated_at)))
+        if film_id:
+            persons[-1].film_ids.add(film_id)
+            persons[-1].roles.add(role)
+    if persons:
+        yield persons
+
+
+def iter_genres(connection, chunk_size: int) -> Iterator[List[Genre]]:
+    genres = [Genre(id=genre_id, name=name, description=description, updated_at=as_utc(updated_at),
+                    film_count=film_count)
+              for genre_id, name, description, updated_at, film_count in connection.execute("""
+                  SELECT g.id, g.name, g.description, g.updated_at, COUNT(gfw.id)
+                  FROM genre as g
+                  LEFT JOIN genre_film_work as gfw ON gfw.genre_id = g.id
+                  GROUP BY g.id
+              """)]
+    for start in range(0, len(genres), chunk_size):
+        yield genres[start:start + chunk_size]
+
+
+def get_checkpoints(connection) -> Dict[str, datetime]:
+    """Максимальные updated_at таблиц SQLite и текущий момент для журнала related_change в виде состояния ETL"""
+    checkpoints = {RELATED_CHANGES_STATE: datetime.now(pytz.UTC)}
+    for state_key, table in STATE_TABLES.items():
+        # ORDER BY вместо MAX, чтобы sqlite применил convert_timestamp по объявленному типу колонки
+        row = connection.execute(f"""
+            SELECT updated_at FROM {table} WHERE updated_at IS NOT NULL ORDER BY updated_at DESC LIMIT 1
+        """).fetchone()
+        checkpoints[state_key] = as_utc(row[0]) if row else datetime.min.replace(tzinfo=pytz.UTC)
+    return checkpoints
+
+
+def set_refresh_interval(index: str, value: Optional[str]):
+    """На время наполнения обновление индекса отключается, None возвращает значение по умолчанию"""
+    response = requests.put(f'http://{config.es_db.dsn.host}:{config.es_db.dsn.port}/{index}/_settings',
+                            json={'index': {'refresh_interval': value}})
+    if not response.ok:
+        logging.warning(f'Bootstrap: failed to set refresh_interval of {index}: {response.text}')
+
+
+def load_parallel(loader: BaseLoader, batches: Iterator[List], workers: int) -> int:
+    """Загрузка пачек в workers потоков, одновременно в работе не больше 2 * workers пачек"""
+    loaded = 0
+    in_flight = deque()
+
+    def wait_oldest():
+        future, batch_size = in_flight.popleft()
+        load_result, _ = future.result()
+        if not load_result:
+            raise BootstrapError(f'Failed to load a batch into {loader.index}')
+        return batch_size
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in batches:
+            in_flight.append((executor.submit(loader.load, batch), len(batch)))
+            if len(in_flight) >= 2 * workers:
+                loaded += wait_oldest()
+        while in_flight:
+            loaded += wait_oldest()
+
+    return loaded
+
+
+def bootstrap(db_path: str, chunk_size: int, workers: int):
+    create_indexes()
+    with closing(connect_sqlite(db_path)) as connection:
+        SQLiteLoader(connection)  # регистрирует convert_timestamp
+        checkpoints = get_checkpoints(connection)
+
+        for loader, batches in ((Loader(config.es_db.dsn), iter_filmworks(connection, chunk_size)),
+                                (PersonsLoader(config.es_db.dsn, config.es_db.persons_index),
+                                 iter_persons(connection, chunk_size)),
+                                (GenresLoader(config.es_db.dsn, config.es_db.genres_index),
+                                 iter_genres(connection, chunk_size))):
+            set_refresh_interval(loader.index, '-1')
+            try:
+                loaded = load_parallel(loader, batches, workers)
+            finally:
+                set_refresh_interval(loader.index, None)
+            logging.info(f'Bootstrap: loaded {loaded} documents into {loader.index}')
+
+    state = State(JsonFileStorage(config.state_file_path))
+    for state_key, checkpoint in checkpoints.items():
+        state.set_state(state_key, checkpoint.isoformat())
+    logging.info(f'Bootstrap: ETL state set to {", ".join(f"{key}={value}" for key, value in checkpoints.items())}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s : %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Наполнение индексов Elasticsearch напрямую из SQLite')
+    parser.add_argument('--sqlite-path', default=environ.get('MIGRATION_SRC_DB_PATH', 'db.sqlite'),
+                        help='путь к файлу SQLite')
+    parser.add_argument('--chunk-size', type=int, default=500, help='кол-во документов в одном bulk-запросе')
+    parser.add_argument('--workers', type=int, default=4, help='кол-во параллельных bulk-запросов')
+    args = parser.parse_args()
+    bootstrap(args.sqlite_path, args.chunk_size, args.workers)
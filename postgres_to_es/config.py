@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseModel
 
 
@@ -12,18 +14,36 @@ class DSNSettings(BaseDSNSettings):
     user: str
 
 
+class CircuitBreakerSettings(BaseModel):
+    failure_threshold: int = 5
+    recovery_timeout: float = 5
+    half_open_max_calls: int = 1
+    success_threshold: int = 2
+
+
 class PostgresSettings(BaseModel):
     dsn: DSNSettings
+    # Реплика, из которой ETL читает изменения (по умолчанию - основная база)
+    replica_dsn: Optional[DSNSettings] = None
+    # Отступ в секундах от момента, до которого изменения видны в базе: состояние ETL не продвигается дальше него
+    safety_margin: float = 5
+    # Пул соединений ETL: кол-во соединений и время простоя (сек), после которого соединение проверяется
+    pool_size: int = 2
+    health_check_interval: float = 30
     min_backoff_delay: float = 0.1
     max_backoff_delay: float = 5
     total_backoff_time: float = 30
+    circuit_breaker: CircuitBreakerSettings = CircuitBreakerSettings()
 
 
 class ElasticsearchSettings(BaseModel):
     dsn: BaseDSNSettings
+    persons_index: str = 'persons'
+    genres_index: str = 'genres'
     min_backoff_delay: float = 0.1
     max_backoff_delay: float = 10
     total_backoff_time: float = 30
+    circuit_breaker: CircuitBreakerSettings = CircuitBreakerSettings()
 
 
 class Config(BaseModel):
@@ -42,6 +42,9 @@ db_schema = """
   },
   "mappings": {
     "dynamic": "strict",
+    "_source": {
+      "excludes": ["*_names"]
+    },
     "properties": {
       "id": {
         "type": "keyword"
@@ -49,12 +52,22 @@ db_schema = """
       "imdb_rating": {
         "type": "float"
       },
+      "updated_at": {
+        "type": "date"
+      },
+      "type": {
+        "type": "keyword"
+      },
       "title": {
         "type": "text",
         "analyzer": "ru_en",
         "fields": {
           "raw": { 
             "type":  "keyword"
+          },
+          "suggest": {
+            "type": "completion",
+            "analyzer": "simple"
           }
         }
       },
@@ -0,0 +1,41 @@
+import json
+
+from postgres_to_es.es_db_schema import db_schema
+
+
+# Настройки анализа (в том числе анализатор ru_en) берем у индекса фильмов, чтобы поиск по названиям работал
+# одинаково. Сортировку индекса по рейтингу не наследуем - у жанров такого поля нет
+genres_schema = json.dumps({
+    "settings": {key: value for key, value in json.loads(db_schema)["settings"].items() if key != "index"},
+    "mappings": {
+        "dynamic": "strict",
+        "properties": {
+            "id": {
+                "type": "keyword"
+            },
+            "name": {
+                "type": "text",
+                "analyzer": "ru_en",
+                "fields": {
+                    "raw": {
+                        "type": "keyword"
+                    },
+                    "suggest": {
+                        "type": "completion",
+                        "analyzer": "simple"
+                    }
+                }
+            },
+            "description": {
+                "type": "text",
+                "analyzer": "ru_en"
+            },
+            "film_count": {
+                "type": "integer"
+            },
+            "updated_at": {
+                "type": "date"
+            }
+        }
+    }
+}, indent=2)
@@ -0,0 +1,40 @@
+import json
+
+from postgres_to_es.es_db_schema import db_schema
+
+
+# Настройки анализа (в том числе анализатор ru_en) берем у индекса фильмов, чтобы поиск по именам работал одинаково.
+# Сортировку индекса по рейтингу не наследуем - у персон такого поля нет
+persons_schema = json.dumps({
+    "settings": {key: value for key, value in json.loads(db_schema)["settings"].items() if key != "index"},
+    "mappings": {
+        "dynamic": "strict",
+        "properties": {
+            "id": {
+                "type": "keyword"
+            },
+            "full_name": {
+                "type": "text",
+                "analyzer": "ru_en",
+                "fields": {
+                    "raw": {
+                        "type": "keyword"
+                    },
+                    "suggest": {
+                        "type": "completion",
+                        "analyzer": "simple"
+                    }
+                }
+            },
+            "roles": {
+                "type": "keyword"
+            },
+            "film_ids": {
+                "type": "keyword"
+            },
+            "updated_at": {
+                "type": "date"
+            }
+        }
+    }
+}, indent=2)
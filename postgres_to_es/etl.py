@@ -4,29 +4,36 @@ import logging
 from postgres_to_es.state_storage import JsonFileStorage, State
 from postgres_to_es.config import config
 from postgres_to_es.extractor import Extractor, ExtractorState
-from postgres_to_es.loader import Loader
+from postgres_to_es.loader import Loader, PersonsLoader, GenresLoader
+from postgres_to_es.pool import ConnectionPool
 
 
 def sync_es_with_postgres():
     storage = JsonFileStorage(config.state_file_path)
     etl_state = State(storage)
+    # Пул живет все время работы ETL: соединения не открываются заново на каждой итерации
+    pool = ConnectionPool(config.postgres_db.replica_dsn or config.postgres_db.dsn, config.postgres_db.pool_size,
+                          config.postgres_db.health_check_interval)
     while True:
         logging.info('ETL: Syncing es with postgres')
         try:
-            perform_etl(etl_state)
+            perform_etl(etl_state, pool)
         except Exception as err:
             logging.exception(f'ETL: Failed loop iteration with error')
         time.sleep(config.sync_interval)
 
 
-def perform_etl(state: State):
-    extractor = Extractor(config.postgres_db.dsn, config.batch_size)
+def perform_etl(state: State, pool: ConnectionPool):
+    extractor = Extractor(pool, config.batch_size, config.postgres_db.safety_margin)
     loader = Loader(config.es_db.dsn)
+    persons_loader = PersonsLoader(config.es_db.dsn, config.es_db.persons_index)
+    genres_loader = GenresLoader(config.es_db.dsn, config.es_db.genres_index)
 
     while True:
         synced_state = ExtractorState.fromisoformat([state.get_state('filmworks_synced_date'),
                                                      state.get_state('persons_synced_date'),
-                                                     state.get_state('genres_synced_date')])
+                                                     state.get_state('genres_synced_date'),
+                                                     state.get_state('related_changes_synced_date')])
 
         extract_res = extractor.extract_batch(synced_state)
         if not extract_res.filmworks and not extract_res.state:
@@ -39,10 +46,22 @@ def perform_etl(state: State):
             load_result, _ = loader.load(extract_res.filmworks)
             if load_result:
                 logging.info(f'ETL: Loaded {len(extract_res.filmworks)} filmworks')
+
+        # Персоны и жанры строим по той же пачке изменений, не перечитывая таблицы изменений
+        if load_result:
+            related_res = extractor.extract_related(extract_res)
+            for items, items_loader, items_name in ((related_res.persons, persons_loader, 'persons'),
+                                                    (related_res.genres, genres_loader, 'genres')):
+                if items and load_result:
+                    load_result, _ = items_loader.load(items)
+                    if load_result:
+                        logging.info(f'ETL: Loaded {len(items)} {items_name}')
+
         if extract_res.state and load_result:
             state.set_state('filmworks_synced_date', extract_res.state.filmworks_state.isoformat())
             state.set_state('persons_synced_date', extract_res.state.persons_state.isoformat())
             state.set_state('genres_synced_date', extract_res.state.genres_state.isoformat())
+            state.set_state('related_changes_synced_date', extract_res.state.related_changes_state.isoformat())
 
 
 if __name__ == '__main__':
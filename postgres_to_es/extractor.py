@@ -1,17 +1,23 @@
-from typing import Iterable, List, Any
-from datetime import datetime
+from typing import Iterable, List, Any, Optional, Set
+from datetime import datetime, timedelta
 from os import environ
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 import pytz
 import logging
 
 import psycopg2
-from psycopg2.extras import register_uuid, DictCursor
+from psycopg2.extras import register_uuid
 
 from postgres_to_es.backoff import backoff
-from postgres_to_es.models import FilmWork, NamedItem
+from postgres_to_es.models import FilmWork, NamedItem, Person, Genre
 from postgres_to_es.config import config
+from postgres_to_es.pool import ConnectionPool, postgres_breaker
+
+
+# кол-во проверок подряд с той же границей выгрузки, после которого пишется предупреждение
+STALLED_BOUND_WARNING_CHECKS = 10
 
 
 @dataclass
@@ -25,24 +31,42 @@ class ExtractorState:
     filmworks_state: datetime
     persons_state: datetime
     genres_state: datetime
+    related_changes_state: datetime = datetime.min.replace(tzinfo=pytz.UTC)
 
     @classmethod
     def fromisoformat(cls, iso_list: List[str]):
         if iso_list[0] is None:
             return None
+        # контрольной точки журнала content.related_change может не быть в состоянии, сохраненном до его появления
         return cls(filmworks_state=datetime.fromisoformat(iso_list[0]),
                    persons_state=datetime.fromisoformat(iso_list[1]),
-                   genres_state=datetime.fromisoformat(iso_list[2]))
+                   genres_state=datetime.fromisoformat(iso_list[2]),
+                   related_changes_state=datetime.fromisoformat(iso_list[3]) if iso_list[3]
+                   else datetime.min.replace(tzinfo=pytz.UTC))
 
 
 @dataclass
 class BatchExtractResult:
     filmworks: Iterable[FilmWork] = None
     state: ExtractorState = None
+    # изменившиеся персоны и жанры, которые могли не попасть в пачку фильмов (например, персона без фильмов)
+    person_ids: Set[str] = field(default_factory=set)
+    genre_ids: Set[str] = field(default_factory=set)
+
+
+@dataclass
+class RelatedExtractResult:
+    persons: List[Person] = field(default_factory=list)
+    genres: List[Genre] = field(default_factory=list)
 
 
 class BaseExtractor(ABC):
     """Базовый класс загрузчика фильмов"""
+
+    # Верхняя граница updated_at для таблиц изменений: строки новее нее еще могут быть не видны (не дошли до реплики
+    # или их транзакция не завершилась), поэтому состояние не должно уходить дальше нее
+    extract_until: datetime = None
+
     def __init__(self, batch_size: int):
         register_uuid()
         self.batch_size = batch_size
@@ -128,11 +152,12 @@ class FilmworksExtractor(BaseExtractor):
         request.sql_template = """
                                     SELECT id
                                     FROM content.film_work
-                                    WHERE updated_at > %s
+                                    WHERE updated_at > %s AND updated_at <= %s
                                     ORDER BY updated_at
                                     LIMIT %s;
                                 """
-        request.data = (extract_since.filmworks_state.isoformat(sep=" "), self.batch_size)
+        request.data = (extract_since.filmworks_state.isoformat(sep=" "), self.extract_until.isoformat(sep=" "),
+                        self.batch_size)
 
         return request
 
@@ -170,11 +195,11 @@ class FilmworksFromPersonsExtractor(BaseExtractor):
             sql_request = """
                             SELECT id, updated_at
                             FROM content.person
-                            WHERE updated_at > %s
+                            WHERE updated_at > %s AND updated_at <= %s
                             ORDER BY updated_at
                             LIMIT %s;
                         """
-            cursor.execute(sql_request, (extract_since.persons_state, self.batch_size))
+            cursor.execute(sql_request, (extract_since.persons_state, self.extract_until, self.batch_size))
             persons = cursor.fetchall()  # тут persons нам понадобится чуть позже, поэтому fetchall
             self.person_ids = [str(person[0]) for person in persons]
 
@@ -201,6 +226,7 @@ class FilmworksFromPersonsExtractor(BaseExtractor):
         if not extract_res.filmworks and len(self.person_ids) > 0:
             extract_res.state = extract_since
             extract_res.state.persons_state = self.max_persons_updated_at
+            extract_res.person_ids = set(self.person_ids)
             self.person_ids = None
         else:
             extract_res.state = None
@@ -222,11 +248,11 @@ class FilmworksFromGenresExtractor(BaseExtractor):
             sql_request = """
                             SELECT id, updated_at
                             FROM content.genre
-                            WHERE updated_at > %s
+                            WHERE updated_at > %s AND updated_at <= %s
                             ORDER BY updated_at
                             LIMIT %s;
                         """
-            cursor.execute(sql_request, (extract_since.genres_state, self.batch_size))
+            cursor.execute(sql_request, (extract_since.genres_state, self.extract_until, self.batch_size))
             genres = cursor.fetchall()
             self.genre_ids = [str(genre[0]) for genre in genres]
 
@@ -253,6 +279,7 @@ class FilmworksFromGenresExtractor(BaseExtractor):
         if not extract_res.filmworks and len(self.genre_ids) > 0:
             extract_res.state = extract_since
             extract_res.state.genres_state = self.max_genres_updated_at
+            extract_res.genre_ids = set(self.genre_ids)
             self.genre_ids = None
         else:
             extract_res.state = None
@@ -262,50 +289,264 @@ class FilmworksFromGenresExtractor(BaseExtractor):
         return extract_res
 
 
+class RelatedChangesExtractor(BaseExtractor):
+    """
+    Персоны и жанры из журнала content.related_change (миграция 0005_related_changes): удаленные и те, у которых
+    убрали связь с фильмом. По связям фильмов пачки их не найти, поэтому они передаются в выгрузку персон и жанров
+    отдельно. Записи одного оператора имеют одинаковый changed_at, поэтому пачка не обрывается посреди них: в нее
+    попадают все записи с changed_at последней строки.
+    """
+
+    def get_extract_request(self, cursor, extract_since: ExtractorState):
+        request = RawRequest()
+        request.sql_template = """
+                                    SELECT item_type, item_id, changed_at
+                                    FROM content.related_change
+                                    WHERE changed_at > %(since)s AND changed_at <= COALESCE((
+                                        SELECT changed_at
+                                        FROM content.related_change
+                                        WHERE changed_at > %(since)s AND changed_at <= %(until)s
+                                        ORDER BY changed_at
+                                        OFFSET %(limit)s
+                                        LIMIT 1
+                                    ), %(until)s)
+                                    ORDER BY changed_at;
+                               """
+        request.data = {'since': extract_since.related_changes_state, 'until': self.extract_until,
+                        'limit': self.batch_size}
+
+        return request
+
+    def extract_batch(self, connection, extract_since: ExtractorState):
+        with connection:
+            with connection.cursor() as cursor:
+                sql_request = self.get_extract_request(cursor, extract_since)
+                cursor.execute(sql_request.sql_template, sql_request.data)
+                changes = cursor.fetchall()
+
+        if not changes:
+            return BatchExtractResult()
+
+        extract_res = BatchExtractResult(state=extract_since)
+        extract_res.state.related_changes_state = changes[-1]['changed_at']
+        for change in changes:
+            item_ids = extract_res.person_ids if change['item_type'] == 'person' else extract_res.genre_ids
+            item_ids.add(str(change['item_id']))
+
+        return extract_res
+
+
+class BaseRelatedExtractor(ABC):
+    """Базовый класс для выгрузки документов, связанных с пачкой фильмов (персон, жанров).
+    Идентификаторы берутся из уже выгруженной пачки, поэтому таблицы изменений повторно не сканируются"""
+
+    sql_template: str = ''
+
+    @abstractmethod
+    def related_ids(self, extract_res: BatchExtractResult) -> Set[str]:
+        """Идентификаторы документов, затронутых пачкой"""
+        pass
+
+    @abstractmethod
+    def transform_raw_data(self, raw_data) -> List:
+        pass
+
+    @abstractmethod
+    def deleted_item(self, item_id: str):
+        """Документ, который BaseLoader удалит из индекса"""
+        pass
+
+    def extract(self, connection, extract_res: BatchExtractResult) -> List:
+        item_ids = self.related_ids(extract_res)
+        if not item_ids:
+            return []
+
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(self.sql_template, (tuple(item_ids),))
+                items = self.transform_raw_data(cursor.fetchall())
+
+        # Те, кого уже нет в Postgres, удаляем из индекса
+        found_ids = {str(item.id) for item in items}
+        items.extend(self.deleted_item(item_id) for item_id in item_ids - found_ids)
+
+        return items
+
+
+class PersonsExtractor(BaseRelatedExtractor):
+    sql_template = """
+                        SELECT
+                            p.id,
+                            p.full_name,
+                            p.updated_at,
+                            pfw.film_work_id as fw_id,
+                            pfw.role as role
+                        FROM content.person as p
+                        LEFT JOIN content.person_film_work as pfw ON pfw.person_id = p.id
+                        WHERE p.id IN %s
+                        ORDER BY p.id;
+                   """
+
+    def related_ids(self, extract_res: BatchExtractResult) -> Set[str]:
+        person_ids = set(extract_res.person_ids)
+        for filmwork in extract_res.filmworks or ():
+            person_ids.update(str(person.id) for person in (*filmwork.actors, *filmwork.writers, *filmwork.directors))
+        return person_ids
+
+    def transform_raw_data(self, raw_data) -> List[Person]:
+        persons = []
+        for data in raw_data:
+            if not persons or data['id'] != persons[-1].id:
+                persons.append(Person(id=data['id'], full_name=data['full_name'], updated_at=data['updated_at']))
+            if data['fw_id']:
+                persons[-1].film_ids.add(data['fw_id'])
+                persons[-1].roles.add(data['role'])
+        return persons
+
+    def deleted_item(self, item_id: str) -> Person:
+        return Person(id=item_id, full_name=None, updated_at=None)
+
+
+class GenresExtractor(BaseRelatedExtractor):
+    sql_template = """
+                        SELECT
+                            g.id,
+                            g.name,
+                            g.description,
+                            g.updated_at,
+                            COUNT(gfw.id) as film_count
+                        FROM content.genre as g
+                        LEFT JOIN content.genre_film_work as gfw ON gfw.genre_id = g.id
+                        WHERE g.id IN %s
+                        GROUP BY g.id;
+                   """
+
+    def related_ids(self, extract_res: BatchExtractResult) -> Set[str]:
+        genre_ids = set(extract_res.genre_ids)
+        for filmwork in extract_res.filmworks or ():
+            genre_ids.update(str(genre.id) for genre in filmwork.genres)
+        return genre_ids
+
+    def transform_raw_data(self, raw_data) -> List[Genre]:
+        return [Genre(id=data['id'], name=data['name'], description=data['description'],
+                      updated_at=data['updated_at'], film_count=data['film_count']) for data in raw_data]
+
+    def deleted_item(self, item_id: str) -> Genre:
+        return Genre(id=item_id, name=None, description=None, updated_at=None)
+
+
+# Повтор выгрузки при потере соединения: пул уже выбросил сломанное соединение, повтор получит новое
+retry_on_connection_error = backoff(exceptions=(psycopg2.OperationalError, psycopg2.InterfaceError),
+                                   start_sleep_time=config.postgres_db.min_backoff_delay,
+                                   border_sleep_time=config.postgres_db.max_backoff_delay,
+                                   total_sleep_time=config.postgres_db.total_backoff_time,
+                                   breaker=postgres_breaker)
+
+
 class Extractor:
-    """Класс для выгрузки данных из PostgreSQL пачками"""
+    """Класс для выгрузки данных из PostgreSQL (или его реплики) пачками через общий пул соединений"""
 
-    def __init__(self, dsn, batch_size):
+    def __init__(self, pool: ConnectionPool, batch_size, safety_margin: float = 0):
         register_uuid()
-        self.dsn = dict(dsn)
+        self.pool = pool
         self.batch_size = batch_size or 100
-        self.connection = None
-        self.connect()
-
-        self.extractors = iter((FilmworksExtractor(self.batch_size),
-                                FilmworksFromPersonsExtractor(self.batch_size),
-                                FilmworksFromGenresExtractor(self.batch_size)))
+        self.safety_margin = timedelta(seconds=safety_margin)
+        # граница выгрузки и кол-во проверок подряд, при которых она не сдвигалась
+        self.last_extract_until: Optional[datetime] = None
+        self.stalled_checks = 0
+        # персоны и жанры пачки выгружаются параллельно, каждый поток со своим соединением из пула
+        self.related_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='extract-related')
+
+        self.all_extractors = (FilmworksExtractor(self.batch_size),
+                               FilmworksFromPersonsExtractor(self.batch_size),
+                               FilmworksFromGenresExtractor(self.batch_size),
+                               RelatedChangesExtractor(self.batch_size))
+        self.extractors = iter(self.all_extractors)
         self.extractor = next(self.extractors)
+        self.persons_extractor = PersonsExtractor()
+        self.genres_extractor = GenresExtractor()
 
     def __del__(self):
-        if self.connection:
-            self.connection.close()
-
-    @backoff(exceptions=(psycopg2.OperationalError,),
-             start_sleep_time=config.postgres_db.min_backoff_delay,
-             border_sleep_time=config.postgres_db.max_backoff_delay,
-             total_sleep_time=config.postgres_db.total_backoff_time)
-    def connect(self):
-        self.connection = psycopg2.connect(**self.dsn, cursor_factory=DictCursor)
+        self.related_executor.shutdown(wait=False)
 
+    @retry_on_connection_error
     def extract_batch(self, extract_since=None) -> BatchExtractResult:
         if not extract_since:
             extract_since = ExtractorState(filmworks_state=datetime.min.replace(tzinfo=pytz.UTC),
                                            persons_state=datetime.min.replace(tzinfo=pytz.UTC),
-                                           genres_state=datetime.min.replace(tzinfo=pytz.UTC))
-        try:
-            return self.extract_batch_impl(extract_since)
-        except (psycopg2.OperationalError, psycopg2.InterfaceError) as db_exception:
-            logging.warning(f'Failed to execute extract_batch from postgres: {db_exception}')
-            self.connect()
-            return self.extract_batch(extract_since)
-
-    def extract_batch_impl(self, extract_since) -> BatchExtractResult:
-        extract_res = self.extractor.extract_batch(self.connection, extract_since)
+                                           genres_state=datetime.min.replace(tzinfo=pytz.UTC),
+                                           related_changes_state=datetime.min.replace(tzinfo=pytz.UTC))
+        with self.pool.connection() as connection:
+            return self.extract_batch_impl(connection, extract_since)
+
+    def get_extract_until(self, connection) -> Optional[datetime]:
+        """
+        Момент, до которого изменения гарантированно видны в базе, за вычетом safety_margin (на транзакции,
+        начатые раньше, но еще не завершенные, и на доставку WAL на реплику). На реплике это время последней
+        примененной транзакции, а если реплика применила все принятое и WAL receiver подключен к основной базе -
+        текущее время: иначе при простое основной базы граница стояла бы на месте и последние изменения не
+        выгружались бы до следующей записи. None - реплика еще ничего не применила.
+        """
+        with connection:
+            with connection.cursor() as cursor:
+                # статус WAL receiver виден только ролям с pg_read_all_stats, для остальных реплика не считается
+                # догнавшей, и граница - время последней примененной транзакции
+                cursor.execute("""
+                                SELECT
+                                    pg_is_in_recovery() as is_replica,
+                                    now() as now,
+                                    pg_last_xact_replay_timestamp() as replayed_at,
+                                    coalesce(pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                                             AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver
+                                                         WHERE status = 'streaming'), false) as caught_up;
+                               """)
+                row = cursor.fetchone()
+
+        if not row['is_replica'] or row['caught_up']:
+            visible_until = row['now']
+        else:
+            visible_until = row['replayed_at']
+            if visible_until is None:
+                return None
+            logging.info(f'Replica replay lag is {row["now"] - visible_until}')
+        extract_until = visible_until - self.safety_margin
+        self.check_stalled(extract_until)
+        return extract_until
+
+    def check_stalled(self, extract_until: datetime):
+        if extract_until != self.last_extract_until:
+            self.last_extract_until = extract_until
+            self.stalled_checks = 0
+            return
+        self.stalled_checks += 1
+        if self.stalled_checks % STALLED_BOUND_WARNING_CHECKS == 0:
+            logging.warning(f'Extract bound has not moved from {extract_until} for {self.stalled_checks} checks, '
+                            f'the replica may be disconnected from the primary')
+
+    def extract_batch_impl(self, connection, extract_since) -> BatchExtractResult:
+        extract_until = self.get_extract_until(connection)
+        if extract_until is None:
+            logging.warning('Replica has not replayed any transaction yet, nothing to extract')
+            return BatchExtractResult()
+        for extractor in self.all_extractors:
+            extractor.extract_until = extract_until
+
+        extract_res = self.extractor.extract_batch(connection, extract_since)
         while not extract_res.filmworks and not extract_res.state:
             self.extractor = next(self.extractors, None)
             if not self.extractor:
                 break
-            extract_res = self.extractor.extract_batch(self.connection, extract_since)
+            extract_res = self.extractor.extract_batch(connection, extract_since)
 
         return extract_res
+
+    def extract_related(self, extract_res: BatchExtractResult) -> RelatedExtractResult:
+        """Выгрузка персон и жанров, затронутых пачкой фильмов"""
+        persons = self.related_executor.submit(self.extract_items, self.persons_extractor, extract_res)
+        genres = self.related_executor.submit(self.extract_items, self.genres_extractor, extract_res)
+        return RelatedExtractResult(persons=persons.result(), genres=genres.result())
+
+    @retry_on_connection_error
+    def extract_items(self, extractor: BaseRelatedExtractor, extract_res: BatchExtractResult) -> List:
+        with self.pool.connection() as connection:
+            return extractor.extract(connection, extract_res)
@@ -9,30 +9,37 @@ from abc import abstractmethod, ABC
 
 import requests
 
-from postgres_to_es.backoff import backoff
-from postgres_to_es.models import FilmWork, NamedItem
+from postgres_to_es.backoff import backoff, get_circuit_breaker
+from postgres_to_es.models import FilmWork, NamedItem, Person, Genre
 from postgres_to_es.config import config
 
 
+# Общий для всех воркеров процесса автомат для Elasticsearch
+es_breaker = get_circuit_breaker('elasticsearch', **config.es_db.circuit_breaker.dict())
+
+
+class ElasticsearchUnavailable(Exception):
+    """Elasticsearch ответил ошибкой 5xx: сервис перегружен или недоступен"""
+
+
 class BaseLoader(ABC):
     """Базовый класс для загрузки данных в Elasticsearch"""
 
-    def __init__(self, dsn):
+    def __init__(self, dsn, index: Optional[str] = None):
         self.dsn = dict(dsn)
+        self.index = index or self.dsn['dbname']
 
-    @backoff(exceptions=(requests.exceptions.ConnectionError,),
-             start_sleep_time=config.es_db.min_backoff_delay, border_sleep_time=config.es_db.max_backoff_delay,
-             total_sleep_time=config.es_db.total_backoff_time)
     def load(self, filmworks: Iterable[FilmWork]) -> (bool, datetime):
         if not filmworks:
             logging.warning('Loading to Elasticsearch: empty list')
             return True, None
 
         bulk_request_string = self.transform_items_to_raw_request_data(filmworks)
-        headers = {'Content-Type': 'application/x-ndjson'}
-        response = requests.post("http://{}:{}/_bulk?filter_path=errors".format(self.dsn['host'], self.dsn['port']),
-                                 data=bulk_request_string,
-                                 headers=headers)
+        try:
+            response = self.send_bulk(bulk_request_string)
+        except ElasticsearchUnavailable as err:
+            logging.error(f'Loading to Elasticsearch: {err}')
+            return False, None
 
         if response.status_code != HTTPStatus.OK or response.json().get('errors', True) is True:
             logging.error(f'Loading to Elasticsearch: loaded with errors ({response.status_code})')
@@ -42,6 +49,19 @@ class BaseLoader(ABC):
 
         return True, filmworks[-1].updated_at
 
+    # Ответы 5xx, как и потеря соединения, засчитываются автомату как ошибки и повторяются
+    @backoff(exceptions=(requests.exceptions.ConnectionError, ElasticsearchUnavailable),
+             start_sleep_time=config.es_db.min_backoff_delay, border_sleep_time=config.es_db.max_backoff_delay,
+             total_sleep_time=config.es_db.total_backoff_time, breaker=es_breaker)
+    def send_bulk(self, bulk_request_string: str) -> requests.Response:
+        headers = {'Content-Type': 'application/x-ndjson'}
+        response = requests.post("http://{}:{}/_bulk?filter_path=errors".format(self.dsn['host'], self.dsn['port']),
+                                 data=bulk_request_string,
+                                 headers=headers)
+        if response.status_code >= HTTPStatus.INTERNAL_SERVER_ERROR:
+            raise ElasticsearchUnavailable(f'bulk request failed with status {response.status_code}')
+        return response
+
     @abstractmethod
     def transform_item_to_raw_json(self, item) -> Optional[Dict]:
         """Преобразовать входные данные в json для эластика"""
@@ -54,12 +74,12 @@ class BaseLoader(ABC):
             if not raw_json:
                 # Удаляем
                 bulk_request_data.append(
-                    {"delete": {"_index": self.dsn['dbname'], "_id": str(item.id)}}
+                    {"delete": {"_index": self.index, "_id": str(item.id)}}
                 )
             else:
                 # Добавляем / обновляем
                 bulk_request_data.append(
-                    {"index": {"_index": self.dsn['dbname'], "_id": str(item.id)}}
+                    {"index": {"_index": self.index, "_id": str(item.id)}}
                 )
                 bulk_request_data.append(
                     raw_json
@@ -89,6 +109,8 @@ class Loader(BaseLoader):
                     "title": filmwork.title,
                     "description": filmwork.description,
                     "imdb_rating": filmwork.rating,
+                    "type": filmwork.type,
+                    "updated_at": filmwork.updated_at.isoformat(),
                     "id": str(filmwork.id)
                }
 
@@ -99,3 +121,37 @@ class Loader(BaseLoader):
     @staticmethod
     def named_items_names(named_items: Set[NamedItem]):
         return ', '.join(item.name for item in named_items)
+
+
+class PersonsLoader(BaseLoader):
+    """Класс для загрузки данных о персонах в Elasticsearch"""
+
+    def transform_item_to_raw_json(self, item):
+        person: Person = item
+        if not person.full_name:
+            return None
+
+        return {
+                    "id": str(person.id),
+                    "full_name": person.full_name,
+                    "roles": sorted(person.roles),
+                    "film_ids": [str(film_id) for film_id in person.film_ids],
+                    "updated_at": person.updated_at.isoformat()
+               }
+
+
+class GenresLoader(BaseLoader):
+    """Класс для загрузки данных о жанрах в Elasticsearch"""
+
+    def transform_item_to_raw_json(self, item):
+        genre: Genre = item
+        if not genre.name:
+            return None
+
+        return {
+                    "id": str(genre.id),
+                    "name": genre.name,
+                    "description": genre.description,
+                    "film_count": genre.film_count,
+                    "updated_at": genre.updated_at.isoformat()
+               }
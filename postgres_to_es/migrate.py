@@ -1,23 +1,53 @@
+import json
+
 import requests
 import logging
 
 from postgres_to_es.config import config
 from postgres_to_es.es_db_schema import db_schema
+from postgres_to_es.es_persons_schema import persons_schema
+from postgres_to_es.es_genres_schema import genres_schema
+
 
+def index_url(path: str) -> str:
+    return 'http://{host}:{port}/{path}'.format(host=config.es_db.dsn.host, port=config.es_db.dsn.port, path=path)
 
-def create_index():
+
+def create_index(index: str, schema: str):
     try:
         headers = {'Content-Type': 'application/json'}
-        response = requests.put('http://{host}:{port}/{path}'.format(host=config.es_db.dsn.host,
-                                                                     port=config.es_db.dsn.port,
-                                                                     path=config.es_db.dsn.dbname),
-                                data=db_schema,
-                                headers=headers)
-        logging.info(f'Finished with response: {response.status_code} ({response.text}))')
+        if requests.head(index_url(index)).status_code == 200:
+            update_mapping(index, schema)
+            return
+        response = requests.put(index_url(index), data=schema, headers=headers)
+        logging.info(f'Finished {index} with response: {response.status_code} ({response.text}))')
     except requests.exceptions.ConnectionError as es_connection_error:
         logging.warning(f'Failed to connect to ES: {es_connection_error}', )
 
 
+def update_mapping(index: str, schema: str):
+    """
+    Добавление в существующий индекс новых полей схемы (индексы со strict-маппингом отклоняют документы с полями,
+    которых нет в маппинге). Изменить тип или анализатор существующего поля, _source и настройки индекса
+    (например, сортировку) так нельзя - для этого индекс нужно пересоздать
+    """
+    # передаем только поля: изменение _source (например, excludes) ES для существующего индекса отклоняет
+    properties = json.loads(schema)['mappings']['properties']
+    response = requests.put(index_url(f'{index}/_mapping'), data=json.dumps({'properties': properties}),
+                            headers={'Content-Type': 'application/json'})
+    if response.status_code != 200:
+        logging.warning(f'Failed to update mapping of {index}: {response.status_code} ({response.text}), '
+                        f'the index has to be recreated')
+        return
+    logging.info(f'Updated mapping of existing index {index}')
+
+
+def create_indexes():
+    create_index(config.es_db.dsn.dbname, db_schema)
+    create_index(config.es_db.persons_index, persons_schema)
+    create_index(config.es_db.genres_index, genres_schema)
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format='%(asctime)s : %(name)s - %(levelname)s - %(message)s')
-    create_index()
+    create_indexes()
@@ -23,3 +23,21 @@ class FilmWork:
     actors: Set[NamedItem] = field(default_factory=set)
     writers: Set[NamedItem] = field(default_factory=set)
     directors: Set[NamedItem] = field(default_factory=set)
+
+
+@dataclass(frozen=True)
+class Person:
+    id: uuid.UUID
+    full_name: Optional[str]
+    updated_at: Optional[datetime]
+    roles: Set[str] = field(default_factory=set)
+    film_ids: Set[uuid.UUID] = field(default_factory=set)
+
+
+@dataclass(frozen=True)
+class Genre:
+    id: uuid.UUID
+    name: Optional[str]
+    description: Optional[str]
+    updated_at: Optional[datetime]
+    film_count: int = 0
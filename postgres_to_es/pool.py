@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import DictCursor
+
+from postgres_to_es.backoff import get_circuit_breaker
+from postgres_to_es.config import config
+
+
+# Общий для всех воркеров процесса автомат для Postgres
+postgres_breaker = get_circuit_breaker('postgres', **config.postgres_db.circuit_breaker.dict())
+
+
+class PoolTimeout(Exception):
+    """За отведенное время не освободилось ни одного соединения"""
+
+
+class ConnectionPool:
+    """
+    Пул постоянных соединений с Postgres для потоков ETL. Соединений не больше size, свободные выдаются в порядке
+    LIFO (последнее возвращенное соединение скорее всего живо). Соединение, простаивавшее дольше
+    health_check_interval, перед выдачей проверяется запросом SELECT 1. Соединение, на котором возникла ошибка
+    соединения (OperationalError, InterfaceError), в пул не возвращается, вместо него при следующем запросе
+    открывается новое.
+    """
+
+    def __init__(self, dsn, size: int = 2, health_check_interval: float = 30, acquire_timeout: float = 30):
+        self.dsn = dict(dsn)
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self._idle = deque()  # пары (соединение, время возврата в пул)
+        self._opened = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def connection(self):
+        connection = self._acquire()
+        try:
+            yield connection
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self._discard(connection)
+            raise
+        except BaseException:
+            self._release(connection)
+            raise
+        self._release(connection)
+
+    def close(self):
+        with self._condition:
+            while self._idle:
+                connection, _ = self._idle.pop()
+                connection.close()
+                self._opened -= 1
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self._condition:
+                while not self._idle and self._opened >= self.size:
+                    if not self._condition.wait(deadline - time.monotonic()):
+                        raise PoolTimeout(f'No free postgres connection in {self.acquire_timeout} seconds')
+                if not self._idle:
+                    self._opened += 1
+                    break
+                connection, released_at = self._idle.pop()
+
+            # проверка вне блокировки, чтобы медленная сеть не задерживала остальные потоки
+            if self._is_usable(connection, released_at):
+                return connection
+            logging.info('ConnectionPool: replacing broken connection to postgres')
+            self._discard(connection)
+
+        try:
+            return psycopg2.connect(**self.dsn, cursor_factory=DictCursor)
+        except BaseException:
+            with self._condition:
+                self._opened -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, connection):
+        if not connection.closed and connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                pass
+        if connection.closed or connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            self._discard(connection)
+            return
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    def _discard(self, connection):
+        connection.close()
+        with self._condition:
+            self._opened -= 1
+            self._condition.notify()
+
+    def _is_usable(self, connection, released_at: float) -> bool:
+        if connection.closed:
+            return False
+        if time.monotonic() - released_at < self.health_check_interval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
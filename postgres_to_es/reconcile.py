@@ -0,0 +1,190 @@
+import argparse
+import json
+import logging
+import sys
+from dataclasses import dataclass
+from datetime import datetime
+from enum import Enum
+from typing import Iterator, Tuple, Optional, List, Dict
+
+import psycopg2
+import requests
+from psycopg2.extras import register_uuid, DictCursor
+
+from postgres_to_es.backoff import backoff
+from postgres_to_es.config import config
+from postgres_to_es.extractor import BaseExtractor
+from postgres_to_es.loader import Loader, es_breaker
+from postgres_to_es.models import FilmWork
+from postgres_to_es.state_storage import JsonFileStorage, State
+
+
+# Сверка Postgres и индекса movies в Elasticsearch. Обе стороны читаются потоково, отсортированными по id
+# (в Postgres - серверным курсором, в ES - через search_after), и сливаются merge-join'ом, так что в памяти
+# одновременно находится не больше одной пачки с каждой стороны. Порядок uuid в Postgres (побайтовый) совпадает
+# с лексикографическим порядком их строкового представления, по которому сортирует keyword-поле id в ES.
+
+
+VersionPair = Tuple[str, Optional[datetime]]
+
+
+class DriftType(Enum):
+    missing = 'missing'  # фильм есть в Postgres, но его нет в индексе
+    stale = 'stale'  # в индексе лежит более старая версия фильма
+    orphaned = 'orphaned'  # фильм удален из Postgres, но остался в индексе
+
+
+@dataclass(frozen=True)
+class Drift:
+    id: str
+    drift_type: DriftType
+
+
+def iter_postgres_versions(connection, chunk_size: int) -> Iterator[VersionPair]:
+    """Потоковое чтение пар (id, updated_at) из content.film_work в порядке id"""
+    with connection.cursor(name='reconcile_film_work_versions') as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute("""
+                            SELECT id, updated_at
+                            FROM content.film_work
+                            ORDER BY id;
+                       """)
+        for film_id, updated_at in cursor:
+            yield str(film_id), updated_at
+
+
+@backoff(exceptions=(requests.exceptions.ConnectionError,),
+         start_sleep_time=config.es_db.min_backoff_delay, border_sleep_time=config.es_db.max_backoff_delay,
+         total_sleep_time=config.es_db.total_backoff_time, breaker=es_breaker)
+def search_es(url: str, body: Dict) -> List[Dict]:
+    response = requests.post(url,
+                             params={'filter_path': 'hits.hits._id,hits.hits._source,hits.hits.sort'},
+                             data=json.dumps(body),
+                             headers={'Content-Type': 'application/json'})
+    response.raise_for_status()
+    return response.json().get('hits', {}).get('hits', [])
+
+
+def iter_es_versions(dsn, chunk_size: int) -> Iterator[VersionPair]:
+    """Потоковое чтение пар (id, updated_at) из индекса в порядке id с помощью search_after"""
+    url = 'http://{}:{}/{}/_search'.format(dsn.host, dsn.port, dsn.dbname)
+    search_after = None
+    while True:
+        body = {
+            'size': chunk_size,
+            '_source': ['updated_at'],
+            'sort': [{'id': 'asc'}],
+            'track_total_hits': False,
+        }
+        if search_after:
+            body['search_after'] = search_after
+
+        hits = search_es(url, body)
+        if not hits:
+            return
+
+        for hit in hits:
+            updated_at = hit.get('_source', {}).get('updated_at')
+            yield hit['_id'], datetime.fromisoformat(updated_at) if updated_at else None
+        search_after = hits[-1]['sort']
+
+
+def merge_versions(pg_versions: Iterator[VersionPair], es_versions: Iterator[VersionPair]) -> Iterator[Drift]:
+    """Merge-join двух отсортированных по id потоков с выдачей расхождений"""
+    pg_item = next(pg_versions, None)
+    es_item = next(es_versions, None)
+    while pg_item or es_item:
+        if es_item is None or (pg_item is not None and pg_item[0] < es_item[0]):
+            yield Drift(id=pg_item[0], drift_type=DriftType.missing)
+            pg_item = next(pg_versions, None)
+        elif pg_item is None or es_item[0] < pg_item[0]:
+            yield Drift(id=es_item[0], drift_type=DriftType.orphaned)
+            es_item = next(es_versions, None)
+        else:
+            # Документы, проиндексированные до появления в схеме поля updated_at, и фильмы без updated_at
+            # в Postgres (строки, загруженные в обход Django) считаем устаревшими
+            if es_item[1] is None or pg_item[1] is None or pg_item[1] > es_item[1]:
+                yield Drift(id=pg_item[0], drift_type=DriftType.stale)
+            pg_item = next(pg_versions, None)
+            es_item = next(es_versions, None)
+
+
+class Reconciler:
+    """Класс для исправления расхождений пачками: переиндексация недостающих и устаревших фильмов
+    и удаление из индекса фильмов, которых уже нет в Postgres"""
+
+    def __init__(self, connection, loader: Loader, batch_size: int):
+        self.connection = connection
+        self.loader = loader
+        self.batch_size = batch_size
+        self.reindex_ids: List[str] = []
+        self.delete_ids: List[str] = []
+
+    def add(self, drift: Drift):
+        if drift.drift_type == DriftType.orphaned:
+            self.delete_ids.append(drift.id)
+        else:
+            self.reindex_ids.append(drift.id)
+
+        if len(self.reindex_ids) + len(self.delete_ids) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        filmworks = []
+        if self.reindex_ids:
+            with self.connection.cursor() as cursor:
+                enriched_data = BaseExtractor.enrich(cursor, self.reindex_ids)
+                filmworks.extend(BaseExtractor.transform_raw_data_to_films(enriched_data))
+        # Фильм без названия Loader превращает в удаление документа
+        filmworks.extend(FilmWork(id=film_id, title=None, description=None, type=None, rating=None, updated_at=None)
+                         for film_id in self.delete_ids)
+
+        if filmworks:
+            load_result, _ = self.loader.load(filmworks)
+            if not load_result:
+                logging.error(f'Reconcile: failed to apply {len(filmworks)} fixes')
+
+        self.reindex_ids = []
+        self.delete_ids = []
+
+
+def prune_related_changes(connection):
+    """Удаление из журнала content.related_change записей, уже обработанных ETL (до его контрольной точки)"""
+    synced_date = State(JsonFileStorage(config.state_file_path)).get_state('related_changes_synced_date')
+    if not synced_date:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM content.related_change WHERE changed_at <= %s;', (synced_date,))
+        logging.info(f'Reconcile: pruned {cursor.rowcount} processed related changes')
+
+
+def reconcile(apply: bool, chunk_size: int):
+    register_uuid()
+    stats = {drift_type: 0 for drift_type in DriftType}
+    with psycopg2.connect(**dict(config.postgres_db.dsn), cursor_factory=DictCursor) as connection:
+        reconciler = Reconciler(connection, Loader(config.es_db.dsn), config.batch_size) if apply else None
+        drifts = merge_versions(iter_postgres_versions(connection, chunk_size),
+                                iter_es_versions(config.es_db.dsn, chunk_size))
+        for drift in drifts:
+            stats[drift.drift_type] += 1
+            if reconciler:
+                reconciler.add(drift)
+            else:
+                sys.stdout.write(json.dumps({'id': drift.id, 'drift': drift.drift_type.value}) + '\n')
+        if reconciler:
+            reconciler.flush()
+            prune_related_changes(connection)
+    connection.close()
+
+    logging.info('Reconcile: ' + ', '.join(f'{drift_type.value}={count}' for drift_type, count in stats.items()))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s : %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Сверка content.film_work с индексом movies в Elasticsearch')
+    parser.add_argument('--apply', action='store_true',
+                        help='сразу исправить расхождения (по умолчанию только вывести их в stdout в формате NDJSON)')
+    parser.add_argument('--chunk-size', type=int, default=5000,
+                        help='размер пачки при чтении из Postgres и Elasticsearch')
+    args = parser.parse_args()
+    reconcile(args.apply, args.chunk_size)
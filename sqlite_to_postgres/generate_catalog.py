@@ -0,0 +1,401 @@
+import argparse
+import logging
+import random
+import sqlite3
+import time
+import uuid
+from array import array
+from contextlib import closing
+from functools import lru_cache
+from datetime import date, datetime, timezone
+from itertools import accumulate
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from psycopg2.extras import execute_values
+
+from sqlite_to_postgres.load_data import (REFRESH_SEARCH_VECTORS_SQL, PostgresSaver, connect_postgres, dsn_from_env,
+                                          make_copy_converter, tables)
+
+
+# Генератор синтетического каталога для нагрузочного тестирования: от десятков тысяч до миллионов фильмов в SQLite
+# (в схеме db.sqlite) и/или в схеме content Postgres. Распределения приближены к реальным:
+# - размер актерского состава - распределение Парето (у большинства фильмов несколько актеров, у части - десятки);
+# - популярность персон - закон Ципфа-Мандельброта, так что самые популярные персоны снимаются в тысячах фильмов;
+# - популярность жанров тоже неравномерная.
+# Строки генерируются пачками и пишутся в SQLite через executemany, в Postgres - через COPY с отложенными индексами.
+# id персон вычисляются из их номера, поэтому в памяти держатся только накопленные веса популярности.
+#
+# Команда churn имитирует правки из админки в уже заполненном Postgres: изменение фильмов, персон и жанров,
+# добавление и удаление связей с обновлением updated_at фильмов, как это делают сигналы админки.
+#
+#   $ python -m sqlite_to_postgres.generate_catalog generate --films 1000000 --sqlite catalog.sqlite --postgres
+#   $ python -m sqlite_to_postgres.generate_catalog churn --edits 10000 --rate 50
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE genre (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    description TEXT,
+    created_at timestamp with time zone,
+    updated_at timestamp with time zone
+);
+CREATE TABLE film_work (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    description TEXT,
+    creation_date DATE,
+    certificate TEXT,
+    file_path TEXT,
+    rating FLOAT,
+    type TEXT not null,
+    created_at timestamp with time zone,
+    updated_at timestamp with time zone
+);
+CREATE TABLE person (
+    id TEXT PRIMARY KEY,
+    full_name TEXT NOT NULL,
+    birth_date DATE,
+    created_at timestamp with time zone,
+    updated_at timestamp with time zone
+);
+CREATE TABLE genre_film_work (
+    id TEXT PRIMARY KEY,
+    film_work_id TEXT NOT NULL,
+    genre_id TEXT NOT NULL,
+    created_at timestamp with time zone
+);
+CREATE TABLE person_film_work (
+    id TEXT PRIMARY KEY,
+    film_work_id TEXT NOT NULL,
+    person_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    created_at timestamp with time zone
+);
+"""
+
+SQLITE_INDEXES = """
+CREATE UNIQUE INDEX film_work_genre ON genre_film_work (film_work_id, genre_id);
+CREATE UNIQUE INDEX film_work_person_role ON person_film_work (film_work_id, person_id, role);
+"""
+
+GENRES = ('Drama', 'Comedy', 'Action', 'Thriller', 'Romance', 'Crime', 'Adventure', 'Horror', 'Sci-Fi', 'Family',
+          'Fantasy', 'Mystery', 'Animation', 'Documentary', 'Biography', 'History', 'Music', 'War', 'Sport',
+          'Western', 'Musical', 'Short', 'Reality-TV', 'Talk-Show', 'Game-Show', 'News', 'Film-Noir', 'Adult')
+FIRST_NAMES = ('John', 'Mary', 'James', 'Anna', 'Robert', 'Olga', 'Michael', 'Elena', 'David', 'Maria', 'Peter',
+               'Linda', 'Ivan', 'Sarah', 'Thomas', 'Irina', 'Daniel', 'Laura', 'Sergey', 'Emma', 'George', 'Alice')
+LAST_NAMES = ('Smith', 'Ivanov', 'Johnson', 'Petrova', 'Brown', 'Sokolov', 'Miller', 'Kuznetsova', 'Davis',
+              'Popov', 'Wilson', 'Morozova', 'Taylor', 'Volkov', 'Clark', 'Lebedeva', 'Lewis', 'Novikov', 'Walker')
+TITLE_WORDS = ('Star', 'Night', 'Last', 'Dark', 'Return', 'Lost', 'City', 'Dream', 'War', 'Love', 'Secret',
+               'Empire', 'Shadow', 'River', 'Storm', 'Ghost', 'Silent', 'Golden', 'Winter', 'Road', 'Fire', 'Moon')
+DESCRIPTION_WORDS = ('a', 'the', 'young', 'hero', 'must', 'find', 'family', 'against', 'world', 'secret', 'time',
+                     'after', 'journey', 'friends', 'mysterious', 'city', 'love', 'war', 'past', 'truth', 'power')
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f+00'
+CATALOG_START = datetime(2015, 1, 1, tzinfo=timezone.utc).timestamp()
+CATALOG_END = datetime(2021, 6, 1, tzinfo=timezone.utc).timestamp()
+
+# Параметр Мандельброта: сглаживает вершину распределения популярности персон
+POPULARITY_OFFSET = 10
+MAX_ACTORS = 60
+
+UUID_VERSION_MASK = ~((0xf << 76) | (0xc << 60)) & ((1 << 128) - 1)
+UUID_VERSION_BITS = (4 << 76) | (0x8 << 60)
+
+Row = Tuple
+
+
+def format_uuid4(bits: int) -> str:
+    """Строка uuid версии 4 из 128 бит - заметно быстрее, чем str(uuid.UUID(...))"""
+    hex_value = '%032x' % (bits & UUID_VERSION_MASK | UUID_VERSION_BITS)
+    return f'{hex_value[:8]}-{hex_value[8:12]}-{hex_value[12:16]}-{hex_value[16:20]}-{hex_value[20:]}'
+
+
+def zipf_cum_weights(count: int, skew: float, offset: float = 0) -> array:
+    """Накопленные веса закона Ципфа(-Мандельброта) для random.choices"""
+    return array('d', accumulate((rank + offset) ** -skew for rank in range(1, count + 1)))
+
+
+class CatalogGenerator:
+    """Потоковая генерация строк каталога пачками фильмов"""
+
+    def __init__(self, films: int, persons: int, seed: int, person_skew: float, genre_skew: float):
+        self.films = films
+        self.persons = persons
+        self.random = random.Random(seed)
+        self.salt = self.random.getrandbits(128)
+        self.person_weights = zipf_cum_weights(persons, person_skew, POPULARITY_OFFSET)
+        self.genre_weights = zipf_cum_weights(len(GENRES), genre_skew)
+        self.genre_ids = [self.new_id() for _ in GENRES]
+        # популярные персоны встречаются постоянно, их id не пересчитываем
+        self.person_id = lru_cache(maxsize=100000)(self.person_id)
+
+    def new_id(self) -> str:
+        return format_uuid4(self.random.getrandbits(128))
+
+    def person_id(self, index: int) -> str:
+        # Нечетный множитель делает отображение номера в 128-битное число взаимно однозначным
+        return format_uuid4((index * 0x9E3779B97F4A7C15F39CC0605CEDC835 + self.salt) % (1 << 128))
+
+    def timestamps(self) -> Tuple[str, str]:
+        created_at = self.random.uniform(CATALOG_START, CATALOG_END)
+        updated_at = min(CATALOG_END, created_at + self.random.expovariate(1 / (30 * 86400)))
+        return (datetime.fromtimestamp(created_at, timezone.utc).strftime(TIMESTAMP_FORMAT),
+                datetime.fromtimestamp(updated_at, timezone.utc).strftime(TIMESTAMP_FORMAT))
+
+    def genre_rows(self) -> List[Row]:
+        return [(genre_id, name, None, *self.timestamps()) for genre_id, name in zip(self.genre_ids, GENRES)]
+
+    def person_rows(self, chunk_size: int) -> Iterator[List[Row]]:
+        rnd = self.random
+        for start in range(0, self.persons, chunk_size):
+            rows = []
+            for index in range(start, min(start + chunk_size, self.persons)):
+                birth_date = None
+                if rnd.random() < 0.4:
+                    birth_date = date.fromordinal(rnd.randint(704000, 732000)).isoformat()
+                rows.append((self.person_id(index), f'{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)}',
+                             birth_date, *self.timestamps()))
+            yield rows
+
+    def pick_persons(self, count: int) -> set:
+        indexes = self.random.choices(range(self.persons), cum_weights=self.person_weights, k=count)
+        return {self.person_id(index) for index in indexes}
+
+    def film_rows(self, chunk_size: int) -> Iterator[Tuple[List[Row], List[Row], List[Row]]]:
+        """Пачки (фильмы, связи с персонами, связи с жанрами)"""
+        rnd = self.random
+        for start in range(0, self.films, chunk_size):
+            films, person_links, genre_links = [], [], []
+            for _ in range(min(chunk_size, self.films - start)):
+                film_id = self.new_id()
+                created_at, updated_at = self.timestamps()
+                title = ' '.join(rnd.choices(TITLE_WORDS, k=rnd.randint(1, 4)))
+                description = ' '.join(rnd.choices(DESCRIPTION_WORDS, k=rnd.randint(8, 40))) \
+                    if rnd.random() < 0.8 else None
+                films.append((film_id, title, description,
+                              date.fromordinal(rnd.randint(700000, 737900)).isoformat() if rnd.random() < 0.7
+                              else None,
+                              None, None,
+                              round(rnd.triangular(1, 10, 6.5), 1) if rnd.random() < 0.9 else None,
+                              'movie' if rnd.random() < 0.8 else 'tv_show',
+                              created_at, updated_at))
+
+                cast = {
+                    'actor': self.pick_persons(min(MAX_ACTORS, int(rnd.paretovariate(1.5) * 1.5))),
+                    'director': self.pick_persons(1 if rnd.random() < 0.9 else 2),
+                    'writer': self.pick_persons(rnd.randint(1, 3)),
+                }
+                for role, person_ids in cast.items():
+                    person_links.extend((self.new_id(), film_id, person_id, role, created_at)
+                                        for person_id in person_ids)
+
+                genre_count = 1 + (rnd.random() < 0.5) + (rnd.random() < 0.2)
+                genre_ids = set(rnd.choices(self.genre_ids, cum_weights=self.genre_weights, k=genre_count))
+                genre_links.extend((self.new_id(), film_id, genre_id, created_at) for genre_id in genre_ids)
+            yield films, person_links, genre_links
+
+
+class SQLiteWriter:
+    """Запись в новую базу SQLite, уникальные индексы строятся после загрузки"""
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.executescript(SQLITE_SCHEMA)
+
+    def write(self, table_name: str, rows: List[Row]):
+        if rows:
+            self.connection.executemany(f'INSERT INTO {table_name} VALUES ({", ".join("?" * len(rows[0]))})', rows)
+
+    def close(self):
+        self.connection.executescript(SQLITE_INDEXES)
+        self.connection.commit()
+        self.connection.close()
+
+
+class PostgresWriter:
+    """
+    Запись в схему content через COPY: таблицы очищаются, индексы и внешние ключи строятся, а векторы поиска
+    пересчитываются после загрузки
+    """
+
+    def __init__(self, dsn: dict, maintenance_work_mem: str):
+        self.maintenance_work_mem = maintenance_work_mem
+        self.connection = connect_postgres(dsn)
+        self.saver = PostgresSaver(self.connection)
+        self.table_infos = {table_info.table_name: table_info for table_info in tables}
+        self.converters: Dict[str, Callable] = {name: make_copy_converter(table_info.data_type)
+                                                for name, table_info in self.table_infos.items()}
+        with self.connection:
+            self.saver.truncate_all()
+            self.deferred = self.saver.drop_deferred_schema(self.table_infos)
+
+    def write(self, table_name: str, rows: List[Row]):
+        convert = self.converters[table_name]
+        with self.connection:
+            self.saver.copy_items(table_name, self.table_infos[table_name].data_type,
+                                  [''.join([f'{convert(row)}\n' for row in rows])])
+
+    def close(self):
+        with self.connection:
+            self.saver.execute_ddl([statement for statements in self.deferred.indexes.values()
+                                    for statement in statements], self.maintenance_work_mem)
+            self.saver.execute_ddl(self.deferred.foreign_keys, self.maintenance_work_mem)
+            if self.deferred.triggers:
+                self.saver.execute_ddl([*self.deferred.triggers, REFRESH_SEARCH_VECTORS_SQL])
+        self.connection.close()
+
+
+def generate(args):
+    generator = CatalogGenerator(args.films, args.persons or max(1, args.films // 2), args.seed,
+                                 args.person_skew, args.genre_skew)
+    writers = []
+    if args.sqlite:
+        writers.append(SQLiteWriter(args.sqlite))
+    if args.postgres:
+        writers.append(PostgresWriter(dsn_from_env(), args.maintenance_work_mem))
+    if not writers:
+        raise SystemExit('Nothing to write: pass --sqlite and/or --postgres')
+
+    started = time.monotonic()
+    for writer in writers:
+        writer.write('genre', generator.genre_rows())
+    for rows in generator.person_rows(args.chunk_size):
+        for writer in writers:
+            writer.write('person', rows)
+    logging.info(f'Generated {generator.persons} persons in {time.monotonic() - started:.1f}s')
+
+    films_done = links_done = 0
+    for films, person_links, genre_links in generator.film_rows(args.chunk_size):
+        for writer in writers:
+            writer.write('film_work', films)
+            writer.write('person_film_work', person_links)
+            writer.write('genre_film_work', genre_links)
+        films_done += len(films)
+        links_done += len(person_links) + len(genre_links)
+        logging.info(f'Generated {films_done} films, {links_done} links in {time.monotonic() - started:.1f}s')
+
+    for writer in writers:
+        writer.close()
+    logging.info(f'Done in {time.monotonic() - started:.1f}s')
+
+
+def sample_ids(cursor, table: str, count: int) -> List[str]:
+    """Случайная выборка около count id таблицы без полного сканирования"""
+    cursor.execute("""SELECT reltuples FROM pg_class WHERE oid = %s::regclass""", (f'content.{table}',))
+    percent = min(100.0, 100.0 * count * 2 / max(cursor.fetchone()[0], 1))
+    cursor.execute(f"""SELECT id::text FROM content.{table} TABLESAMPLE SYSTEM (%s) LIMIT %s""", (percent, count))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def churn(args):
+    """
+    Правки пачками по --batch штук в одной транзакции с частотой --rate правок в секунду. Связи меняются вместе
+    с updated_at фильма, как при сохранении фильма в админке.
+    """
+    rnd = random.Random(args.seed)
+    edits = (
+        # (вес, имя) - доли разных правок
+        (40, 'film'), (25, 'add_person_link'), (15, 'remove_person_link'), (10, 'person'), (8, 'genre_link'),
+        (2, 'genre'),
+    )
+    edit_weights = list(accumulate(weight for weight, _ in edits))
+
+    with closing(connect_postgres(dsn_from_env())) as connection:
+        with connection, connection.cursor() as cursor:
+            film_ids = sample_ids(cursor, 'film_work', args.pool_size)
+            person_ids = sample_ids(cursor, 'person', args.pool_size)
+            genre_ids = sample_ids(cursor, 'genre', args.pool_size)
+        if not film_ids or not person_ids or not genre_ids:
+            raise SystemExit('Catalog is empty, generate it first')
+
+        done = 0
+        started = time.monotonic()
+        while done < args.edits:
+            batch = rnd.choices([name for _, name in edits], cum_weights=edit_weights,
+                                k=min(args.batch, args.edits - done))
+            with connection, connection.cursor() as cursor:
+                touched_films = set()
+                for edit in batch:
+                    film_id = rnd.choice(film_ids)
+                    if edit == 'film':
+                        cursor.execute("""UPDATE content.film_work SET rating = %s WHERE id = %s""",
+                                       (round(rnd.uniform(1, 10), 1), film_id))
+                        touched_films.add(film_id)
+                    elif edit == 'add_person_link':
+                        cursor.execute("""
+                                        INSERT INTO content.person_film_work (id, film_work_id, person_id, role, created_at)
+                                        VALUES (%s, %s, %s, %s, now())
+                                        ON CONFLICT DO NOTHING
+                                       """, (str(uuid.uuid4()), film_id, rnd.choice(person_ids),
+                                             rnd.choice(('actor', 'writer', 'director'))))
+                        touched_films.add(film_id)
+                    elif edit == 'remove_person_link':
+                        cursor.execute("""
+                                        DELETE FROM content.person_film_work
+                                        WHERE id = (SELECT id FROM content.person_film_work
+                                                    WHERE film_work_id = %s LIMIT 1)
+                                       """, (film_id,))
+                        touched_films.add(film_id)
+                    elif edit == 'person':
+                        cursor.execute("""UPDATE content.person SET full_name = %s, updated_at = now() WHERE id = %s""",
+                                       (f'{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)}',
+                                        rnd.choice(person_ids)))
+                    elif edit == 'genre_link':
+                        cursor.execute("""
+                                        INSERT INTO content.genre_film_work (id, film_work_id, genre_id, created_at)
+                                        VALUES (%s, %s, %s, now())
+                                        ON CONFLICT DO NOTHING
+                                       """, (str(uuid.uuid4()), film_id, rnd.choice(genre_ids)))
+                        touched_films.add(film_id)
+                    elif edit == 'genre':
+                        cursor.execute("""UPDATE content.genre SET description = %s, updated_at = now() WHERE id = %s""",
+                                       (' '.join(rnd.choices(DESCRIPTION_WORDS, k=8)), rnd.choice(genre_ids)))
+                if touched_films:
+                    execute_values(cursor, """
+                                            UPDATE content.film_work as fw SET updated_at = now()
+                                            FROM (VALUES %s) as touched (id)
+                                            WHERE fw.id = touched.id
+                                           """, [(film_id,) for film_id in touched_films])
+            done += len(batch)
+
+            if args.rate:
+                delay = done / args.rate - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            logging.info(f'Applied {done} edits')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s : %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Генератор синтетического каталога для нагрузочного тестирования')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = subparsers.add_parser('generate', help='сгенерировать каталог')
+    generate_parser.add_argument('--films', type=int, default=10000)
+    generate_parser.add_argument('--persons', type=int, default=None, help='по умолчанию половина от --films')
+    generate_parser.add_argument('--person-skew', type=float, default=0.8,
+                                 help='показатель степени в распределении популярности персон')
+    generate_parser.add_argument('--genre-skew', type=float, default=1.0,
+                                 help='показатель степени в распределении популярности жанров')
+    generate_parser.add_argument('--sqlite', default=None, help='путь к новому файлу SQLite')
+    generate_parser.add_argument('--postgres', action='store_true',
+                                 help='записать в Postgres (MIGRATION_DST_DB_*), таблицы content будут очищены')
+    generate_parser.add_argument('--chunk-size', type=int, default=10000)
+    generate_parser.add_argument('--maintenance-work-mem', default='512MB')
+    generate_parser.add_argument('--seed', type=int, default=42)
+
+    churn_parser = subparsers.add_parser('churn', help='имитировать правки из админки в Postgres')
+    churn_parser.add_argument('--edits', type=int, default=1000, help='общее кол-во правок')
+    churn_parser.add_argument('--rate', type=float, default=0, help='правок в секунду (0 - без ограничения)')
+    churn_parser.add_argument('--batch', type=int, default=10, help='правок в одной транзакции')
+    churn_parser.add_argument('--pool-size', type=int, default=10000, help='сколько id каждой таблицы выбрать для правок')
+    churn_parser.add_argument('--seed', type=int, default=None)
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        generate(args)
+    else:
+        churn(args)
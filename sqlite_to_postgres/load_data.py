@@ -1,7 +1,14 @@
+import io
+import json
+import logging
+import os
+import re
 import sqlite3
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import closing
-from dataclasses import dataclass, astuple, fields
-from typing import Iterable
+from dataclasses import asdict, dataclass, field, fields
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from datetime import datetime, date
 import uuid
 from enum import Enum, auto
@@ -9,7 +16,24 @@ from os import environ
 
 import psycopg2
 from psycopg2.extensions import connection as _connection
-from psycopg2.extras import execute_batch, register_uuid, DictCursor
+from psycopg2.extras import register_uuid, DictCursor
+
+
+# Кол-во строк, читаемых из SQLite за раз
+DEFAULT_CHUNK_SIZE = 5000
+# Размер блока, которым данные передаются в COPY
+COPY_BUFFER_SIZE = 1 << 20
+# maintenance_work_mem для построения индексов после загрузки
+DEFAULT_MAINTENANCE_WORK_MEM = '512MB'
+
+# Триггеры, поддерживающие content.film_work.search_vector (миграция 0004_filmwork_search_vector). На время загрузки
+# они отключаются: пересчитывать вектор на каждую пачку связей дорого, а параллельная загрузка связей разных таблиц
+# сериализуется на блокировках фильмов. После загрузки векторы всех фильмов пересчитываются одним запросом
+SEARCH_VECTOR_TRIGGER_FUNCTIONS = ['film_work_search_vector', 'film_work_link_search_vectors']
+REFRESH_SEARCH_VECTORS_SQL = """SELECT content.refresh_film_work_search_vectors(ARRAY(SELECT id FROM content.film_work))"""
+
+COPY_NULL = '\\N'
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
 
 
 @dataclass(frozen=True)
@@ -76,17 +100,162 @@ class GenreFilmWork:
 class TableInfo:
     table_name: str
     data_type: type
+    # таблицы, на которые ссылаются внешние ключи этой таблицы: они загружаются раньше
+    depends_on: Tuple[str, ...] = ()
 
 
 tables = (
     TableInfo(table_name='genre', data_type=Genre),
     TableInfo(table_name='person', data_type=Person),
     TableInfo(table_name='film_work', data_type=FilmWork),
-    TableInfo(table_name='person_film_work', data_type=PersonFilmWork),
-    TableInfo(table_name='genre_film_work', data_type=GenreFilmWork),
+    TableInfo(table_name='person_film_work', data_type=PersonFilmWork, depends_on=('film_work', 'person')),
+    TableInfo(table_name='genre_film_work', data_type=GenreFilmWork, depends_on=('film_work', 'genre')),
 )
 
 
+@dataclass
+class DeferredSchema:
+    """DDL вторичных индексов (по таблицам) и внешних ключей, удаленных на время загрузки, и отключенных триггеров"""
+    indexes: Dict[str, List[str]] = field(default_factory=dict)
+    foreign_keys: List[str] = field(default_factory=list)
+    # DDL включения триггеров search_vector; после включения векторы пересчитываются (REFRESH_SEARCH_VECTORS_SQL)
+    triggers: List[str] = field(default_factory=list)
+    # DDL удаления, в том же порядке: сначала внешние ключи, затем индексы, затем отключение триггеров
+    drops: List[str] = field(default_factory=list)
+
+    def merge(self, other: 'DeferredSchema') -> 'DeferredSchema':
+        """
+        Объединение с не восстановленной схемой прошлого запуска (без повторов). Ее индексы и внешние ключи уже
+        удалены, поэтому удалять нужно только свои
+        """
+        indexes = {table_name: list(statements) for table_name, statements in self.indexes.items()}
+        for table_name, statements in other.indexes.items():
+            indexes.setdefault(table_name, []).extend(statement for statement in statements
+                                                      if statement not in indexes[table_name])
+        return DeferredSchema(indexes=indexes,
+                              foreign_keys=[*self.foreign_keys,
+                                            *(fk for fk in other.foreign_keys if fk not in self.foreign_keys)],
+                              triggers=[*self.triggers,
+                                        *(trigger for trigger in other.triggers if trigger not in self.triggers)],
+                              drops=self.drops)
+
+
+# Ключ состояния с DDL удаленных на время загрузки индексов и внешних ключей
+DEFERRED_SCHEMA_KEY = 'deferred_schema'
+
+
+class MigrationState:
+    """
+    Контрольные точки переноса по таблицам в json-файле: ключ (updated_at, rowid) последней перенесенной строки
+    для таблиц с updated_at и rowid для таблиц связей. Там же хранится DDL удаленных на время загрузки индексов
+    и внешних ключей, пока они не восстановлены: если загрузка прервется, следующий запуск восстановит их.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as fs:
+                self.checkpoints = json.load(fs)
+        except FileNotFoundError:
+            self.checkpoints = {}
+
+    def get(self, table_name: str) -> Optional[list]:
+        with self.lock:
+            return self.checkpoints.get(table_name)
+
+    def set(self, table_name: str, checkpoint: Optional[list]):
+        with self.lock:
+            self.checkpoints[table_name] = checkpoint
+            self.save()
+
+    def reset(self):
+        """Сброс контрольных точек таблиц. Не восстановленная схема сохраняется"""
+        with self.lock:
+            self.checkpoints = {key: value for key, value in self.checkpoints.items() if key == DEFERRED_SCHEMA_KEY}
+            self.save()
+
+    def get_deferred_schema(self) -> Optional[DeferredSchema]:
+        with self.lock:
+            deferred = self.checkpoints.get(DEFERRED_SCHEMA_KEY)
+        return DeferredSchema(**deferred) if deferred else None
+
+    def set_deferred_schema(self, deferred: Optional[DeferredSchema]):
+        """Сохранение DDL удаленных индексов и внешних ключей, пока они не восстановлены (None - восстановлены)"""
+        with self.lock:
+            if deferred:
+                self.checkpoints[DEFERRED_SCHEMA_KEY] = asdict(deferred)
+            else:
+                self.checkpoints.pop(DEFERRED_SCHEMA_KEY, None)
+            self.save()
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as fs:
+            json.dump(self.checkpoints, fs)
+        os.replace(tmp_path, self.path)
+
+
+def checkpoint_columns(item_type: type) -> Tuple[str, ...]:
+    """Выражения SQLite, задающие порядок строк для контрольных точек"""
+    if 'updated_at' in {fld.name for fld in fields(item_type)}:
+        return "COALESCE(CAST(updated_at AS TEXT), '')", 'rowid'
+    return 'rowid',
+
+
+def copy_formatter(value_type: type) -> Callable[[Any], str]:
+    """Функция перевода значения поля типа value_type в текстовый формат COPY"""
+    if issubclass(value_type, Enum):
+        members = value_type.__members__
+        # значение проверяется по перечислению, неизвестное значение - KeyError
+        return lambda value: members[value].name
+    if issubclass(value_type, date):
+        return lambda value: value if isinstance(value, str) else value.isoformat()
+    if issubclass(value_type, str):
+        return lambda value: value.translate(COPY_ESCAPES)
+    # uuid хранятся в SQLite текстом и проверяются самим Postgres, числа достаточно перевести в строку
+    return str
+
+
+def make_copy_converter(item_type: type, exclude: Iterable[str] = ()) -> Callable[[tuple], str]:
+    """
+    Конвертер строки SQLite с полями item_type (кроме exclude) в строку COPY. Функции перевода полей выбираются
+    один раз на таблицу, а не проверкой типов каждого значения.
+    """
+    formatters = tuple(copy_formatter(fld.type) for fld in fields(item_type) if fld.name not in exclude)
+
+    def convert(row: tuple) -> str:
+        return '\t'.join(COPY_NULL if value is None else formatter(value)
+                         for formatter, value in zip(formatters, row))
+
+    return convert
+
+
+class CopyStream(io.TextIOBase):
+    """
+    Файлоподобный объект для COPY FROM STDIN, читающий данные из генератора кусков текста. read(size) возвращает не
+    больше size символов текущего куска, так что в памяти держится только один кусок.
+    """
+    def __init__(self, chunks: Iterable[str]):
+        self.chunks = iter(chunks)
+        self.chunk = ''
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while self.position >= len(self.chunk):
+            self.chunk = next(self.chunks, None)
+            self.position = 0
+            if self.chunk is None:
+                self.chunk = ''
+                return ''
+        end = len(self.chunk) if size is None or size < 0 else self.position + size
+        data = self.chunk[self.position:end]
+        self.position += len(data)
+        return data
+
+
 class PostgresSaver:
     """Класс для записи данных в postgres"""
     def __init__(self, pg_conn):
@@ -99,32 +268,127 @@ class PostgresSaver:
             cursor.execute("""TRUNCATE content.genre, content.person, content.film_work CASCADE""")
             cursor.execute("""TRUNCATE content.person_film_work, content.genre_film_work""")
 
-    @staticmethod
-    def raw_data_from_item(item):
-        return map(lambda value: value.name if issubclass(type(value), Enum) else value,
-                   astuple(item))
+    def collect_deferred_schema(self, table_names: Iterable[str]) -> DeferredSchema:
+        """
+        DDL внешних ключей и вторичных индексов таблиц (кроме первичных ключей и ограничений уникальности): их
+        удаления и восстановления после загрузки. Туда же - отключение и включение включенных триггеров search_vector
+        """
+        deferred = DeferredSchema()
+        table_names = list(table_names)
+        with self.pg_conn.cursor() as cursor:
+            cursor.execute("""
+                            SELECT con.conrelid::regclass::text, quote_ident(con.conname), pg_get_constraintdef(con.oid)
+                            FROM pg_constraint as con
+                            JOIN pg_class as cls ON cls.oid = con.conrelid
+                            WHERE con.contype = 'f'
+                                AND cls.relnamespace = 'content'::regnamespace
+                                AND cls.relname = ANY(%s)
+                           """, (table_names,))
+            for table, name, definition in cursor.fetchall():
+                deferred.drops.append(f"""ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {name}""")
+                deferred.foreign_keys.append(f"""ALTER TABLE {table} ADD CONSTRAINT {name} {definition}""")
+
+            cursor.execute("""
+                            SELECT cls.relname, idx.indexrelid::regclass::text, pg_get_indexdef(idx.indexrelid)
+                            FROM pg_index as idx
+                            JOIN pg_class as cls ON cls.oid = idx.indrelid
+                            WHERE cls.relnamespace = 'content'::regnamespace
+                                AND cls.relname = ANY(%s)
+                                AND NOT EXISTS (SELECT 1 FROM pg_constraint as con
+                                                WHERE con.conindid = idx.indexrelid)
+                           """, (table_names,))
+            for table_name, index_name, definition in cursor.fetchall():
+                deferred.drops.append(f"""DROP INDEX IF EXISTS {index_name}""")
+                # IF NOT EXISTS - на случай повторного восстановления после сбоя между построением и записью в state
+                deferred.indexes.setdefault(table_name, []).append(
+                    re.sub(r'^CREATE (UNIQUE )?INDEX ', r'CREATE \1INDEX IF NOT EXISTS ', definition))
+
+            cursor.execute("""
+                            SELECT tg.tgrelid::regclass::text, quote_ident(tg.tgname)
+                            FROM pg_trigger as tg
+                            JOIN pg_class as cls ON cls.oid = tg.tgrelid
+                            JOIN pg_proc as proc ON proc.oid = tg.tgfoid
+                            WHERE cls.relnamespace = 'content'::regnamespace
+                                AND cls.relname = ANY(%s)
+                                AND proc.proname = ANY(%s)
+                                AND tg.tgenabled <> 'D'
+                           """, (table_names, SEARCH_VECTOR_TRIGGER_FUNCTIONS))
+            for table, trigger_name in cursor.fetchall():
+                deferred.drops.append(f"""ALTER TABLE {table} DISABLE TRIGGER {trigger_name}""")
+                deferred.triggers.append(f"""ALTER TABLE {table} ENABLE TRIGGER {trigger_name}""")
+
+        return deferred
+
+    def drop_deferred_schema(self, table_names: Iterable[str]) -> DeferredSchema:
+        """
+        Удаление внешних ключей и вторичных индексов таблиц (кроме первичных ключей и ограничений уникальности) с
+        сохранением их DDL для восстановления после загрузки
+        """
+        deferred = self.collect_deferred_schema(table_names)
+        self.execute_ddl(deferred.drops)
+        return deferred
 
-    def save_items(self, db, items, page_size=1000):
-        """Запись айтемов items в таблицу content.db"""
-        if not items:
-            return
+    def execute_ddl(self, statements: Iterable[str], maintenance_work_mem: str = None):
+        """Выполнение DDL восстановления схемы, построение индексов - с увеличенной maintenance_work_mem"""
+        with self.pg_conn.cursor() as cursor:
+            if maintenance_work_mem:
+                cursor.execute("""SELECT set_config('maintenance_work_mem', %s, true)""", (maintenance_work_mem,))
+            for statement in statements:
+                cursor.execute(statement)
 
+    @staticmethod
+    def upsert_sql(db, field_names: List[str], staging_table: str) -> str:
+        """
+        Перенос строк из staging_table в content.db. Строки с updated_at вставляются или обновляются, только если
+        изменились данные, updated_at при этом выставляется в now(), чтобы изменения подхватил ETL. Связи не
+        изменяются: новые добавляются, а их фильмы отмечаются измененными.
+        """
+        fields_list = ", ".join(field_names)
+        if 'updated_at' not in field_names:
+            return f"""
+                    WITH inserted AS (
+                        INSERT INTO content.{db} ({fields_list})
+                        SELECT {fields_list} FROM {staging_table}
+                        ON CONFLICT DO NOTHING
+                        RETURNING film_work_id
+                    )
+                    UPDATE content.film_work SET updated_at = now()
+                    WHERE id IN (SELECT film_work_id FROM inserted)
+                    """
+
+        data_fields = [name for name in field_names if name not in ('id', 'created_at', 'updated_at')]
+        select_list = ", ".join('now()' if name == 'updated_at' else name for name in field_names)
+        return f"""
+                INSERT INTO content.{db} as dst ({fields_list})
+                SELECT {select_list} FROM {staging_table}
+                ON CONFLICT (id) DO UPDATE SET
+                    {", ".join(f'{name} = EXCLUDED.{name}' for name in data_fields)},
+                    updated_at = EXCLUDED.updated_at
+                WHERE ({", ".join(f'dst.{name}' for name in data_fields)})
+                    IS DISTINCT FROM ({", ".join(f'EXCLUDED.{name}' for name in data_fields)})
+                """
+
+    def upsert_items(self, db, item_type, chunk: str) -> int:
+        """Запись пачки строк в формате COPY в content.db через временную таблицу, возвращает кол-во изменений"""
+        field_names = [fld.name for fld in fields(item_type)]
+        staging_table = f'migration_{db}'
         with self.pg_conn.cursor() as cursor:
-            item_type = type(items[0])
-            fields_list = ", ".join([fld.name for fld in fields(item_type)])
-            placeholder_list = ", ".join(["%s"] * len(fields(item_type)))
-            sql_request = f"""
-                            INSERT INTO content.{db} 
-                            ({fields_list})
-                            VALUES 
-                            ({placeholder_list})
-                        """
-            execute_batch(
-                cursor,
-                sql_request,
-                (list(self.raw_data_from_item(item)) for item in items),
-                page_size=page_size
-            )
+            cursor.execute(f"""
+                            CREATE TEMP TABLE IF NOT EXISTS {staging_table}
+                            (LIKE content.{db} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS
+                            """)
+            cursor.copy_expert(f"COPY {staging_table} ({', '.join(field_names)}) FROM STDIN", CopyStream([chunk]),
+                               size=COPY_BUFFER_SIZE)
+            cursor.execute(self.upsert_sql(db, field_names, staging_table))
+            return cursor.rowcount
+
+    def copy_items(self, db, item_type, chunks: Iterable[str]) -> int:
+        """Потоковая запись строк в формате COPY в таблицу content.db, возвращает кол-во записанных строк"""
+        fields_list = ", ".join(fld.name for fld in fields(item_type))
+        with self.pg_conn.cursor() as cursor:
+            cursor.copy_expert(f"COPY content.{db} ({fields_list}) FROM STDIN", CopyStream(chunks),
+                               size=COPY_BUFFER_SIZE)
+            return cursor.rowcount
 
 
 class SQLiteLoader:
@@ -133,34 +397,69 @@ class SQLiteLoader:
         self.conn = conn
         sqlite3.register_converter("timestamp", SQLiteLoader.convert_timestamp)
 
-    @staticmethod
-    def item_from_raw_data(raw_data, item_type):
-        item_field_values = []
-        for value, value_field in zip(raw_data, fields(item_type)):
-            adapted_value = value
-            value_type = value_field.type
-            if issubclass(value_type, uuid.UUID):
-                adapted_value = value_type(value)
-            elif issubclass(value_type, Enum):
-                adapted_value = value_type[value]
-            item_field_values.append(adapted_value)
-
-        return item_type(*item_field_values)
-
-    def load_items(self, db, item_type):
-        """Загрузка данных типа item_type из таблицы db"""
+    def iter_copy_chunks(self, db, item_type, chunk_size=DEFAULT_CHUNK_SIZE) -> Iterator[str]:
+        """Потоковая выгрузка таблицы db пачками по chunk_size строк в текстовом формате COPY"""
+        convert = make_copy_converter(item_type)
+        fields_list = ", ".join(fld.name for fld in fields(item_type))
         cursor = self.conn.cursor()
-
-        fields_list = ", ".join([fld.name for fld in fields(item_type)])
-        sql_request = f"""
+        try:
+            cursor.execute(f"""
                 SELECT {fields_list}
                 FROM {db}
-            """
-        cursor.execute(sql_request)
-        data = [self.item_from_raw_data(raw_data, item_type) for raw_data in cursor.fetchall()]
-        cursor.close()
+            """)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield ''.join([f'{convert(row)}\n' for row in rows])
+        finally:
+            cursor.close()
+
+    def iter_changed_chunks(self, db, item_type, checkpoint: Optional[list],
+                            chunk_size=DEFAULT_CHUNK_SIZE) -> Iterator[Tuple[str, list]]:
+        """
+        Потоковая выгрузка строк таблицы db после контрольной точки checkpoint пачками в формате COPY вместе с
+        контрольной точкой последней строки пачки
+        """
+        convert = make_copy_converter(item_type)
+        fields_count = len(fields(item_type))
+        fields_list = ", ".join(fld.name for fld in fields(item_type))
+        key_columns = checkpoint_columns(item_type)
+        key_list = ", ".join(key_columns)
+        if checkpoint is None:
+            checkpoint = [''] * (len(key_columns) - 1) + [0]
 
-        return data
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(f"""
+                SELECT {fields_list}, {key_list}
+                FROM {db}
+                WHERE ({key_list}) > ({", ".join("?" * len(key_columns))})
+                ORDER BY {key_list}
+            """, checkpoint)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield ''.join([f'{convert(row[:fields_count])}\n' for row in rows]), list(rows[-1][fields_count:])
+        finally:
+            cursor.close()
+
+    def last_checkpoint(self, db, item_type) -> Optional[list]:
+        """Контрольная точка последней строки таблицы db"""
+        key_columns = checkpoint_columns(item_type)
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(f"""
+                SELECT {", ".join(key_columns)}
+                FROM {db}
+                ORDER BY {", ".join(f'{column} DESC' for column in key_columns)}
+                LIMIT 1
+            """)
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+        return list(row) if row else None
 
     @staticmethod
     def convert_timestamp(db_timestamp):
@@ -182,22 +481,173 @@ class SQLiteLoader:
         return converted_timestamp
 
 
-def load_from_sqlite(connection: sqlite3.Connection, pg_conn: _connection, table_infos: Iterable[TableInfo]):
-    """Основной метод загрузки данных из SQLite в Postgres"""
-    postgres_saver = PostgresSaver(pg_conn)
-    sqlite_loader = SQLiteLoader(connection)
-
-    # Предварительно очищаем все таблицы в postgres
-    postgres_saver.truncate_all()
-
-    # По очереди считываем данные из каждой таблицы sqlite и записываем в postgres
-    for table_info in table_infos:
-        data = sqlite_loader.load_items(table_info.table_name, table_info.data_type)
-        postgres_saver.save_items(table_info.table_name, data)
-
-
-if __name__ == '__main__':
-    dsn = {
+def connect_sqlite(db_path: str) -> sqlite3.Connection:
+    return sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+
+
+def connect_postgres(dsn: dict) -> _connection:
+    return psycopg2.connect(**dsn, cursor_factory=DictCursor)
+
+
+def run_in_dependency_order(table_infos: Iterable[TableInfo], func: Callable[[TableInfo], Any], workers: int):
+    """
+    Выполнение func для каждой таблицы в пуле из workers потоков: таблица запускается, как только завершены все
+    таблицы из ее depends_on (зависимости вне table_infos не учитываются)
+    """
+    pending = {table_info.table_name: table_info for table_info in table_infos}
+    known_tables = set(pending)
+    done = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while pending or running:
+            for table_name, table_info in list(pending.items()):
+                if all(dependency in done for dependency in table_info.depends_on if dependency in known_tables):
+                    running[executor.submit(func, table_info)] = table_name
+                    del pending[table_name]
+            if not running:
+                raise ValueError(f'Cyclic table dependencies: {", ".join(pending)}')
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                table_name = running.pop(future)
+                future.result()
+                done.add(table_name)
+
+
+def copy_table(db_path: str, dsn: dict, table_info: TableInfo, chunk_size: int,
+               state: MigrationState = None) -> int:
+    """Перенос одной таблицы на собственных соединениях с SQLite и Postgres"""
+    with closing(connect_sqlite(db_path)) as sqlite_connection, closing(connect_postgres(dsn)) as pg_connection:
+        sqlite_loader = SQLiteLoader(sqlite_connection)
+        with pg_connection:
+            chunks = sqlite_loader.iter_copy_chunks(table_info.table_name, table_info.data_type, chunk_size)
+            copied = PostgresSaver(pg_connection).copy_items(table_info.table_name, table_info.data_type, chunks)
+        if state:
+            state.set(table_info.table_name, sqlite_loader.last_checkpoint(table_info.table_name,
+                                                                           table_info.data_type))
+    logging.info(f'{table_info.table_name}: {copied} rows copied')
+    return copied
+
+
+def sync_table(db_path: str, dsn: dict, table_info: TableInfo, chunk_size: int, state: MigrationState) -> int:
+    """
+    Инкрементальный перенос строк таблицы, появившихся или измененных после ее контрольной точки. Контрольная точка
+    сохраняется после фиксации каждой пачки, поэтому прерванный перенос продолжается с последней пачки.
+    """
+    changed = 0
+    with closing(connect_sqlite(db_path)) as sqlite_connection, closing(connect_postgres(dsn)) as pg_connection:
+        postgres_saver = PostgresSaver(pg_connection)
+        chunks = SQLiteLoader(sqlite_connection).iter_changed_chunks(
+            table_info.table_name, table_info.data_type, state.get(table_info.table_name), chunk_size)
+        for chunk, checkpoint in chunks:
+            with pg_connection:
+                changed += postgres_saver.upsert_items(table_info.table_name, table_info.data_type, chunk)
+            state.set(table_info.table_name, checkpoint)
+    logging.info(f'{table_info.table_name}: {changed} rows changed')
+    return changed
+
+
+def restore_indexes(dsn: dict, statements: List[str], maintenance_work_mem: str):
+    with closing(connect_postgres(dsn)) as pg_connection:
+        with pg_connection:
+            PostgresSaver(pg_connection).execute_ddl(statements, maintenance_work_mem)
+
+
+def restore_deferred_schema(dsn: dict, deferred: DeferredSchema, workers: int, maintenance_work_mem: str,
+                            state: MigrationState = None):
+    """
+    Восстановление индексов (параллельно по таблицам), затем внешних ключей, затем включение триггеров search_vector
+    с пересчетом векторов всех фильмов. Каждый шаг (индексы - по таблицам) выполняется в своей транзакции, и после
+    ее фиксации восстановленное убирается из сохраненной в state схемы, поэтому при повторном запуске выполняется
+    только то, что не успело восстановиться
+    """
+    pending = DeferredSchema(indexes=dict(deferred.indexes), foreign_keys=list(deferred.foreign_keys),
+                             triggers=list(deferred.triggers), drops=list(deferred.drops))
+    pending_lock = threading.Lock()
+
+    def restore_table(table_name: str):
+        restore_indexes(dsn, deferred.indexes[table_name], maintenance_work_mem)
+        with pending_lock:
+            del pending.indexes[table_name]
+            if state:
+                state.set_deferred_schema(pending)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(restore_table, table_name) for table_name in deferred.indexes]:
+            future.result()
+    restore_indexes(dsn, deferred.foreign_keys, maintenance_work_mem)
+    if state and deferred.triggers:
+        pending.foreign_keys = []
+        state.set_deferred_schema(pending)
+    if deferred.triggers:
+        restore_indexes(dsn, [*deferred.triggers, REFRESH_SEARCH_VECTORS_SQL], maintenance_work_mem)
+    if state:
+        state.set_deferred_schema(None)
+
+
+def load_from_sqlite(db_path: str, dsn: dict, table_infos: Iterable[TableInfo],
+                     chunk_size: int = DEFAULT_CHUNK_SIZE, workers: int = 2, defer_schema: bool = True,
+                     maintenance_work_mem: str = DEFAULT_MAINTENANCE_WORK_MEM, state: MigrationState = None):
+    """
+    Основной метод загрузки данных из SQLite в Postgres. Независимые таблицы переносятся параллельно на отдельных
+    соединениях. С defer_schema вторичные индексы и внешние ключи удаляются перед загрузкой и строятся заново после
+    нее: индексы - параллельно по таблицам, внешние ключи - после всех индексов. Если передан state, по окончании
+    загрузки таблиц в нем сохраняются их контрольные точки для последующей инкрементальной синхронизации, а DDL
+    удаляемой схемы сохраняется в нем до удаления и хранится там, пока схема не восстановлена.
+    """
+    table_infos = list(table_infos)
+    if state:
+        state.reset()
+    # схема, не восстановленная прошлым запуском: ее индексов уже нет, поэтому заново ее не найти
+    deferred = (state.get_deferred_schema() if state else None) or DeferredSchema()
+    with closing(connect_postgres(dsn)) as pg_connection:
+        postgres_saver = PostgresSaver(pg_connection)
+
+        # Предварительно очищаем все таблицы в postgres. Фиксируем сразу, иначе блокировки TRUNCATE не дадут
+        # писать параллельным соединениям
+        with pg_connection:
+            postgres_saver.truncate_all()
+            if defer_schema:
+                deferred = postgres_saver.collect_deferred_schema(table_info.table_name
+                                                                  for table_info in table_infos).merge(deferred)
+                if state:
+                    state.set_deferred_schema(deferred)
+                postgres_saver.execute_ddl(deferred.drops)
+
+    try:
+        run_in_dependency_order(table_infos,
+                                lambda table_info: copy_table(db_path, dsn, table_info, chunk_size, state),
+                                workers)
+    except BaseException:
+        # Схему восстанавливаем и при ошибке загрузки, чтобы не оставить базу без индексов и ограничений. Ошибка
+        # восстановления не должна подменить собой ошибку загрузки: DDL остается в state для следующего запуска
+        try:
+            restore_deferred_schema(dsn, deferred, workers, maintenance_work_mem, state)
+        except Exception:
+            logging.exception('Failed to restore deferred indexes and foreign keys'
+                              + (f', their DDL is kept in {state.path}' if state else ''))
+        raise
+    restore_deferred_schema(dsn, deferred, workers, maintenance_work_mem, state)
+
+
+def sync_from_sqlite(db_path: str, dsn: dict, table_infos: Iterable[TableInfo], state: MigrationState,
+                     chunk_size: int = DEFAULT_CHUNK_SIZE, workers: int = 2):
+    """
+    Инкрементальная синхронизация SQLite с Postgres без очистки таблиц: переносятся только строки после контрольных
+    точек, а в Postgres изменяются только действительно отличающиеся строки. Удаления не переносятся.
+    Индексы и внешние ключи, не восстановленные прерванной полной загрузкой, восстанавливаются перед синхронизацией.
+    """
+    deferred = state.get_deferred_schema()
+    if deferred:
+        logging.info('Restoring indexes and foreign keys left by an interrupted reload')
+        restore_deferred_schema(dsn, deferred, workers, DEFAULT_MAINTENANCE_WORK_MEM, state)
+    run_in_dependency_order(table_infos,
+                            lambda table_info: sync_table(db_path, dsn, table_info, chunk_size, state),
+                            workers)
+
+
+def dsn_from_env() -> dict:
+    return {
         'dbname': environ.get('MIGRATION_DST_DB_NAME'),
         'user': environ.get('MIGRATION_DST_DB_USER'),
         'password': environ.get('MIGRATION_DST_DB_PASSWORD'),
@@ -205,10 +655,22 @@ if __name__ == '__main__':
         'port': int(environ.get('MIGRATION_DST_DB_PORT', '5432'))
     }
 
-    db_path = environ.get('MIGRATION_SRC_DB_PATH', 'db.sqlite')
 
-    with closing(sqlite3.connect(db_path,
-                                 detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)) as sqlite_connection,\
-            psycopg2.connect(**dsn,
-                             cursor_factory=DictCursor) as pg_connection:
-        load_from_sqlite(sqlite_connection, pg_connection, tables)
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s : %(name)s - %(levelname)s - %(message)s')
+    dsn = dsn_from_env()
+
+    db_path = environ.get('MIGRATION_SRC_DB_PATH', 'db.sqlite')
+    chunk_size = int(environ.get('MIGRATION_CHUNK_SIZE', DEFAULT_CHUNK_SIZE))
+    workers = int(environ.get('MIGRATION_WORKERS', 3))
+    defer_schema = environ.get('MIGRATION_DEFER_SCHEMA', '1') == '1'
+    maintenance_work_mem = environ.get('MIGRATION_MAINTENANCE_WORK_MEM', DEFAULT_MAINTENANCE_WORK_MEM)
+    # reload - полная перезаливка, sync - инкрементальная синхронизация от контрольных точек
+    mode = environ.get('MIGRATION_MODE', 'reload')
+    migration_state = MigrationState(environ.get('MIGRATION_STATE_PATH', 'migration_state.json'))
+
+    if mode == 'sync':
+        sync_from_sqlite(db_path, dsn, tables, migration_state, chunk_size, workers)
+    else:
+        load_from_sqlite(db_path, dsn, tables, chunk_size, workers, defer_schema, maintenance_work_mem,
+                         migration_state)
@@ -0,0 +1,192 @@
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import sys
+from contextlib import closing
+from dataclasses import dataclass, fields
+from datetime import datetime
+from enum import Enum
+from os import environ
+from typing import Iterator, List, Optional, Tuple
+
+from psycopg2.extras import register_uuid
+
+from sqlite_to_postgres.load_data import (DEFAULT_CHUNK_SIZE, SQLiteLoader, TableInfo, connect_postgres,
+                                          connect_sqlite, dsn_from_env, make_copy_converter, tables)
+
+
+# Проверка результата переноса SQLite -> Postgres. Обе стороны читаются потоково в порядке первичного ключа
+# и приводятся к одному текстовому виду - строке COPY, которую строит load_data.py (те же convert_timestamp
+# и проверка перечислений). Строки хешируются, последовательные строки SQLite группируются в пачки, и для каждой
+# пачки сравниваются кол-во строк и общий хеш со строками Postgres из того же диапазона ключей. Построчно
+# сравниваются только пачки с несовпавшим хешем. Порядок uuid в Postgres (побайтовый) совпадает с
+# лексикографическим порядком их строкового представления, по которому сортирует SQLite.
+
+
+TIMESTAMP_FIELDS = ('created_at', 'updated_at')
+
+RowDigest = Tuple[str, bytes]
+
+
+class DifferenceType(Enum):
+    missing = 'missing'  # строка есть в SQLite, но ее нет в Postgres
+    extra = 'extra'  # строка есть только в Postgres
+    changed = 'changed'  # значения строки различаются
+
+
+@dataclass(frozen=True)
+class Difference:
+    table: str
+    id: str
+    difference_type: DifferenceType
+
+
+@dataclass
+class TableReport:
+    table: str
+    sqlite_rows: int = 0
+    postgres_rows: int = 0
+    chunks: int = 0
+    mismatched_chunks: int = 0
+
+
+def row_digest(line: str) -> bytes:
+    return hashlib.blake2b(line.encode(), digest_size=16).digest()
+
+
+def iter_sqlite_digests(connection, table_info: TableInfo, exclude, chunk_size: int) -> Iterator[RowDigest]:
+    """Потоковое чтение пар (id, хеш строки) из таблицы SQLite в порядке id"""
+    SQLiteLoader(connection)  # регистрирует convert_timestamp
+    convert = make_copy_converter(table_info.data_type, exclude)
+    fields_list = ", ".join(fld.name for fld in fields(table_info.data_type) if fld.name not in exclude)
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"""
+            SELECT {fields_list}
+            FROM {table_info.table_name}
+            ORDER BY id
+        """)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row[0], row_digest(convert(row))
+    finally:
+        cursor.close()
+
+
+def iter_postgres_digests(connection, table_info: TableInfo, exclude, chunk_size: int) -> Iterator[RowDigest]:
+    """
+    Потоковое чтение пар (id, хеш строки) из таблицы Postgres в порядке id. Время переводится в часовой пояс
+    сессии и теряет его, как и наивное время из SQLite при загрузке.
+    """
+    item_fields = [fld for fld in fields(table_info.data_type) if fld.name not in exclude]
+    convert = make_copy_converter(table_info.data_type, exclude)
+    datetime_positions = [position for position, fld in enumerate(item_fields) if issubclass(fld.type, datetime)]
+    with connection.cursor(name=f'verify_{table_info.table_name}') as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(f"""
+                            SELECT {", ".join(fld.name for fld in item_fields)}
+                            FROM content.{table_info.table_name}
+                            ORDER BY id;
+                       """)
+        for row in cursor:
+            row = list(row)
+            for position in datetime_positions:
+                if row[position] is not None:
+                    row[position] = row[position].replace(tzinfo=None)
+            yield str(row[0]), row_digest(convert(row))
+
+
+def chunk_hash(chunk: List[RowDigest]) -> bytes:
+    chunk_digest = hashlib.blake2b(digest_size=16)
+    for row_id, digest in chunk:
+        chunk_digest.update(row_id.encode())
+        chunk_digest.update(digest)
+    return chunk_digest.digest()
+
+
+def diff_chunks(table: str, sqlite_chunk: List[RowDigest], postgres_chunk: List[RowDigest]) -> Iterator[Difference]:
+    sqlite_digests = dict(sqlite_chunk)
+    for row_id, digest in postgres_chunk:
+        sqlite_digest = sqlite_digests.pop(row_id, None)
+        if sqlite_digest is None:
+            yield Difference(table=table, id=row_id, difference_type=DifferenceType.extra)
+        elif sqlite_digest != digest:
+            yield Difference(table=table, id=row_id, difference_type=DifferenceType.changed)
+    for row_id in sqlite_digests:
+        yield Difference(table=table, id=row_id, difference_type=DifferenceType.missing)
+
+
+def compare_streams(report: TableReport, sqlite_rows: Iterator[RowDigest], postgres_rows: Iterator[RowDigest],
+                    chunk_size: int) -> Iterator[Difference]:
+    """
+    Сравнение потоков пачками: пачка SQLite из chunk_size строк сравнивается со строками Postgres с ключами не больше
+    ее последнего ключа. Строки Postgres после конца SQLite сравниваются с пустыми пачками.
+    """
+    postgres_item: Optional[RowDigest] = next(postgres_rows, None)
+    while True:
+        sqlite_chunk = list(itertools.islice(sqlite_rows, chunk_size))
+        postgres_chunk = []
+        if sqlite_chunk:
+            last_id = sqlite_chunk[-1][0]
+            while postgres_item is not None and postgres_item[0] <= last_id:
+                postgres_chunk.append(postgres_item)
+                postgres_item = next(postgres_rows, None)
+        else:
+            while postgres_item is not None and len(postgres_chunk) < chunk_size:
+                postgres_chunk.append(postgres_item)
+                postgres_item = next(postgres_rows, None)
+        if not sqlite_chunk and not postgres_chunk:
+            return
+
+        report.chunks += 1
+        report.sqlite_rows += len(sqlite_chunk)
+        report.postgres_rows += len(postgres_chunk)
+        if len(sqlite_chunk) != len(postgres_chunk) or chunk_hash(sqlite_chunk) != chunk_hash(postgres_chunk):
+            report.mismatched_chunks += 1
+            yield from diff_chunks(report.table, sqlite_chunk, postgres_chunk)
+
+
+def verify(db_path: str, dsn: dict, table_names: List[str], chunk_size: int, ignore_timestamps: bool) -> bool:
+    register_uuid()
+    exclude = TIMESTAMP_FIELDS if ignore_timestamps else ()
+    consistent = True
+    with closing(connect_sqlite(db_path)) as sqlite_connection, closing(connect_postgres(dsn)) as pg_connection:
+        for table_info in tables:
+            if table_names and table_info.table_name not in table_names:
+                continue
+            report = TableReport(table=table_info.table_name)
+            with pg_connection:
+                differences = compare_streams(
+                    report,
+                    iter_sqlite_digests(sqlite_connection, table_info, exclude, chunk_size),
+                    iter_postgres_digests(pg_connection, table_info, exclude, chunk_size),
+                    chunk_size)
+                for difference in differences:
+                    consistent = False
+                    sys.stdout.write(json.dumps({'table': difference.table, 'id': difference.id,
+                                                 'difference': difference.difference_type.value}) + '\n')
+            logging.info(f'Verify {report.table}: sqlite={report.sqlite_rows}, postgres={report.postgres_rows}, '
+                         f'mismatched chunks {report.mismatched_chunks}/{report.chunks}')
+
+    return consistent
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s : %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Сверка таблиц Postgres с исходной базой SQLite')
+    parser.add_argument('--table', action='append', default=[],
+                        help='проверить только эту таблицу, можно указать несколько раз')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='кол-во строк SQLite в пачке, по которой считается хеш')
+    parser.add_argument('--ignore-timestamps', action='store_true',
+                        help='не сравнивать created_at и updated_at (например, после синхронизации в режиме sync)')
+    args = parser.parse_args()
+
+    is_consistent = verify(environ.get('MIGRATION_SRC_DB_PATH', 'db.sqlite'), dsn_from_env(), args.table,
+                           args.chunk_size, args.ignore_timestamps)
+    sys.exit(0 if is_consistent else 1)